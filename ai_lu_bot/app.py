@@ -1,15 +1,21 @@
 # ai_lu_bot/app.py
+import asyncio
+import json
 import logging
 import os
+import secrets
+import signal
 import sys
 import traceback
 from pathlib import Path
 
 from dotenv import load_dotenv
+from telegram import Update
 from telegram.ext import (
     Application, # Импортируем Application
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
@@ -17,10 +23,43 @@ from telegram.constants import ChatType
 
 # Импортируем хэндлер сообщений и команду start
 from ai_lu_bot.handlers.message import handle_message, start
+from ai_lu_bot.core.memory_index import InMemoryMemoryIndex, LongTermMemory, RedisMemoryIndex
 # Импортируем GeminiService
+from ai_lu_bot.services.fake_backend import FakeModelBackend
 from ai_lu_bot.services.gemini import GeminiService
+from ai_lu_bot.services.key_pool import DEFAULT_KEY_COOLDOWN, GeminiKeyPool, GenaiKeyBackend, mask_key
+from ai_lu_bot.services.persona_cache import (
+    DEFAULT_PERSONA_CACHE_TTL,
+    DEFAULT_PERSONA_REFRESH_MARGIN,
+    DEFAULT_PERSONA_RETRY_AFTER,
+    PersonaCache,
+)
+from ai_lu_bot.services.resilience import DEFAULT_TRIGGER_DEADLINES, ResilientCaller
+from ai_lu_bot.services.scheduler import DEFAULT_QUEUE_TIMEOUTS, GeminiScheduler
+from ai_lu_bot.services.summarizer import DEFAULT_SUMMARY_MAX_TOKENS, ContextSummarizer
+from ai_lu_bot.services.update_stream import (
+    DEFAULT_CLAIM_IDLE,
+    DEFAULT_LEASE_TTL,
+    DEFAULT_PARTITIONS,
+    DEFAULT_STREAM_MAXLEN,
+    UpdateStreamPublisher,
+    UpdateStreamWorker,
+)
 # Импортируем обе реализации менеджера контекста и константу
-from ai_lu_bot.core.context import InMemoryChatContextManager, RedisChatContextManager, MAX_CONTEXT_MESSAGES
+from ai_lu_bot.core.context import (
+    InMemoryChatContextManager,
+    RedisChatContextManager,
+    TieredChatContextManager,
+    MAX_CONTEXT_MESSAGES,
+)
+from ai_lu_bot.core.album import AlbumAggregator
+from ai_lu_bot.core.codec import get_codec
+from ai_lu_bot.core.prompt_builder import DEFAULT_HISTORY_ENTRY_MAX_TOKENS, DEFAULT_HISTORY_TOKEN_BUDGET, PERSONA_INSTRUCTION
+from ai_lu_bot.core.debounce import ChatDebouncer
+from ai_lu_bot.core.metrics import log_metrics_periodically, metrics
+from ai_lu_bot.core.sequencer import ChatSequencer
+from ai_lu_bot.utils.media import DEFAULT_PHOTO_TARGET_SIDES
+from ai_lu_bot.utils.media_cache import MediaCache
 
 
 # -----------------------------------------------------------------------------
@@ -29,23 +68,151 @@ from ai_lu_bot.core.context import InMemoryChatContextManager, RedisChatContextM
 load_dotenv()
 # Переменные окружения для Telegram и Gemini
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Адрес Bot API (свой сервер telegram-bot-api или заглушка для локальных замеров); по умолчанию — api.telegram.org
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").strip()
+# Получение обновлений: 'polling' — long polling, 'webhook' — встроенный HTTP-сервер, которому Telegram отправляет обновления
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling").lower()
+# Настройки режима webhook: адрес и порт сервера, путь, публичный URL (его сообщает Telegram setWebhook)
+# и секрет из заголовка X-Telegram-Bot-Api-Secret-Token (по умолчанию — случайный при каждом запуске)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Роль процесса: 'all' — приём и обработка обновлений в одном процессе, 'ingest' — только приём (polling или webhook)
+# с записью обновлений в очередь Redis Streams, 'worker' — обработка обновлений из очереди (процессов может быть несколько)
+BOT_ROLE = os.getenv("BOT_ROLE", "all").lower()
+# Очередь обновлений: число потоков (партиций по chat_id, не меньше числа обработчиков) и примерная длина потока,
+# срок аренды потока обработчиком и через сколько секунд неподтверждённое обновление обрабатывается заново
+UPDATE_STREAM_PARTITIONS = int(os.getenv("UPDATE_STREAM_PARTITIONS", DEFAULT_PARTITIONS))
+UPDATE_STREAM_MAXLEN = int(os.getenv("UPDATE_STREAM_MAXLEN", DEFAULT_STREAM_MAXLEN))
+UPDATE_STREAM_LEASE_TTL = float(os.getenv("UPDATE_STREAM_LEASE_TTL", DEFAULT_LEASE_TTL))
+UPDATE_STREAM_CLAIM_IDLE = float(os.getenv("UPDATE_STREAM_CLAIM_IDLE", DEFAULT_CLAIM_IDLE))
+# Имя обработчика в группе потребителей (по умолчанию <hostname>-<pid>)
+UPDATE_WORKER_NAME = os.getenv("UPDATE_WORKER_NAME", "").strip() or None
 API_KEY = os.getenv("API_KEY")
+# Несколько ключей Gemini через запятую (по умолчанию — один API_KEY); запросы распределяются между ними
+API_KEYS = [key.strip() for key in os.getenv("API_KEYS", API_KEY or "").split(",") if key.strip()]
+# Лимиты одного ключа (для выбора ключа с наибольшим остатком, 0 — неизвестны) и время на скамейке после квоты/5xx
+GEMINI_KEY_RPM = float(os.getenv("GEMINI_KEY_RPM", 0))
+GEMINI_KEY_TPM = float(os.getenv("GEMINI_KEY_TPM", 0))
+GEMINI_KEY_COOLDOWN = float(os.getenv("GEMINI_KEY_COOLDOWN", DEFAULT_KEY_COOLDOWN))
+# Сколько секунд ждать одну попытку модели цепочки (см. GEMINI_ROUTES), прежде чем повторить или перейти к запасной
+GEMINI_MODEL_TIMEOUT = float(os.getenv("GEMINI_MODEL_TIMEOUT", 45))
+# Общий срок на ответ модели по триггеру, секунды (GEMINI_DEADLINE_<TRIGGER>)
+GEMINI_DEADLINES = {
+    trigger: float(os.getenv(f"GEMINI_DEADLINE_{trigger.upper()}", deadline))
+    for trigger, deadline in DEFAULT_TRIGGER_DEADLINES.items()
+}
+# Повторы при таймаутах и 5xx (всего попыток на модель), хеджированный второй запрос после p95 задержки
+GEMINI_RETRY_ATTEMPTS = int(os.getenv("GEMINI_RETRY_ATTEMPTS", 3))
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "false").lower() in ("1", "true", "yes")
+# Автомат отключения: после скольких сбоев подряд модель отвечает отказом сразу и на сколько секунд
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", 5))
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", 30))
+# Персона Лу (Блоки 1-5 промпта): 'cached' — кэш контента API (пока его нет — system instruction),
+# 'system' — system instruction в каждом запросе, 'inline' — в тексте промпта, как раньше
+GEMINI_PERSONA_MODE = os.getenv("GEMINI_PERSONA_MODE", "system").lower()
+GEMINI_PERSONA_CACHE_TTL = float(os.getenv("GEMINI_PERSONA_CACHE_TTL", DEFAULT_PERSONA_CACHE_TTL))
+GEMINI_PERSONA_CACHE_REFRESH = float(os.getenv("GEMINI_PERSONA_CACHE_REFRESH", DEFAULT_PERSONA_REFRESH_MARGIN))
+GEMINI_PERSONA_CACHE_RETRY = float(os.getenv("GEMINI_PERSONA_CACHE_RETRY", DEFAULT_PERSONA_RETRY_AFTER))
+# 'genai' — настоящий Gemini API, 'fake' — локальная заглушка без сети (для проверки без ключей)
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "genai").lower()
+# Лимиты запросов к Gemini (0 — без лимита), размер очереди и таймауты ожидания по классам приоритета
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", 0))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", 0))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", 100))
+GEMINI_QUEUE_TIMEOUTS = tuple(
+    float(t) for t in os.getenv("GEMINI_QUEUE_TIMEOUTS", ",".join(str(t) for t in DEFAULT_QUEUE_TIMEOUTS)).split(",")
+)
 # Переменные окружения для выбора хранилища контекста и его настроек Redis
 CONTEXT_STORAGE_TYPE = os.getenv("CONTEXT_STORAGE_TYPE", "memory").lower()
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
+# Сколько записей хранится на чат и сколько токенов истории (и одной записи) попадает в промпт
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", MAX_CONTEXT_MESSAGES))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", DEFAULT_HISTORY_TOKEN_BUDGET))
+HISTORY_ENTRY_MAX_TOKENS = int(os.getenv("HISTORY_ENTRY_MAX_TOKENS", DEFAULT_HISTORY_ENTRY_MAX_TOKENS))
+# Фоновое сжатие вытесненных из окна сообщений в краткое содержание переписки чата
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+CONTEXT_SUMMARY_INTERVAL = float(os.getenv("CONTEXT_SUMMARY_INTERVAL", 60))
+CONTEXT_SUMMARY_MIN_BATCH = int(os.getenv("CONTEXT_SUMMARY_MIN_BATCH", 20))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", DEFAULT_SUMMARY_MAX_TOKENS))
+# Сколько вытесненных сообщений чата хранить до сжатия (старые сверх этого теряются без сжатия)
+CONTEXT_EVICTED_MAX = CONTEXT_SUMMARY_MIN_BATCH * 10 if CONTEXT_SUMMARY_ENABLED else 0
+# Долгая память: BM25-поиск по всей истории чата, релевантные давние сообщения добавляются в промпт.
+# Индекс хранится там же, где контекст: в памяти процесса (memory) или в Redis (redis/tiered)
+MEMORY_INDEX_ENABLED = os.getenv("MEMORY_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+MEMORY_RECALL_K = int(os.getenv("MEMORY_RECALL_K", 3))
+MEMORY_RECALL_TIMEOUT = float(os.getenv("MEMORY_RECALL_TIMEOUT", 0.15))
+MEMORY_MAX_DOCS_PER_CHAT = int(os.getenv("MEMORY_MAX_DOCS_PER_CHAT", 20000))
+MEMORY_INDEX_MAX_MB = float(os.getenv("MEMORY_INDEX_MAX_MB", 64))
+# Ограничения in-memory хранилища контекста (CONTEXT_STORAGE_TYPE=memory)
+CONTEXT_MEMORY_MAX_CHATS = int(os.getenv("CONTEXT_MEMORY_MAX_CHATS", 10000))
+CONTEXT_MEMORY_MAX_MB = float(os.getenv("CONTEXT_MEMORY_MAX_MB", 64))
+CONTEXT_MEMORY_IDLE_TTL = float(os.getenv("CONTEXT_MEMORY_IDLE_TTL", 7 * 24 * 3600))
+# Формат новых записей контекста в Redis: 'binary' (компактный) или 'json'. Старые записи читаются в любом формате.
+CONTEXT_CODEC = os.getenv("CONTEXT_CODEC", "binary").lower()
+# Ограничение пула соединений и таймауты асинхронного клиента Redis
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 20))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", 5))
+# Настройки двухуровневого хранилища (CONTEXT_STORAGE_TYPE=tiered): локальный кэш + Redis
+CONTEXT_TIER_MAX_CHATS = int(os.getenv("CONTEXT_TIER_MAX_CHATS", 2000))
+CONTEXT_TIER_FLUSH_INTERVAL = float(os.getenv("CONTEXT_TIER_FLUSH_INTERVAL", 0.2))
+CONTEXT_TIER_VALIDATE_INTERVAL = float(os.getenv("CONTEXT_TIER_VALIDATE_INTERVAL", 5))
+
+# Кэш медиафайлов по file_unique_id: бюджет в памяти, бюджет на диске (mmap) и каталог для файлов
+MEDIA_CACHE_MEMORY_MB = float(os.getenv("MEDIA_CACHE_MEMORY_MB", 32))
+MEDIA_CACHE_DISK_MB = float(os.getenv("MEDIA_CACHE_DISK_MB", 256))
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR") or None
+# Максимальный размер скачиваемого медиа по типу (МБ): больше — не скачиваем вовсе
+MEDIA_MAX_MB = {
+    "image": float(os.getenv("MEDIA_MAX_MB_IMAGE", 10)),
+    "audio": float(os.getenv("MEDIA_MAX_MB_AUDIO", 20)),
+    "video": float(os.getenv("MEDIA_MAX_MB_VIDEO", 20)),
+}
+# Разрешение фото по триггеру ответа: целевая длинная сторона в пикселях (PHOTO_TARGET_SIDE_<TRIGGER>)
+PHOTO_TARGET_SIDES = {
+    trigger: int(os.getenv(f"PHOTO_TARGET_SIDE_{trigger.upper()}", side))
+    for trigger, side in DEFAULT_PHOTO_TARGET_SIDES.items()
+}
+# Фото больше этого размера (КБ) пережимаются локально, если установлен Pillow (0 — не пережимать)
+PHOTO_REENCODE_MAX_KB = float(os.getenv("PHOTO_REENCODE_MAX_KB", 0))
+# Параллельная обработка обновлений: сколько обновлений обрабатывается одновременно (1 — последовательно)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 32))
+# Сбор альбомов: сколько секунд ждать следующую часть альбома (0 — отвечать на каждую часть отдельно)
+ALBUM_COLLECT_WINDOW = float(os.getenv("ALBUM_COLLECT_WINDOW", 0.8))
+# Склейка серии быстрых сообщений в личке в один ответ: окно тишины и максимальная задержка (секунды, 0 — выключено)
+DM_DEBOUNCE_WINDOW = float(os.getenv("DM_DEBOUNCE_WINDOW", 1.5))
+DM_DEBOUNCE_MAX_WAIT = float(os.getenv("DM_DEBOUNCE_MAX_WAIT", 6))
+# Потоковая отправка ответов: первый фрагмент сразу, дальше правки сообщения не чаще STREAM_EDIT_INTERVAL секунд
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "0").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+# Период записи снимка метрик в лог (секунды, 0 — не писать)
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", 300))
 
 # Проверка критически важных переменных
 if not BOT_TOKEN:
     print("CRITICAL: TELEGRAM_BOT_TOKEN не найден в окружении", file=sys.stderr)
     sys.exit(1)
-if not API_KEY:
-    print("CRITICAL: API_KEY не найден в окружении", file=sys.stderr)
+if BOT_ROLE not in ("all", "ingest", "worker"):
+    print(f"CRITICAL: Неизвестная роль процесса: {BOT_ROLE}. Используйте 'all', 'ingest' или 'worker'.", file=sys.stderr)
+    sys.exit(1)
+if not API_KEYS and GEMINI_BACKEND != "fake" and BOT_ROLE != "ingest":
+    print("CRITICAL: API_KEY (или API_KEYS) не найден в окружении", file=sys.stderr)
+    sys.exit(1)
+if UPDATE_MODE not in ("polling", "webhook"):
+    print(f"CRITICAL: Неизвестный режим получения обновлений: {UPDATE_MODE}. Используйте 'polling' или 'webhook'.", file=sys.stderr)
+    sys.exit(1)
+if UPDATE_MODE == "webhook" and not WEBHOOK_URL and BOT_ROLE != "worker":
+    print("CRITICAL: UPDATE_MODE=webhook требует WEBHOOK_URL (публичный HTTPS-адрес, на который Telegram шлёт обновления)", file=sys.stderr)
     sys.exit(1)
 # Проверка типа хранилища контекста
-if CONTEXT_STORAGE_TYPE not in ["memory", "redis"]:
-    print(f"CRITICAL: Неизвестный тип хранилища контекста: {CONTEXT_STORAGE_TYPE}. Используйте 'memory' или 'redis'.", file=sys.stderr)
+if CONTEXT_STORAGE_TYPE not in ["memory", "redis", "tiered"]:
+    print(f"CRITICAL: Неизвестный тип хранилища контекста: {CONTEXT_STORAGE_TYPE}. Используйте 'memory', 'redis' или 'tiered'.", file=sys.stderr)
     sys.exit(1)
 
 
@@ -118,6 +285,81 @@ async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYP
         logger.error("Failed to send error message to user: %s", e)
 
 
+# -----------------------------------------------------------------------------
+# Хуки жизненного цикла Application
+# -----------------------------------------------------------------------------
+async def post_init(application: Application) -> None:
+    """
+    Выполняется внутри event loop перед началом получения обновлений.
+    Проверяет подключение асинхронных хранилищ (например, Redis).
+    """
+    chat_context_manager_instance = application.bot_data.get("chat_context_manager")
+    if hasattr(chat_context_manager_instance, "connect"):
+        # Если Redis выбран, но менеджер не смог подключиться, это критическая ошибка запуска
+        if not await chat_context_manager_instance.connect():
+            raise RuntimeError(f"{type(chat_context_manager_instance).__name__} failed to connect to Redis at {REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}.")
+
+    update_publisher = application.bot_data.get("update_publisher")
+    if update_publisher is not None and not await update_publisher.connect():
+        raise RuntimeError(f"UpdateStreamPublisher failed to connect to Redis at {REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}.")
+
+    gemini_service = application.bot_data.get("gemini_service")
+    if gemini_service is not None:
+        # Кэш персоны создаётся в фоне; до его появления персона уходит system instruction
+        gemini_service.warm_persona_cache()
+
+    if METRICS_LOG_INTERVAL > 0:
+        application.bot_data["metrics_task"] = asyncio.create_task(
+            log_metrics_periodically(METRICS_LOG_INTERVAL), name="metrics-logger"
+        )
+    context_summarizer = application.bot_data.get("context_summarizer")
+    if context_summarizer is not None:
+        application.bot_data["summarizer_task"] = asyncio.create_task(context_summarizer.run(), name="context-summarizer")
+    long_term_memory = application.bot_data.get("long_term_memory")
+    if long_term_memory is not None:
+        application.bot_data["memory_task"] = asyncio.create_task(long_term_memory.run(), name="memory-indexer")
+
+
+async def post_shutdown(application: Application) -> None:
+    """Закрывает соединения сервисов при остановке приложения."""
+    for task_name in ("metrics_task", "summarizer_task", "memory_task"):
+        task = application.bot_data.pop(task_name, None)
+        if task is not None:
+            task.cancel()
+    logger.info("Metrics snapshot at shutdown: %s", metrics.snapshot())
+    media_cache = application.bot_data.get("media_cache")
+    if media_cache is not None:
+        media_cache.close()
+    long_term_memory = application.bot_data.get("long_term_memory")
+    if long_term_memory is not None:
+        await long_term_memory.close()
+    update_publisher = application.bot_data.get("update_publisher")
+    if update_publisher is not None:
+        await update_publisher.close()
+    chat_context_manager_instance = application.bot_data.get("chat_context_manager")
+    if hasattr(chat_context_manager_instance, "close"):
+        await chat_context_manager_instance.close()
+        logger.info(f"{type(chat_context_manager_instance).__name__} connections closed.")
+
+
+def build_key_pool() -> GeminiKeyPool:
+    """Пул ключей Gemini из API_KEYS (или заглушек при GEMINI_BACKEND=fake)."""
+    if GEMINI_BACKEND == "fake":
+        logger.warning("GEMINI_BACKEND=fake: responses come from a local stub, not from Gemini.")
+        backends = [FakeModelBackend(name=f"fake{i}") for i in range(max(len(API_KEYS), 1))]
+        labels = [backend.name for backend in backends]
+    else:
+        backends = [GenaiKeyBackend(key) for key in API_KEYS]
+        labels = [mask_key(key) for key in API_KEYS]
+    return GeminiKeyPool(
+        backends,
+        labels=labels,
+        requests_per_minute=GEMINI_KEY_RPM,
+        tokens_per_minute=GEMINI_KEY_TPM,
+        cooldown=GEMINI_KEY_COOLDOWN,
+    )
+
+
 # -----------------------------------------------------------------------------
 # Сборка приложения Telegram Application
 # -----------------------------------------------------------------------------
@@ -131,14 +373,80 @@ def build_application() -> Application:
 
     # --- Создание Application ---
     # Используем BOT_TOKEN, который уже проверен
-    app = Application.builder().token(BOT_TOKEN).build()
+    # post_init/post_shutdown подключают и закрывают асинхронные хранилища внутри event loop
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Разные чаты обрабатываются параллельно; порядок внутри чата обеспечивает ChatSequencer.
+        # Приём пишет обновления в очередь строго по одному — в потоке они лежат в порядке поступления
+        .concurrent_updates(MAX_CONCURRENT_UPDATES if MAX_CONCURRENT_UPDATES > 1 and BOT_ROLE != "ingest" else False)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL.rstrip('/')}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL.rstrip('/')}/file/bot")
+    app = builder.build()
+    # Обновления (из polling или webhook) ждут обработки во внутренней очереди Application
+    metrics.register_gauge("update_queue", app.update_queue.qsize)
     logger.info("Telegram Application instance created.")
 
+    if BOT_ROLE == "ingest":
+        # Приём: обновления не обрабатываются, а пишутся в очередь для обработчиков (BOT_ROLE=worker) — сервисы ответа не нужны
+        update_publisher = UpdateStreamPublisher(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=REDIS_DB,
+            partitions=UPDATE_STREAM_PARTITIONS,
+            maxlen=UPDATE_STREAM_MAXLEN,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+        )
+        app.bot_data["update_publisher"] = update_publisher
+        app.add_handler(TypeHandler(Update, update_publisher.handle))
+        logger.info(f"Ingest role: updates are published to {UPDATE_STREAM_PARTITIONS} Redis streams (redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}).")
+        return app
+
     # --- Инициализация сервисов ---
     # Инициализация GeminiService
     # Проверка API_KEY уже была выше, но сервис может упасть и при конфигурации
     try:
-        gemini_service = GeminiService()
+        gemini_scheduler = GeminiScheduler(
+            requests_per_minute=GEMINI_RPM,
+            tokens_per_minute=GEMINI_TPM,
+            max_queue=GEMINI_MAX_QUEUE,
+            queue_timeouts=GEMINI_QUEUE_TIMEOUTS,
+        )
+        metrics.register_gauge("gemini_scheduler", gemini_scheduler.stats)
+        key_pool = build_key_pool()
+        metrics.register_gauge("gemini_keys", key_pool.stats)
+        resilience = ResilientCaller(
+            max_attempts=GEMINI_RETRY_ATTEMPTS,
+            attempt_timeout=GEMINI_MODEL_TIMEOUT,
+            hedge=GEMINI_HEDGE,
+            breaker_threshold=GEMINI_BREAKER_THRESHOLD,
+            breaker_reset=GEMINI_BREAKER_RESET,
+            deadlines=GEMINI_DEADLINES,
+        )
+        metrics.register_gauge("gemini_models", resilience.stats)
+        persona_cache = None
+        if GEMINI_PERSONA_MODE == "cached":
+            persona_cache = PersonaCache(
+                PERSONA_INSTRUCTION,
+                ttl=GEMINI_PERSONA_CACHE_TTL,
+                refresh_margin=GEMINI_PERSONA_CACHE_REFRESH,
+                retry_after=GEMINI_PERSONA_CACHE_RETRY,
+            )
+            metrics.register_gauge("persona_cache", persona_cache.stats)
+        gemini_service = GeminiService(
+            scheduler=gemini_scheduler,
+            key_pool=key_pool,
+            model_timeout=GEMINI_MODEL_TIMEOUT,
+            resilience=resilience,
+            history_token_budget=HISTORY_TOKEN_BUDGET,
+            history_entry_max_tokens=HISTORY_ENTRY_MAX_TOKENS,
+            persona_mode=GEMINI_PERSONA_MODE,
+            persona_cache=persona_cache,
+        )
         # Сохраняем инстанс сервиса в bot_data, чтобы он был доступен в хэндлерах
         app.bot_data["gemini_service"] = gemini_service
         logger.info("GeminiService initialized and added to app.bot_data.")
@@ -151,20 +459,43 @@ def build_application() -> Application:
     chat_context_manager_instance = None
     if CONTEXT_STORAGE_TYPE == "memory":
         logger.info("Using InMemoryChatContextManager for context storage.")
-        chat_context_manager_instance = InMemoryChatContextManager(max_messages=MAX_CONTEXT_MESSAGES)
-    elif CONTEXT_STORAGE_TYPE == "redis":
+        if BOT_ROLE == "worker":
+            # Чаты распределены между обработчиками и переходят от одного к другому — контекст должен быть общим
+            logger.warning("CONTEXT_STORAGE_TYPE=memory with BOT_ROLE=worker: each worker keeps its own context; use 'redis'.")
+        chat_context_manager_instance = InMemoryChatContextManager(
+            max_messages=CONTEXT_MAX_MESSAGES,
+            max_chats=CONTEXT_MEMORY_MAX_CHATS,
+            max_bytes=int(CONTEXT_MEMORY_MAX_MB * 1024 * 1024),
+            idle_ttl=CONTEXT_MEMORY_IDLE_TTL,
+            max_evicted=CONTEXT_EVICTED_MAX,
+        )
+    elif CONTEXT_STORAGE_TYPE in ("redis", "tiered"):
+        if CONTEXT_STORAGE_TYPE == "tiered" and BOT_ROLE == "worker":
+            # Локальный кэш каждого процесса согласуется с Redis не сразу, а чат может перейти к другому обработчику
+            logger.warning("CONTEXT_STORAGE_TYPE=tiered with BOT_ROLE=worker: a chat moved to another worker may briefly see stale context.")
         logger.info(f"Using RedisChatContextManager for context storage (redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}).")
         try:
             chat_context_manager_instance = RedisChatContextManager(
                 host=REDIS_HOST,
                 port=REDIS_PORT,
                 db=REDIS_DB,
-                max_messages=MAX_CONTEXT_MESSAGES
+                max_messages=CONTEXT_MAX_MESSAGES,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                connect_timeout=REDIS_CONNECT_TIMEOUT,
+                codec=get_codec(CONTEXT_CODEC),
+                max_evicted=CONTEXT_EVICTED_MAX,
             )
-            # Проверяем, успешно ли подключились к Redis внутри менеджера
-            # Если Redis выбран, но менеджер не смог подключиться, это критическая ошибка
-            if chat_context_manager_instance._redis_client is None:
-                 raise RuntimeError(f"RedisChatContextManager failed to connect to Redis at {REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}.")
+            # Само подключение (PING) проверяется асинхронно в post_init
+            if CONTEXT_STORAGE_TYPE == "tiered":
+                logger.info("Wrapping RedisChatContextManager into TieredChatContextManager (local hot cache + write-behind).")
+                chat_context_manager_instance = TieredChatContextManager(
+                    chat_context_manager_instance,
+                    max_messages=CONTEXT_MAX_MESSAGES,
+                    max_chats=CONTEXT_TIER_MAX_CHATS,
+                    flush_interval=CONTEXT_TIER_FLUSH_INTERVAL,
+                    validate_interval=CONTEXT_TIER_VALIDATE_INTERVAL,
+                )
         except Exception as e:
             logger.critical(f"Failed to initialize RedisChatContextManager: {e}")
             # Если Redis выбран, но менеджер не смог инициализироваться/подключиться, это критическая ошибка запуска
@@ -174,6 +505,74 @@ def build_application() -> Application:
     app.bot_data["chat_context_manager"] = chat_context_manager_instance
     logger.info(f"{type(chat_context_manager_instance).__name__} initialized and added to app.bot_data.")
 
+    # Кэш медиафайлов (общий для всех чатов)
+    media_cache = MediaCache(
+        memory_budget=int(MEDIA_CACHE_MEMORY_MB * 1024 * 1024),
+        disk_budget=int(MEDIA_CACHE_DISK_MB * 1024 * 1024),
+        spill_dir=MEDIA_CACHE_DIR,
+    )
+    app.bot_data["media_cache"] = media_cache
+    app.bot_data["media_max_bytes"] = {media_type: int(mb * 1024 * 1024) for media_type, mb in MEDIA_MAX_MB.items()}
+    app.bot_data["photo_target_sides"] = PHOTO_TARGET_SIDES
+    app.bot_data["photo_reencode_max_bytes"] = int(PHOTO_REENCODE_MAX_KB * 1024)
+    metrics.register_gauge("media_cache", media_cache.stats)
+
+    # Режим отправки ответов (потоковый или целиком)
+    app.bot_data["stream_responses"] = STREAM_RESPONSES
+    app.bot_data["stream_edit_interval"] = STREAM_EDIT_INTERVAL
+    logger.info(f"Response streaming {'enabled' if STREAM_RESPONSES else 'disabled'} (edit interval {STREAM_EDIT_INTERVAL}s).")
+
+    # Упорядочивание сообщений внутри чата при параллельной обработке обновлений
+    chat_sequencer = ChatSequencer()
+    app.bot_data["chat_sequencer"] = chat_sequencer
+    metrics.register_gauge("chat_queue_depth", chat_sequencer.queue_depths)
+    # Сбор частей альбома в одно сообщение (требует параллельной обработки обновлений)
+    if ALBUM_COLLECT_WINDOW > 0 and MAX_CONCURRENT_UPDATES > 1:
+        album_aggregator = AlbumAggregator(window=ALBUM_COLLECT_WINDOW)
+        app.bot_data["album_aggregator"] = album_aggregator
+        metrics.register_gauge("albums_pending", album_aggregator.pending)
+        logger.info(f"AlbumAggregator initialized (window {ALBUM_COLLECT_WINDOW}s).")
+    # Один ответ на серию сообщений в личке (требует параллельной обработки обновлений)
+    if DM_DEBOUNCE_WINDOW > 0 and MAX_CONCURRENT_UPDATES > 1:
+        chat_debouncer = ChatDebouncer(quiet_window=DM_DEBOUNCE_WINDOW, max_wait=DM_DEBOUNCE_MAX_WAIT)
+        app.bot_data["chat_debouncer"] = chat_debouncer
+        metrics.register_gauge("dm_bursts_pending", chat_debouncer.pending)
+        logger.info(f"ChatDebouncer initialized (quiet window {DM_DEBOUNCE_WINDOW}s, max wait {DM_DEBOUNCE_MAX_WAIT}s).")
+    if hasattr(chat_context_manager_instance, "stats"):
+        metrics.register_gauge("context_storage", chat_context_manager_instance.stats)
+    # Сжатие вытесненного контекста: фоновый цикл запускается в post_init
+    if CONTEXT_SUMMARY_ENABLED:
+        context_summarizer = ContextSummarizer(
+            chat_context_manager_instance,
+            gemini_service,
+            interval=CONTEXT_SUMMARY_INTERVAL,
+            min_batch=CONTEXT_SUMMARY_MIN_BATCH,
+            max_summary_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+        )
+        app.bot_data["context_summarizer"] = context_summarizer
+        metrics.register_gauge("context_summaries_pending", context_summarizer.pending)
+    # Долгая память: запись в индекс идёт в фоне (цикл запускается в post_init), поиск — в пути ответа
+    if MEMORY_INDEX_ENABLED:
+        if CONTEXT_STORAGE_TYPE == "memory":
+            memory_index = InMemoryMemoryIndex(
+                max_chats=CONTEXT_MEMORY_MAX_CHATS,
+                max_docs_per_chat=MEMORY_MAX_DOCS_PER_CHAT,
+                max_bytes=int(MEMORY_INDEX_MAX_MB * 1024 * 1024),
+            )
+            metrics.register_gauge("memory_index", memory_index.stats)
+        else:
+            memory_index = RedisMemoryIndex(
+                host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB,
+                max_connections=REDIS_MAX_CONNECTIONS, socket_timeout=REDIS_SOCKET_TIMEOUT,
+            )
+        long_term_memory = LongTermMemory(memory_index, window=CONTEXT_MAX_MESSAGES)
+        app.bot_data["long_term_memory"] = long_term_memory
+        app.bot_data["memory_recall_k"] = MEMORY_RECALL_K
+        app.bot_data["memory_recall_timeout"] = MEMORY_RECALL_TIMEOUT
+        metrics.register_gauge("memory_pending", long_term_memory.pending)
+        logger.info(f"LongTermMemory initialized ({type(memory_index).__name__}, top {MEMORY_RECALL_K}, timeout {MEMORY_RECALL_TIMEOUT}s).")
+    logger.info(f"ChatSequencer initialized (max concurrent updates: {MAX_CONCURRENT_UPDATES}).")
+
 
     # --- Регистрация хэндлеров ---
     # Глобальный error handler
@@ -208,6 +607,48 @@ def build_application() -> Application:
     return app
 
 
+async def run_worker(application: Application) -> None:
+    """
+    BOT_ROLE=worker: обновления берутся не из Telegram, а из очереди Redis Streams и проходят
+    через Application.process_update — те же хэндлеры, что и при polling/webhook. SIGINT/SIGTERM
+    останавливают чтение очереди; начатые обновления дорабатываются до остановки.
+    """
+    async def process(payload: str) -> None:
+        await application.process_update(Update.de_json(json.loads(payload), application.bot))
+
+    worker = UpdateStreamWorker(
+        process,
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        partitions=UPDATE_STREAM_PARTITIONS,
+        consumer=UPDATE_WORKER_NAME,
+        concurrency=MAX_CONCURRENT_UPDATES,
+        lease_ttl=UPDATE_STREAM_LEASE_TTL,
+        claim_idle=UPDATE_STREAM_CLAIM_IDLE,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+    )
+    if not await worker.connect():
+        raise RuntimeError(f"UpdateStreamWorker failed to connect to Redis at {REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}.")
+    metrics.register_gauge("update_stream", worker.stats)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+
+    # Тот же жизненный цикл, что у run_polling/run_webhook, только без получения обновлений из Telegram
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    try:
+        await worker.run()
+    finally:
+        await worker.close()
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+
 # -----------------------------------------------------------------------------
 # Entry‑point
 # -----------------------------------------------------------------------------
@@ -224,12 +665,32 @@ def main() -> None:
         application = build_application()
 
         logger.info("Telegram Application built successfully.")
-        logger.info("Bot starting in polling mode...")
 
-        # Запускаем бота в режиме polling.
-        # application уже определен благодаря build_application
-        application.run_polling(close_loop=False, stop_signals=None)
-        logger.info("Bot polling stopped gracefully.")
+        if BOT_ROLE == "worker":
+            logger.info("Bot starting as update stream worker %s...", UPDATE_WORKER_NAME or "(default name)")
+            asyncio.run(run_worker(application))
+            logger.info("Update stream worker stopped gracefully.")
+        elif UPDATE_MODE == "webhook":
+            # Встроенный HTTP-сервер PTB отвечает Telegram 200 сразу после проверки секрета и разбора JSON,
+            # а само обновление кладёт в очередь Application — обработка идёт отдельно (с MAX_CONCURRENT_UPDATES)
+            logger.info("Bot starting in webhook mode on %s:%d/%s (public URL %s)...", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL)
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                close_loop=False,
+                stop_signals=None,
+            )
+            logger.info("Bot webhook server stopped gracefully.")
+        else:
+            logger.info("Bot starting in polling mode...")
+            # Запускаем бота в режиме polling.
+            # application уже определен благодаря build_application
+            application.run_polling(close_loop=False, stop_signals=None)
+            logger.info("Bot polling stopped gracefully.")
 
     except Exception as exc:
         # Ловим любые исключения, произошедшие во время bootstrap (до запуска polling)
@@ -0,0 +1,80 @@
+# ai_lu_bot/core/album.py
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Message
+
+from ai_lu_bot.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingAlbum:
+    """Части одного альбома, собранные на текущий момент."""
+    __slots__ = ("messages", "updated")
+
+    def __init__(self, first: Message):
+        self.messages: List[Message] = [first]
+        self.updated = asyncio.Event()
+
+
+class AlbumAggregator:
+    """
+    Собирает альбом (сообщения с общим media_group_id), который Telegram присылает отдельными обновлениями.
+
+    Первый обработчик части альбома становится ведущим: ждёт, пока части перестанут приходить
+    (window секунд тишины, но не дольше max_wait), и получает весь альбом целиком.
+    Обработчики остальных частей получают None и дальше ничего не делают.
+    Имеет смысл только при параллельной обработке обновлений: при последовательной
+    ведущий просто дождётся окна и получит альбом из одной части.
+    """
+    def __init__(self, window: float = 0.8, max_wait: float = 3.0, max_parts: int = 10):
+        """
+        Args:
+            window: Сколько секунд ждать следующую часть альбома.
+            max_wait: Максимальное общее время сбора альбома (секунды).
+            max_parts: Максимум частей (в альбоме Telegram не больше 10).
+        """
+        self._window = window
+        self._max_wait = max_wait
+        self._max_parts = max_parts
+        self._albums: Dict[Tuple[int, str], _PendingAlbum] = {}
+
+    async def collect(self, chat_id: int, message: Message) -> Optional[List[Message]]:
+        """
+        Регистрирует часть альбома. Ведущему возвращает все собранные части в порядке message_id,
+        остальным — None.
+        """
+        key = (chat_id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.messages.append(message)
+            album.updated.set()
+            logger.debug("Album %s in chat %d: part %d joined (%d parts so far).", key[1], chat_id, message.message_id, len(album.messages))
+            return None
+
+        album = self._albums[key] = _PendingAlbum(message)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._max_wait
+        try:
+            while len(album.messages) < self._max_parts:
+                album.updated.clear()
+                timeout = min(self._window, deadline - loop.time())
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(album.updated.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break # Части перестали приходить
+        finally:
+            del self._albums[key]
+
+        metrics.inc("albums_collected")
+        metrics.inc("album_parts_collected", len(album.messages))
+        logger.info("Album %s in chat %d collected: %d parts.", key[1], chat_id, len(album.messages))
+        return sorted(album.messages, key=lambda m: m.message_id)
+
+    def pending(self) -> int:
+        """Сколько альбомов собирается прямо сейчас (для метрик)."""
+        return len(self._albums)
@@ -0,0 +1,141 @@
+# ai_lu_bot/core/codec.py
+import json
+import logging
+import struct
+from typing import Any, Dict, Mapping, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+# --- Запись контекста ---
+class ContextEntry:
+    """
+    Лёгкая запись истории переписки (__slots__ вместо словаря).
+    Поддерживает доступ как к словарю (entry.get("text"), entry["user"]),
+    поэтому код, написанный для записей-словарей, работает без изменений.
+    """
+    __slots__ = ("user", "text", "from_bot", "message_id")
+
+    def __init__(self, user: str = "Неизвестный", text: str = "", from_bot: bool = False, message_id: Optional[int] = None):
+        self.user = user
+        self.text = text
+        self.from_bot = from_bot
+        self.message_id = message_id
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> "ContextEntry":
+        return cls(
+            user=data.get("user") or "Неизвестный",
+            text=data.get("text") or "",
+            from_bot=bool(data.get("from_bot", False)),
+            message_id=data.get("message_id"),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"user": self.user, "text": self.text, "from_bot": self.from_bot, "message_id": self.message_id}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in ContextEntry.__slots__:
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key: str) -> Any:
+        if key in ContextEntry.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, ContextEntry):
+            return self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"ContextEntry({self.to_dict()!r})"
+
+
+EntryLike = Union[ContextEntry, Mapping[str, Any]]
+
+
+def as_entry(entry: EntryLike) -> ContextEntry:
+    """Приводит запись (словарь или ContextEntry) к ContextEntry."""
+    return entry if isinstance(entry, ContextEntry) else ContextEntry.from_dict(entry)
+
+
+# --- Кодеки ---
+class JsonEntryCodec:
+    """Исходный формат: JSON-объект с ключами user/text/from_bot/message_id."""
+    name = "json"
+
+    def encode(self, entry: EntryLike) -> bytes:
+        return json.dumps(as_entry(entry).to_dict()).encode("utf-8")
+
+    def decode(self, data: bytes) -> ContextEntry:
+        return ContextEntry.from_dict(json.loads(data))
+
+
+class BinaryEntryCodec:
+    """
+    Компактный двоичный формат (версия 1):
+    заголовок <тег 0xC1><флаги><message_id int64><длина user uint16>, затем user и text в UTF-8.
+    Длина текста не хранится — текст занимает остаток записи.
+    """
+    name = "binary"
+    TAG = 0xC1 # Не может быть первым байтом JSON-записи ('{'), поэтому форматы не путаются
+    _HEADER = struct.Struct("<BBqH")
+    _FLAG_FROM_BOT = 0x01
+    _FLAG_HAS_MESSAGE_ID = 0x02
+
+    def encode(self, entry: EntryLike) -> bytes:
+        entry = as_entry(entry)
+        # 16383 символа * 4 байта UTF-8 гарантированно помещаются в uint16 без разрыва символа
+        user = entry.user[:0x3FFF].encode("utf-8")
+        flags = 0
+        if entry.from_bot:
+            flags |= self._FLAG_FROM_BOT
+        if entry.message_id is not None:
+            flags |= self._FLAG_HAS_MESSAGE_ID
+        header = self._HEADER.pack(self.TAG, flags, entry.message_id or 0, len(user))
+        return b"".join((header, user, entry.text.encode("utf-8")))
+
+    def decode(self, data: bytes) -> ContextEntry:
+        tag, flags, message_id, user_len = self._HEADER.unpack_from(data)
+        if tag != self.TAG:
+            raise ValueError(f"Unexpected binary entry tag: {tag:#x}")
+        view = memoryview(data)
+        offset = self._HEADER.size
+        user = str(view[offset:offset + user_len], "utf-8")
+        text = str(view[offset + user_len:], "utf-8")
+        return ContextEntry(
+            user=user,
+            text=text,
+            from_bot=bool(flags & self._FLAG_FROM_BOT),
+            message_id=message_id if flags & self._FLAG_HAS_MESSAGE_ID else None,
+        )
+
+
+_CODECS = {codec.name: codec for codec in (JsonEntryCodec(), BinaryEntryCodec())}
+
+
+def get_codec(name: str) -> Union[JsonEntryCodec, BinaryEntryCodec]:
+    """Возвращает кодек для записи по имени ('binary' или 'json')."""
+    try:
+        return _CODECS[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown context entry codec: {name}. Use one of: {', '.join(_CODECS)}")
+
+
+def decode_entry(data: Optional[bytes]) -> Optional[ContextEntry]:
+    """
+    Декодирует запись в любом поддерживаемом формате, определяя его по первому байту.
+    Старые JSON-записи читаются прозрачно. При ошибке возвращает None.
+    """
+    if not data:
+        return None
+    try:
+        if data[0] == BinaryEntryCodec.TAG:
+            return _CODECS["binary"].decode(data)
+        return _CODECS["json"].decode(data)
+    except (ValueError, struct.error, TypeError, AttributeError) as e:
+        # json.JSONDecodeError и UnicodeDecodeError — подклассы ValueError
+        logger.error(f"Failed to decode context entry {data[:64]!r}: {e}")
+        return None
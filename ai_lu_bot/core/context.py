@@ -1,67 +1,242 @@
 # ai_lu_bot/core/context.py
 import logging
-import json
-from typing import Any, Dict, List, Optional
-import redis # Импортируем библиотеку redis
+import asyncio
+import sys
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+import redis.asyncio as aioredis # Асинхронный клиент Redis, не блокирует event loop
+
+from ai_lu_bot.core.codec import BinaryEntryCodec, ContextEntry, EntryLike, JsonEntryCodec, as_entry, decode_entry
 
 logger = logging.getLogger(__name__)
 
 # --- Константа для максимального количества сообщений в контексте ---
-MAX_CONTEXT_MESSAGES = 30 # Теперь используется обеими реализациями менеджера
-
-# --- Вспомогательные функции для сериализации/десериализации ---
-def _serialize_entry(entry: Dict[str, Any]) -> str:
-    """Сериализует запись контекста (словарь) в JSON строку."""
-    # В будущем можно добавить обработку нестандартных типов, если они появятся
-    return json.dumps(entry)
-
-def _deserialize_data(data: Optional[bytes]) -> Optional[Dict[str, Any]]:
-    """Десериализует JSON строку (bytes) в запись контекста (словарь)."""
-    if data is None:
-        return None
-    try:
-        return json.loads(data)
-    except json.JSONDecodeError:
-        logger.error(f"Failed to deserialize JSON data: {data!r}")
-        return None # Возвращаем None или пустой словарь при ошибке
-
-
-# --- Реализация менеджера контекста в памяти (старый) ---
+# Сколько записей хранится на чат. В промпт из них попадает столько, сколько влезает в бюджет токенов
+# (см. prompt_builder.DEFAULT_HISTORY_TOKEN_BUDGET), поэтому запас рассчитан на короткие реплики
+MAX_CONTEXT_MESSAGES = 100 # Теперь используется обеими реализациями менеджера
+
+# --- Оценка размера записи в памяти ---
+# Фиксированная добавка на объект ContextEntry, message_id и ссылку в кольцевом буфере (оценка для CPython)
+_ENTRY_OVERHEAD_BYTES = 120
+
+def _approx_entry_size(entry: ContextEntry) -> int:
+    """Приблизительный размер записи контекста в памяти (байты)."""
+    return _ENTRY_OVERHEAD_BYTES + sys.getsizeof(entry.text) + sys.getsizeof(entry.user)
+
+
+class _ChatWindow:
+    """Кольцевой буфер последних сообщений одного чата, его краткое содержание и учётные данные."""
+    __slots__ = ("entries", "evicted", "summary", "size_bytes", "last_access")
+
+    def __init__(self, max_messages: int):
+        # deque с maxlen сам вытесняет самый старый элемент за O(1)
+        self.entries: Deque[ContextEntry] = deque(maxlen=max_messages)
+        # Вытесненные из окна записи, ещё не вошедшие в краткое содержание (только при max_evicted > 0)
+        self.evicted: Deque[ContextEntry] = deque()
+        self.summary: Optional[str] = None
+        self.size_bytes = 0
+        self.last_access = time.monotonic()
+
+
+# --- Реализация менеджера контекста в памяти ---
 class InMemoryChatContextManager:
     """
     Хранит историю переписки в памяти (до max_messages на чат).
     История теряется при перезапуске приложения.
+
+    Потребление памяти ограничено: окно каждого чата — кольцевой буфер фиксированного размера,
+    общее число чатов и приблизительный объём ограничены (вытесняются давно неактивные чаты, LRU),
+    а чаты без активности дольше idle_ttl удаляются.
     """
-    def __init__(self, max_messages: int = MAX_CONTEXT_MESSAGES):
+    def __init__(
+        self,
+        max_messages: int = MAX_CONTEXT_MESSAGES,
+        max_chats: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+        idle_ttl: float = 7 * 24 * 3600,
+        max_evicted: int = 0,
+    ):
         """
         Инициализирует in-memory менеджер контекста.
+
+        Args:
+            max_messages: Максимальное количество сообщений на чат.
+            max_chats: Максимальное количество чатов в памяти.
+            max_bytes: Приблизительный лимит памяти под все окна контекста (байты).
+            idle_ttl: Через сколько секунд без активности окно чата удаляется (0 — не удалять).
+            max_evicted: Сколько вытесненных из окна записей хранить до сжатия в краткое содержание
+                         (0 — вытесненные записи сразу теряются).
         """
-        self._storage: Dict[int, List[Dict[str, Any]]] = {}
+        # OrderedDict упорядочен по времени последнего обращения: в начале — самые давние чаты
+        self._storage: "OrderedDict[int, _ChatWindow]" = OrderedDict()
         self._max = max_messages
-        logger.info(f"InMemoryChatContextManager initialized with max_messages = {self._max}")
+        self._max_chats = max_chats
+        self._max_bytes = max_bytes
+        self._idle_ttl = idle_ttl
+        self._max_evicted = max_evicted
+        self._total_bytes = 0
+        self._evicted_lru = 0
+        self._evicted_ttl = 0
+        logger.info(
+            f"InMemoryChatContextManager initialized with max_messages = {self._max}, "
+            f"max_chats = {self._max_chats}, max_bytes = {self._max_bytes}, idle_ttl = {self._idle_ttl}s"
+        )
+
+    def _touch(self, chat_id: int, create: bool) -> Optional[_ChatWindow]:
+        """Возвращает окно чата, помечая его как недавно использованное."""
+        self._expire_idle()
+        window = self._storage.get(chat_id)
+        if window is None:
+            if not create:
+                return None
+            window = _ChatWindow(self._max)
+            self._storage[chat_id] = window
+        else:
+            self._storage.move_to_end(chat_id)
+        window.last_access = time.monotonic()
+        return window
+
+    def _account(self, window: _ChatWindow, delta: int) -> None:
+        window.size_bytes += delta
+        self._total_bytes += delta
+
+    def _drop(self, chat_id: int) -> None:
+        window = self._storage.pop(chat_id)
+        self._total_bytes -= window.size_bytes
+
+    def _expire_idle(self) -> None:
+        """Удаляет чаты, неактивные дольше idle_ttl. Проверяются только самые давние (начало OrderedDict)."""
+        if self._idle_ttl <= 0:
+            return
+        deadline = time.monotonic() - self._idle_ttl
+        while self._storage:
+            chat_id, window = next(iter(self._storage.items()))
+            if window.last_access >= deadline:
+                break
+            self._drop(chat_id)
+            self._evicted_ttl += 1
+
+    def _enforce_limits(self, keep_chat_id: int) -> None:
+        """Вытесняет наименее недавно использованные чаты, пока не уложимся в лимиты."""
+        while len(self._storage) > 1 and (
+            len(self._storage) > self._max_chats or self._total_bytes > self._max_bytes
+        ):
+            chat_id = next(iter(self._storage))
+            if chat_id == keep_chat_id: # Текущий чат всегда самый свежий, но на всякий случай
+                break
+            self._drop(chat_id)
+            self._evicted_lru += 1
+            logger.debug(f"InMemory: Evicted context of chat {chat_id} (LRU).")
+
+    async def add(self, chat_id: int, entry: EntryLike) -> None:
+        # Записи хранятся как ContextEntry (__slots__) — заметно компактнее словарей
+        entry = as_entry(entry)
+        window = self._touch(chat_id, create=True)
+        entry_size = _approx_entry_size(entry)
+        if len(window.entries) == self._max:
+            # Самая старая запись будет вытеснена кольцевым буфером: она либо ждёт сжатия, либо теряется
+            if self._max_evicted > 0:
+                window.evicted.append(window.entries[0])
+                if len(window.evicted) > self._max_evicted:
+                    self._account(window, -_approx_entry_size(window.evicted.popleft()))
+            else:
+                self._account(window, -_approx_entry_size(window.entries[0]))
+        window.entries.append(entry)
+        window.size_bytes += entry_size
+        self._total_bytes += entry_size
+        self._enforce_limits(chat_id)
+
 
-    def add(self, chat_id: int, entry: Dict[str, Any]) -> None:
-        lst = self._storage.setdefault(chat_id, [])
-        lst.append(entry)
-        if len(lst) > self._max:
-            lst.pop(0)
-        # logger.debug(f"InMemory: Added entry to context for chat {chat_id}. Size: {len(lst)}")
+    async def add_and_get(self, chat_id: int, entry: EntryLike, return_window: bool = True) -> List[ContextEntry]:
+        """
+        Добавляет запись и (опционально) возвращает текущее окно контекста.
+        Интерфейс совпадает с RedisChatContextManager.add_and_get.
+        """
+        await self.add(chat_id, entry)
+        if not return_window:
+            return []
+        window = self._storage.get(chat_id)
+        return list(window.entries) if window else []
 
 
-    def get(self, chat_id: int) -> List[Dict[str, Any]]:
-        """Возвращает историю контекста из памяти."""
-        # logger.debug(f"InMemory: Retrieving context for chat {chat_id}. Size: {len(self._storage.get(chat_id, []))}")
-        return self._storage.get(chat_id, [])
+    async def get(self, chat_id: int) -> List[ContextEntry]:
+        """Возвращает копию истории контекста из памяти."""
+        window = self._touch(chat_id, create=False)
+        return list(window.entries) if window else []
 
 
-    def remove_last(self, chat_id: int) -> None:
+    async def remove_last(self, chat_id: int) -> None:
         """Удаляет последнюю запись из истории в памяти."""
-        lst = self._storage.get(chat_id, [])
-        if lst:
-            lst.pop()
-            # logger.debug(f"InMemory: Removed last entry from context for chat {chat_id}.")
-        # else:
-             # logger.debug(f"InMemory: Attempted to remove last entry from empty context for chat {chat_id}")
+        window = self._touch(chat_id, create=False)
+        if window and window.entries:
+            removed_size = _approx_entry_size(window.entries.pop())
+            window.size_bytes -= removed_size
+            self._total_bytes -= removed_size
+
+
+    async def get_evicted(self, chat_id: int) -> List[ContextEntry]:
+        """Вытесненные из окна записи, ещё не вошедшие в краткое содержание (старые первыми)."""
+        window = self._storage.get(chat_id)
+        return list(window.evicted) if window else []
+
+
+    async def get_summary(self, chat_id: int) -> Optional[str]:
+        """Краткое содержание ранней переписки чата или None."""
+        window = self._storage.get(chat_id)
+        return window.summary if window else None
+
+
+    async def set_summary(self, chat_id: int, summary: str, consumed: int) -> None:
+        """Сохраняет новое краткое содержание и удаляет consumed первых вытесненных записей, вошедших в него."""
+        window = self._storage.get(chat_id)
+        if window is None:
+            return
+        for _ in range(min(consumed, len(window.evicted))):
+            self._account(window, -_approx_entry_size(window.evicted.popleft()))
+        old_size = sys.getsizeof(window.summary) if window.summary is not None else 0
+        window.summary = summary
+        self._account(window, sys.getsizeof(summary) - old_size)
+
+
+    def stats(self) -> Dict[str, int]:
+        """Текущая заполненность хранилища (для логов и метрик)."""
+        return {
+            "chats": len(self._storage),
+            "entries": sum(len(window.entries) for window in self._storage.values()),
+            "approx_bytes": self._total_bytes,
+            "max_chats": self._max_chats,
+            "max_bytes": self._max_bytes,
+            "evicted_lru": self._evicted_lru,
+            "evicted_ttl": self._evicted_ttl,
+        }
+
+
+# --- Lua-скрипт: добавление + обрезка + чтение окна за один round trip ---
+# KEYS[1] - ключ списка контекста, KEYS[2] - ключ счётчика версии контекста,
+# KEYS[3] - ключ списка вытесненных записей, ожидающих сжатия в краткое содержание
+# ARGV[1] - максимальное количество сообщений, ARGV[2] - '1', если нужно вернуть окно,
+# ARGV[3] - сколько вытесненных записей хранить (0 — не хранить), ARGV[4..] - сериализованные записи для добавления
+# Возвращает {новая версия, окно или пустой список}. Версия увеличивается на число добавленных записей,
+# что позволяет локальным кэшам (TieredChatContextManager) заметить записи других инстансов.
+_APPEND_SCRIPT = """
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 4))
+local keep = tonumber(ARGV[1])
+local max_evicted = tonumber(ARGV[3])
+if max_evicted > 0 then
+    local overflow = redis.call('LLEN', KEYS[1]) - keep
+    if overflow > 0 then
+        redis.call('RPUSH', KEYS[3], unpack(redis.call('LRANGE', KEYS[1], 0, overflow - 1)))
+        redis.call('LTRIM', KEYS[3], -max_evicted, -1)
+    end
+end
+redis.call('LTRIM', KEYS[1], -keep, -1)
+local version = redis.call('INCRBY', KEYS[2], #ARGV - 3)
+if ARGV[2] == '1' then
+    return {version, redis.call('LRANGE', KEYS[1], 0, -1)}
+end
+return {version, {}}
+"""
 
 
 # --- Реализация менеджера контекста с использованием Redis ---
@@ -69,63 +244,199 @@ class RedisChatContextManager:
     """
     Хранит историю переписки в Redis List (до max_messages на чат).
     Сохраняет контекст между перезапусками бота.
+    Использует redis.asyncio: все операции awaitable и не блокируют event loop
+    python-telegram-bot на время сетевого round trip.
     """
-    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0, max_messages: int = MAX_CONTEXT_MESSAGES):
+    def __init__(
+        self,
+        host: str = 'localhost',
+        port: int = 6379,
+        db: int = 0,
+        max_messages: int = MAX_CONTEXT_MESSAGES,
+        max_connections: int = 20,
+        socket_timeout: float = 5.0,
+        connect_timeout: float = 5.0,
+        pool_timeout: float = 5.0,
+        codec: Union[BinaryEntryCodec, JsonEntryCodec, None] = None,
+        max_evicted: int = 0,
+    ):
         """
-        Инициализирует Redis менеджер контекста и устанавливает соединение.
+        Инициализирует Redis менеджер контекста. Само подключение проверяется в connect().
 
         Args:
             host, port, db: Параметры подключения к Redis.
             max_messages: Максимальное количество сообщений для хранения.
+            max_connections: Верхняя граница размера пула соединений.
+            socket_timeout: Таймаут операций чтения/записи сокета (секунды).
+            connect_timeout: Таймаут установки соединения (секунды).
+            pool_timeout: Сколько ждать свободного соединения из пула, если все заняты (секунды).
+            codec: Кодек для новых записей (по умолчанию компактный двоичный).
+                   Читаются записи в любом поддерживаемом формате, включая старые JSON.
+            max_evicted: Сколько вытесненных из окна записей хранить до сжатия в краткое содержание
+                         (0 — вытесненные записи сразу теряются).
         """
         self._max = max_messages
-        self._redis_client: Optional[redis.Redis] = None # Тип Optional, т.к. подключение может не удаться
+        self._max_evicted = max_evicted
+        self._codec = codec or BinaryEntryCodec()
+        self._address = f"redis://{host}:{port}/{db}"
+        # BlockingConnectionPool ограничивает число соединений: при исчерпании пула
+        # корутины ждут освобождения соединения (не дольше pool_timeout), а не открывают новые.
+        self._pool = aioredis.BlockingConnectionPool(
+            host=host,
+            port=port,
+            db=db,
+            max_connections=max_connections,
+            timeout=pool_timeout,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=connect_timeout,
+        )
+        # decode_responses=False (по умолчанию в пуле): записи хранятся как bytes
+        self._redis_client: Optional[aioredis.Redis] = aioredis.Redis(connection_pool=self._pool)
+        # Скрипт регистрируется один раз; вызывается через EVALSHA (при NOSCRIPT клиент сам его перезагрузит)
+        self._append_script = self._redis_client.register_script(_APPEND_SCRIPT)
+        logger.info(
+            f"RedisChatContextManager created for {self._address} with max_messages = {self._max}, "
+            f"max_connections = {max_connections}, socket_timeout = {socket_timeout}s, connect_timeout = {connect_timeout}s, "
+            f"codec = {self._codec.name}"
+        )
 
+    async def connect(self) -> bool:
+        """
+        Проверяет соединение с Redis (PING). Вызывается один раз при старте приложения (post_init).
+        При неудаче сбрасывает клиента и возвращает False.
+        """
+        if not self._redis_client:
+            return False
         try:
-            # Создаем клиента Redis. pool_connections=True используется по умолчанию для пула соединений.
-            self._redis_client = redis.Redis(host=host, port=port, db=db, decode_responses=False) # decode_responses=False, т.к. json.loads ожидает bytes/str
-            # Проверяем соединение (необязательно, но полезно при старте)
-            self._redis_client.ping()
-            logger.info(f"RedisChatContextManager initialized and connected to redis://{host}:{port}/{db} with max_messages = {self._max}")
-        except redis.exceptions.ConnectionError as e:
-            self._redis_client = None # Сбрасываем клиента, если подключение не удалось
-            logger.critical(f"RedisChatContextManager: Failed to connect to Redis at {host}:{port}/{db}: {e}")
-            # В этой реализации мы просто логируем ошибку и не можем использовать Redis.
-            # При вызове add/get/remove_last нужно будет это обработать.
+            await self._redis_client.ping()
+            # Загружаем скрипт в кэш скриптов Redis заранее, чтобы первый вызов не тратил лишний RTT
+            await self._redis_client.script_load(_APPEND_SCRIPT)
+            logger.info(f"RedisChatContextManager connected to {self._address}")
+            return True
+        except aioredis.ConnectionError as e:
+            logger.critical(f"RedisChatContextManager: Failed to connect to Redis at {self._address}: {e}")
         except Exception as e:
-            self._redis_client = None
             logger.critical(f"RedisChatContextManager: An unexpected error occurred during Redis initialization: {e}", exc_info=True)
+        # В этой реализации мы просто логируем ошибку и не можем использовать Redis.
+        # При вызове add/get/remove_last это обрабатывается.
+        await self.close()
+        return False
 
+    async def close(self) -> None:
+        """Закрывает клиента и все соединения пула."""
+        client, self._redis_client = self._redis_client, None
+        try:
+            if client is not None:
+                await client.aclose()
+            await self._pool.disconnect()
+        except Exception as e:
+            logger.warning(f"RedisChatContextManager: Error while closing Redis connections: {e}")
 
     def _redis_key(self, chat_id: int) -> str:
         """Генерирует ключ Redis для истории чата."""
         return f"context:{chat_id}"
 
-    def add(self, chat_id: int, entry: Dict[str, Any]) -> None:
+    def _version_key(self, chat_id: int) -> str:
+        """Генерирует ключ Redis для счётчика версии истории чата."""
+        return f"context_ver:{chat_id}"
+
+    def _evicted_key(self, chat_id: int) -> str:
+        """Генерирует ключ Redis для вытесненных записей, ожидающих сжатия."""
+        return f"context_evicted:{chat_id}"
+
+    def _summary_key(self, chat_id: int) -> str:
+        """Генерирует ключ Redis для краткого содержания ранней переписки чата."""
+        return f"context_summary:{chat_id}"
+
+    def _script_keys(self, chat_id: int) -> List[str]:
+        return [self._redis_key(chat_id), self._version_key(chat_id), self._evicted_key(chat_id)]
+
+    def _script_args(self, entries: List[EntryLike], return_window: bool) -> List[Any]:
+        # Кодируем записи в bytes для Redis выбранным кодеком
+        return [self._max, 1 if return_window else 0, self._max_evicted, *(self._codec.encode(entry) for entry in entries)]
+
+    def _decode_entries(self, raw_entries: List[Optional[bytes]]) -> List[ContextEntry]:
+        """Декодирует сырые элементы списка (любого формата), пропуская повреждённые записи."""
+        entries = [decode_entry(raw_entry) for raw_entry in raw_entries]
+        return [entry for entry in entries if entry is not None]
+
+    async def add(self, chat_id: int, entry: EntryLike) -> None:
         """
         Добавляет новую запись в историю контекста в Redis для указанного чата.
-        Использует Redis List (RPUSH и LTRIM).
+        RPUSH и LTRIM выполняются атомарно одним вызовом Lua-скрипта (один round trip).
+        """
+        await self.add_and_get(chat_id, entry, return_window=False)
+
+
+    async def add_and_get(self, chat_id: int, entry: EntryLike, return_window: bool = True) -> List[ContextEntry]:
+        """
+        Атомарно добавляет запись, обрезает список до max_messages и (опционально)
+        возвращает текущее окно контекста — всё за один round trip к Redis.
+
+        Returns:
+            Окно контекста после добавления (старые записи первыми) или пустой список,
+            если return_window=False либо произошла ошибка.
         """
         if not self._redis_client:
             logger.error(f"Redis not connected. Cannot add context for chat {chat_id}.")
-            return
+            return []
 
         key = self._redis_key(chat_id)
         try:
-            # Сериализуем запись в JSON строку
-            serialized_entry = _serialize_entry(entry).encode('utf-8') # Кодируем в bytes для Redis
-            # Добавляем в конец списка (RPUSH)
-            self._redis_client.rpush(key, serialized_entry)
-            # Обрезаем список, чтобы оставить только последние max_messages элементов
-            # LTRIM key start stop (0 - первый элемент, -1 - последний)
-            # LTRIM key -max -1 оставляет max последних элементов
-            self._redis_client.ltrim(key, -self._max, -1)
-            # logger.debug(f"Redis: Added entry to context for chat {chat_id}. Key: {key}. Current length (approx): {self._redis_client.llen(key)}")
+            _version, raw_entries = await self._append_script(
+                keys=self._script_keys(chat_id),
+                args=self._script_args([entry], return_window),
+            )
+            return self._decode_entries(raw_entries) if return_window else []
         except Exception as e:
             logger.error(f"Redis: Error adding context entry for chat {chat_id} (Key: {key}): {e}", exc_info=True)
+            return []
+
+
+    async def append_batch(self, batches: Dict[int, List[EntryLike]]) -> Dict[int, int]:
+        """
+        Добавляет накопленные записи сразу для нескольких чатов одним пайплайном (один round trip).
+        Используется для отложенной записи (write-behind) в TieredChatContextManager.
+
+        Returns:
+            Новые версии контекста по chat_id. При ошибке исключение пробрасывается вызывающему,
+            чтобы он мог повторить запись позже.
+        """
+        if not self._redis_client:
+            raise aioredis.ConnectionError("Redis not connected")
+        chat_ids = [chat_id for chat_id, entries in batches.items() if entries]
+        if not chat_ids:
+            return {}
+        async with self._redis_client.pipeline(transaction=False) as pipe:
+            for chat_id in chat_ids:
+                await self._append_script(
+                    keys=self._script_keys(chat_id),
+                    args=self._script_args(batches[chat_id], return_window=False),
+                    client=pipe,
+                )
+            results = await pipe.execute()
+        return {chat_id: int(result[0]) for chat_id, result in zip(chat_ids, results)}
+
+
+    async def get_version(self, chat_id: int) -> int:
+        """Возвращает текущую версию контекста чата (0, если записей ещё не было)."""
+        if not self._redis_client:
+            raise aioredis.ConnectionError("Redis not connected")
+        return int(await self._redis_client.get(self._version_key(chat_id)) or 0)
+
+
+    async def get_with_version(self, chat_id: int) -> Tuple[List[ContextEntry], int]:
+        """Атомарно читает окно контекста и его версию (MULTI/EXEC, один round trip)."""
+        if not self._redis_client:
+            raise aioredis.ConnectionError("Redis not connected")
+        async with self._redis_client.pipeline(transaction=True) as pipe:
+            pipe.lrange(self._redis_key(chat_id), -self._max, -1)
+            pipe.get(self._version_key(chat_id))
+            raw_entries, version = await pipe.execute()
+        return self._decode_entries(raw_entries), int(version or 0)
 
 
-    def get(self, chat_id: int) -> List[Dict[str, Any]]:
+    async def get(self, chat_id: int) -> List[ContextEntry]:
         """
         Возвращает текущую историю контекста из Redis для указанного чата.
         Возвращает последние MAX_CONTEXT_MESSAGES записей.
@@ -136,21 +447,16 @@ class RedisChatContextManager:
 
         key = self._redis_key(chat_id)
         try:
-            # Получаем последние max_messages элементов из списка (LRANGE key start stop)
-            # LRANGE key -max -1
-            raw_entries = self._redis_client.lrange(key, -self._max, -1)
-            # Десериализуем каждую запись
-            entries = [_deserialize_data(raw_entry) for raw_entry in raw_entries if raw_entry is not None]
-            # Фильтруем None, если десериализация не удалась для каких-то элементов
-            valid_entries = [entry for entry in entries if entry is not None]
-            # logger.debug(f"Redis: Retrieved context for chat {chat_id}. Key: {key}. Items: {len(valid_entries)}")
-            return valid_entries
+            # Получаем последние max_messages элементов из списка (LRANGE key -max -1)
+            raw_entries = await self._redis_client.lrange(key, -self._max, -1)
+            # Десериализуем каждую запись, пропуская те, что не удалось разобрать
+            return self._decode_entries(raw_entries)
         except Exception as e:
             logger.error(f"Redis: Error getting context entries for chat {chat_id} (Key: {key}): {e}", exc_info=True)
             return [] # Возвращаем пустой список при ошибке
 
 
-    def remove_last(self, chat_id: int) -> None:
+    async def remove_last(self, chat_id: int) -> None:
         """
         Удаляет самую последнюю добавленную запись из истории контекста в Redis.
         Использует Redis List (RPOP).
@@ -161,12 +467,296 @@ class RedisChatContextManager:
 
         key = self._redis_key(chat_id)
         try:
-            # Удаляем и получаем последний элемент списка (RPOP)
-            removed_data = self._redis_client.rpop(key)
-            # logger.debug(f"Redis: Removed last context entry for chat {chat_id}. Key: {key}. Data: {removed_data!r}")
-            # Примечание: RPOP возвращает None, если список пуст, что корректно обрабатывается Redis.
+            # Удаляем последний элемент списка (RPOP) и увеличиваем версию контекста.
+            # Для пустого списка Redis вернёт None.
+            async with self._redis_client.pipeline(transaction=True) as pipe:
+                pipe.rpop(key)
+                pipe.incr(self._version_key(chat_id))
+                await pipe.execute()
         except Exception as e:
             logger.error(f"Redis: Error removing last context entry for chat {chat_id} (Key: {key}): {e}", exc_info=True)
 
-# Удаляем глобальный инстанс менеджера контекста
-# chat_context_manager = ChatContextManager() # УДАЛИТЬ или закомментировать
+
+    async def get_evicted(self, chat_id: int) -> List[ContextEntry]:
+        """Вытесненные из окна записи, ещё не вошедшие в краткое содержание (старые первыми)."""
+        if not self._redis_client:
+            raise aioredis.ConnectionError("Redis not connected")
+        return self._decode_entries(await self._redis_client.lrange(self._evicted_key(chat_id), 0, -1))
+
+
+    async def get_summary(self, chat_id: int) -> Optional[str]:
+        """Краткое содержание ранней переписки чата или None."""
+        if not self._redis_client:
+            raise aioredis.ConnectionError("Redis not connected")
+        raw = await self._redis_client.get(self._summary_key(chat_id))
+        return raw.decode("utf-8") if raw is not None else None
+
+
+    async def set_summary(self, chat_id: int, summary: str, consumed: int) -> None:
+        """
+        Атомарно (MULTI/EXEC) сохраняет новое краткое содержание и удаляет consumed первых вытесненных записей,
+        вошедших в него. Записи, вытесненные за время сжатия, остаются в конце списка до следующего раза.
+        """
+        if not self._redis_client:
+            raise aioredis.ConnectionError("Redis not connected")
+        async with self._redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(self._summary_key(chat_id), summary.encode("utf-8"))
+            pipe.ltrim(self._evicted_key(chat_id), consumed, -1)
+            await pipe.execute()
+
+
+# --- Двухуровневый менеджер контекста: локальный кэш + Redis ---
+class _CachedWindow:
+    """Локальная копия окна контекста чата и версия Redis, которой она соответствует."""
+    __slots__ = ("entries", "version", "validated_at")
+
+    def __init__(self, entries: List[ContextEntry], version: int, max_messages: int):
+        self.entries: Deque[ContextEntry] = deque(entries, maxlen=max_messages)
+        self.version = version
+        self.validated_at = time.monotonic()
+
+
+class TieredChatContextManager:
+    """
+    Двухуровневое хранилище контекста: окна «горячих» чатов держатся в памяти процесса,
+    а Redis (RedisChatContextManager) остаётся источником истины и сохраняет контекст между перезапусками.
+
+    - get обслуживается из локального кэша без обращения к Redis;
+    - add пишет в локальный кэш сразу, а в Redis — отложенно (write-behind), пачками
+      через один пайплайн раз в flush_interval секунд;
+    - каждая запись в Redis увеличивает версию контекста чата. Если после сброса версия
+      не совпала с ожидаемой, значит в чат писал другой инстанс — локальная копия сбрасывается.
+      Кроме того, не реже раза в validate_interval секунд версия сверяется с Redis.
+    """
+    def __init__(
+        self,
+        remote: RedisChatContextManager,
+        max_messages: int = MAX_CONTEXT_MESSAGES,
+        max_chats: int = 2000,
+        flush_interval: float = 0.2,
+        validate_interval: float = 5.0,
+    ):
+        """
+        Args:
+            remote: Менеджер контекста Redis (нижний уровень).
+            max_messages: Максимальное количество сообщений на чат.
+            max_chats: Сколько окон чатов держать в локальном кэше (LRU).
+            flush_interval: Период отложенной записи в Redis (секунды).
+            validate_interval: Как долго локальное окно считается актуальным без сверки версии (секунды).
+        """
+        self._remote = remote
+        self._max = max_messages
+        self._max_chats = max_chats
+        self._flush_interval = flush_interval
+        self._validate_interval = validate_interval
+        self._local: "OrderedDict[int, _CachedWindow]" = OrderedDict()
+        # Записи, ещё не отправленные в Redis. Больше max_messages на чат хранить смысла нет.
+        self._pending: Dict[int, Deque[ContextEntry]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._flushes = 0
+        self._dropped = 0
+        logger.info(
+            f"TieredChatContextManager initialized with max_chats = {self._max_chats}, "
+            f"flush_interval = {self._flush_interval}s, validate_interval = {self._validate_interval}s"
+        )
+
+    async def connect(self) -> bool:
+        """Подключает Redis и запускает фоновую отложенную запись."""
+        if not await self._remote.connect():
+            return False
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop(), name="context-write-behind")
+        return True
+
+    async def close(self) -> None:
+        """Останавливает фоновую запись, сбрасывает оставшиеся записи в Redis и закрывает соединения."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self._flush()
+        await self._remote.close()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            if self._pending:
+                await self._flush()
+
+    async def _flush(self, chat_id: Optional[int] = None) -> None:
+        """
+        Отправляет накопленные записи в Redis (все или только указанного чата) и сверяет версии.
+        При ошибке записи возвращаются в очередь и будут отправлены при следующем сбросе.
+        """
+        async with self._flush_lock:
+            await self._flush_locked(chat_id)
+
+    async def _flush_locked(self, chat_id: Optional[int] = None) -> None:
+        """Тело _flush; вызывается только под self._flush_lock."""
+        if chat_id is None:
+            batches, self._pending = self._pending, {}
+        elif chat_id in self._pending:
+            batches = {chat_id: self._pending.pop(chat_id)}
+        else:
+            return
+        if not batches:
+            return
+        try:
+            versions = await self._remote.append_batch({cid: list(entries) for cid, entries in batches.items()})
+        except Exception as e:
+            logger.error(f"Tiered: Failed to flush context for {len(batches)} chat(s) to Redis, will retry: {e}")
+            for cid, entries in batches.items():
+                # Новые записи, пришедшие во время сброса, должны остаться после старых
+                newer = self._pending.get(cid, ())
+                self._count_dropped(cid, len(entries) + len(newer) - self._max)
+                entries.extend(newer)
+                self._pending[cid] = entries
+            return
+        self._flushes += 1
+        for cid, version in versions.items():
+            window = self._local.get(cid)
+            if window is None:
+                continue
+            if version == window.version + len(batches[cid]):
+                window.version = version
+                window.validated_at = time.monotonic()
+            else:
+                # В Redis писал кто-то ещё — локальная копия больше не соответствует источнику истины
+                self._invalidate(cid)
+
+    def _count_dropped(self, chat_id: int, dropped: int) -> None:
+        """Учитывает записи, вытесненные из переполненной очереди чата до того, как они попали в Redis."""
+        if dropped <= 0:
+            return
+        self._dropped += dropped
+        logger.warning(
+            f"Tiered: Dropped {dropped} unflushed context entries of chat {chat_id} "
+            f"(more than {self._max} waiting for Redis)."
+        )
+
+    def _invalidate(self, chat_id: int) -> None:
+        if self._local.pop(chat_id, None) is not None:
+            self._invalidations += 1
+            logger.debug(f"Tiered: Local context of chat {chat_id} invalidated (version mismatch).")
+
+    async def _load(self, chat_id: int) -> _CachedWindow:
+        """Загружает окно чата из Redis в локальный кэш (предварительно отправив его отложенные записи)."""
+        # Под блокировкой сброса: ни одна запись чата не окажется «в пути» между очередью и Redis во время чтения
+        async with self._flush_lock:
+            await self._flush_locked(chat_id)
+            entries, version = await self._remote.get_with_version(chat_id)
+            window = _CachedWindow(entries, version, self._max)
+            # Записи, добавленные во время чтения, ещё в очереди — в кэше они должны быть сразу
+            window.entries.extend(self._pending.get(chat_id, ()))
+        self._local[chat_id] = window
+        while len(self._local) > self._max_chats:
+            self._local.popitem(last=False)
+        return window
+
+    async def _window(self, chat_id: int) -> Optional[_CachedWindow]:
+        """Возвращает актуальное локальное окно чата, при необходимости сверяя версию или загружая его."""
+        window = self._local.get(chat_id)
+        if window is not None and time.monotonic() - window.validated_at > self._validate_interval:
+            # Под блокировкой сброса: пачка, уже ушедшая в Redis, но ещё не учтённая в window.version,
+            # иначе выглядела бы как чужая запись и вызывала бы лишнюю перезагрузку окна
+            async with self._flush_lock:
+                window = self._local.get(chat_id) # Окно могли сбросить, пока ждали блокировку
+                if chat_id in self._pending:
+                    # Сброс сам сверит версию (и сбросит окно при расхождении)
+                    await self._flush_locked(chat_id)
+                elif window is not None:
+                    if await self._remote.get_version(chat_id) == window.version:
+                        window.validated_at = time.monotonic()
+                    else:
+                        self._invalidate(chat_id)
+            window = self._local.get(chat_id)
+        if window is None:
+            self._misses += 1
+            return await self._load(chat_id)
+        self._hits += 1
+        self._local.move_to_end(chat_id)
+        return window
+
+    async def add(self, chat_id: int, entry: EntryLike) -> None:
+        """Добавляет запись в локальный кэш (если чат в нём есть) и в очередь отложенной записи в Redis."""
+        entry = as_entry(entry)
+        window = self._local.get(chat_id)
+        if window is not None:
+            window.entries.append(entry)
+        pending = self._pending.setdefault(chat_id, deque(maxlen=self._max))
+        # Окно в Redis всё равно обрезается до max_messages, но самая старая запись очереди так и не попадёт в архив вытесненных
+        self._count_dropped(chat_id, len(pending) + 1 - self._max)
+        pending.append(entry)
+
+    async def add_and_get(self, chat_id: int, entry: EntryLike, return_window: bool = True) -> List[ContextEntry]:
+        """
+        Добавляет запись и (опционально) возвращает текущее окно контекста.
+        Интерфейс совпадает с RedisChatContextManager.add_and_get.
+        """
+        await self.add(chat_id, entry)
+        if not return_window:
+            return []
+        return await self.get(chat_id)
+
+
+    async def get(self, chat_id: int) -> List[ContextEntry]:
+        """Возвращает окно контекста из локального кэша (при промахе — из Redis)."""
+        try:
+            window = await self._window(chat_id)
+        except Exception as e:
+            logger.error(f"Tiered: Error getting context entries for chat {chat_id}: {e}", exc_info=True)
+            return []
+        return list(window.entries)
+
+
+    async def remove_last(self, chat_id: int) -> None:
+        """Удаляет последнюю запись: из очереди отложенной записи, если она ещё не ушла в Redis, иначе — из Redis."""
+        # Под блокировкой сброса: пока пачка «в пути», последней записи нет ни в очереди, ни в Redis,
+        # а неудачный сброс вернёт её в очередь уже после удаления
+        async with self._flush_lock:
+            pending = self._pending.get(chat_id)
+            window = self._local.get(chat_id)
+            if pending:
+                pending.pop()
+                if not pending:
+                    del self._pending[chat_id]
+                if window is not None and window.entries:
+                    window.entries.pop()
+                return
+            await self._remote.remove_last(chat_id)
+        # Версия в Redis изменилась — проще перечитать окно при следующем обращении
+        self._local.pop(chat_id, None)
+
+
+    async def get_evicted(self, chat_id: int) -> List[ContextEntry]:
+        """Вытесненные записи хранит Redis: туда они попадают при отложенной записи."""
+        return await self._remote.get_evicted(chat_id)
+
+
+    async def get_summary(self, chat_id: int) -> Optional[str]:
+        return await self._remote.get_summary(chat_id)
+
+
+    async def set_summary(self, chat_id: int, summary: str, consumed: int) -> None:
+        await self._remote.set_summary(chat_id, summary, consumed)
+
+
+    def stats(self) -> Dict[str, int]:
+        """Статистика локального уровня (для логов и метрик)."""
+        return {
+            "local_chats": len(self._local),
+            "pending_chats": len(self._pending),
+            "pending_entries": sum(len(entries) for entries in self._pending.values()),
+            "hits": self._hits,
+            "misses": self._misses,
+            "invalidations": self._invalidations,
+            "flushes": self._flushes,
+            "dropped": self._dropped,
+        }
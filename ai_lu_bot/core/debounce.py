@@ -0,0 +1,121 @@
+# ai_lu_bot/core/debounce.py
+import asyncio
+import logging
+from typing import Awaitable, Dict, Optional, TypeVar
+
+from ai_lu_bot.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class BurstSuperseded(Exception):
+    """Генерация ответа отменена: в чат пришло более новое сообщение того же всплеска."""
+
+
+class _Burst:
+    """Серия сообщений чата, на которую будет дан один ответ."""
+    __slots__ = ("started", "last_arrival", "seq", "generation")
+
+    def __init__(self, now: float):
+        self.started = now
+        self.last_arrival = now
+        self.seq = 0
+        self.generation: Optional[asyncio.Future] = None
+
+
+class ChatDebouncer:
+    """
+    Склеивает серию быстрых сообщений чата (например, 3-4 коротких сообщения подряд в личке) в один ответ.
+
+    Каждое сообщение регистрируется через arrive() и попадает в контекст как обычно, но отвечает
+    только последнее: оно ждёт quiet_window секунд тишины (не дольше max_wait от начала серии).
+    Более раннее сообщение, дождавшись своей очереди, видит, что его обогнали, и ответа не даёт.
+    Если генерация ответа уже идёт, новое сообщение серии её отменяет — ответ всё равно устарел.
+    """
+    def __init__(self, quiet_window: float = 1.5, max_wait: float = 6.0):
+        """
+        Args:
+            quiet_window: Сколько секунд тишины после сообщения считать концом серии.
+            max_wait: Максимальная задержка ответа от первого сообщения серии (секунды).
+        """
+        self._quiet_window = quiet_window
+        self._max_wait = max_wait
+        self._bursts: Dict[int, _Burst] = {}
+
+    def arrive(self, chat_id: int) -> int:
+        """Регистрирует новое сообщение чата. Возвращает его номер в серии (он же размер серии)."""
+        now = asyncio.get_running_loop().time()
+        burst = self._bursts.get(chat_id)
+        if burst is None:
+            burst = self._bursts[chat_id] = _Burst(now)
+        burst.seq += 1
+        burst.last_arrival = now
+        if burst.generation is not None and not burst.generation.done():
+            burst.generation.cancel()
+            metrics.inc("dm_burst_generations_cancelled")
+            logger.info("Chat %d: new message in burst, cancelling obsolete generation.", chat_id)
+        burst.generation = None
+        return burst.seq
+
+    async def wait_quiet(self, chat_id: int, seq: int) -> Optional[int]:
+        """
+        Ждёт конца серии. Возвращает число сообщений серии, если ответить должно сообщение seq,
+        или None, если его обогнало более новое сообщение.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            burst = self._bursts.get(chat_id)
+            if burst is None or burst.seq != seq:
+                metrics.inc("dm_burst_messages_coalesced")
+                return None
+            delay = min(burst.last_arrival + self._quiet_window, burst.started + self._max_wait) - loop.time()
+            if delay <= 0:
+                return burst.seq
+            await asyncio.sleep(delay)
+
+    async def run(self, chat_id: int, seq: int, coro: Awaitable[T]) -> T:
+        """
+        Выполняет генерацию ответа так, чтобы новое сообщение серии могло её отменить.
+        Бросает BurstSuperseded, если генерацию отменили из-за нового сообщения.
+        """
+        task = asyncio.ensure_future(coro)
+        burst = self._bursts.get(chat_id)
+        if burst is None or burst.seq != seq:
+            task.cancel()
+            raise BurstSuperseded()
+        burst.generation = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            current = self._bursts.get(chat_id)
+            if current is not None and current.seq != seq:
+                raise BurstSuperseded()
+            raise # Отменили сам обработчик
+        finally:
+            if burst.generation is task:
+                burst.generation = None
+
+    def commit(self, chat_id: int, seq: int) -> bool:
+        """
+        Вызывается перед отправкой ответа: False, если серию продолжило более новое сообщение.
+        Иначе серия закрывается, и следующее сообщение чата начнёт новую.
+        """
+        burst = self._bursts.get(chat_id)
+        if burst is None or burst.seq != seq:
+            return False
+        del self._bursts[chat_id]
+        if seq > 1:
+            metrics.inc("dm_bursts_answered")
+        return True
+
+    def release(self, chat_id: int, seq: int) -> None:
+        """Закрывает серию, если обработчик последнего сообщения завершился, не дойдя до commit()."""
+        burst = self._bursts.get(chat_id)
+        if burst is not None and burst.seq == seq:
+            del self._bursts[chat_id]
+
+    def pending(self) -> int:
+        """Сколько чатов сейчас в ожидании конца серии (для метрик)."""
+        return len(self._bursts)
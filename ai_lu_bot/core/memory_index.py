@@ -0,0 +1,428 @@
+# ai_lu_bot/core/memory_index.py
+"""
+Долгая память чата: архив всех сообщений (только добавление) и инкрементальный обратный индекс
+с ранжированием BM25 по токенам русского текста. Всё считается локально, без внешних сервисов эмбеддингов.
+Индекс хранится в памяти процесса (InMemoryMemoryIndex) или в Redis (RedisMemoryIndex).
+"""
+import asyncio
+import heapq
+import json
+import logging
+import math
+import re
+import struct
+import sys
+import time
+from array import array
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import redis.asyncio as aioredis
+
+from ai_lu_bot.core.codec import EntryLike
+from ai_lu_bot.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Параметры BM25
+_K1 = 1.2
+_B = 0.75
+# Термины, встречающиеся больше чем в этой доле документов, почти ничего не добавляют к ранжированию (idf < 3),
+# а их списки самые длинные и занимают почти всё время поиска — при поиске они пропускаются
+_MAX_DF_RATIO = 0.05
+# ...но только в больших архивах: короткие списки просматриваются быстро, а в маленьком чате любой термин редок
+_MIN_SKIPPED_DF = 1000
+# Не больше стольких разных терминов запроса (самые длинные сообщения не должны превращаться в дорогой поиск)
+_MAX_QUERY_TERMS = 16
+# Предел просмотренных вхождений на один поиск. Подсчёт идёт синхронно, и таймаут recall() прервать его не может,
+# поэтому работа ограничена заранее: термины просматриваются от самых редких (самых весомых), пока хватает бюджета
+_MAX_SCANNED_POSTINGS = 20000
+
+# --- Оценка размера индекса в памяти (для CPython) ---
+# Кортеж полей документа, ссылка в архиве, длина документа и message_id
+_DOC_OVERHEAD_BYTES = 130
+# Ключ словаря, кортеж из двух array и их заголовки
+_TERM_OVERHEAD_BYTES = 260
+# Одно вхождение: номер документа (I) и частота (H) с запасом на рост array
+_POSTING_BYTES = 7
+
+
+# --- Токенизация ---
+_WORD_RE = re.compile(r"[^\W\d_]{2,}|\d{2,}")
+_STOPWORDS = frozenset("""
+и в во не что он на я с со как а то все всё она так его но да ты к у же вы за бы по только ее её мне было вот от
+меня еще ещё нет о об из ему теперь когда даже ну ли если уже или ни быть был него до вас нибудь опять уж вам ведь
+там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже
+себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее сейчас
+были куда зачем всех никогда можно при наконец два хоть после над больше тот через эти нас про всего них какая
+много разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно
+всю между вообще просто очень
+the a an and or of to in is it that this for on with you
+""".split())
+# Частые окончания русских слов; отрезается одно, самое длинное подходящее (грубый стеммер без словарей)
+_ENDINGS = tuple(sorted("""
+ями ами ого его ому ему ыми ими ость ости ах ях ов ев ей ий ый ой ая яя ое ее ые ие ом ем ам ям ую юю ть ла ло ли
+ет ит ут ют ат ят ешь ишь а я о е ы и у ю ь й
+""".split(), key=len, reverse=True))
+_MIN_STEM = 3
+
+
+@lru_cache(maxsize=16384)
+def _stem(word: str) -> str:
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Термины текста для индекса: слова в нижнем регистре без стоп-слов, с отрезанными окончаниями."""
+    return [
+        _stem(word)
+        for word in _WORD_RE.findall(text.lower().replace("ё", "е"))
+        if word not in _STOPWORDS
+    ]
+
+
+def _idf(n_docs: int, df: int) -> float:
+    return math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+
+def _length_norm(avg_len: float) -> Tuple[float, float]:
+    """Множители знаменателя BM25: tf + K1 * (1 - B + B * len / avg) = tf + a + b * len (вычисляются раз на запрос)."""
+    return _K1 * (1 - _B), _K1 * _B / avg_len
+
+
+def _within_budget(dfs: Iterable[int]) -> int:
+    """
+    Сколько терминов (уже упорядоченных по возрастанию df) помещается в _MAX_SCANNED_POSTINGS.
+    Отброшенные термины самые частые, то есть наименее весомые; об отсечении пишется метрика.
+    """
+    budget = _MAX_SCANNED_POSTINGS
+    count = 0
+    for df in dfs:
+        if df > budget:
+            metrics.inc("memory_search_truncated")
+            break
+        budget -= df
+        count += 1
+    return count
+
+
+class MemoryHit(NamedTuple):
+    """Найденное сообщение архива."""
+    message_id: Optional[int]
+    user: str
+    text: str
+    from_bot: bool
+    score: float
+
+
+def _entry_fields(entry: EntryLike) -> Tuple[Optional[int], str, str, bool]:
+    return (
+        entry.get("message_id"),
+        entry.get("user") or "Неизвестный",
+        entry.get("text") or "",
+        bool(entry.get("from_bot", False)),
+    )
+
+
+# --- Индекс в памяти процесса ---
+class _ChatIndex:
+    """Архив и обратный индекс одного чата: номер документа — позиция в архиве."""
+    __slots__ = ("docs", "lengths", "postings", "total_len", "size_bytes")
+
+    def __init__(self):
+        self.docs: List[Tuple[Optional[int], str, str, bool]] = []
+        self.lengths = array("I")
+        # термин -> (номера документов, частоты термина); списки растут только добавлением
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.total_len = 0
+        self.size_bytes = 0 # Приблизительный размер архива и индекса в памяти
+
+    def add(self, fields: Tuple[Optional[int], str, str, bool], terms: List[str]) -> int:
+        """Добавляет документ; возвращает, на сколько байт (приблизительно) вырос индекс."""
+        doc_id = len(self.docs)
+        self.docs.append(fields)
+        self.lengths.append(len(terms))
+        self.total_len += len(terms)
+        counts = Counter(terms)
+        added = _DOC_OVERHEAD_BYTES + sys.getsizeof(fields[2]) + _POSTING_BYTES * len(counts)
+        for term, tf in counts.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = (array("I"), array("H"))
+                added += _TERM_OVERHEAD_BYTES + sys.getsizeof(term)
+            posting[0].append(doc_id)
+            posting[1].append(min(tf, 0xFFFF))
+        self.size_bytes += added
+        return added
+
+    def search(self, terms: Iterable[str], limit: int, skip_recent: int) -> List[Tuple[float, int]]:
+        n_docs = len(self.docs)
+        if not n_docs:
+            return []
+        norm_a, norm_b = _length_norm(max(self.total_len / n_docs, 1.0))
+        first_recent = n_docs - skip_recent
+        max_df = max(n_docs * _MAX_DF_RATIO, _MIN_SKIPPED_DF)
+        lengths = self.lengths
+        postings = sorted(
+            (posting for posting in map(self.postings.get, terms) if posting is not None and len(posting[0]) <= max_df),
+            key=lambda posting: len(posting[0]),
+        )
+        del postings[_within_budget(len(posting[0]) for posting in postings):]
+        scores: Dict[int, float] = {}
+        for posting in postings:
+            weight = _idf(n_docs, len(posting[0])) * (_K1 + 1)
+            for doc_id, tf in zip(*posting):
+                if doc_id >= first_recent:
+                    break
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf / (tf + norm_a + norm_b * lengths[doc_id])
+        return heapq.nlargest(limit, ((score, doc_id) for doc_id, score in scores.items()))
+
+
+class InMemoryMemoryIndex:
+    """
+    Долгая память в памяти процесса (теряется при перезапуске). Число чатов и общий размер индекса ограничены
+    (вытесняются давно не пополнявшиеся чаты), а архив чата сверх max_docs_per_chat или больше всего лимита
+    сокращается вдвое — индекс перестраивается по оставшейся половине.
+    """
+    def __init__(self, max_chats: int = 1000, max_docs_per_chat: int = 20000, max_bytes: int = 64 * 1024 * 1024):
+        """
+        Args:
+            max_chats: Сколько чатов держать в индексе (LRU).
+            max_docs_per_chat: Сколько сообщений одного чата держать в индексе.
+            max_bytes: Приблизительный лимит памяти под индексы всех чатов (байты).
+        """
+        self._chats: "OrderedDict[int, _ChatIndex]" = OrderedDict()
+        self._max_chats = max_chats
+        self._max_docs = max_docs_per_chat
+        self._max_bytes = max_bytes
+        self._total_bytes = 0
+        self._evicted = 0
+
+    def _rebuild(self, chat_id: int, kept: Sequence[Tuple[Optional[int], str, str, bool]]) -> None:
+        old = self._chats[chat_id]
+        index = self._chats[chat_id] = _ChatIndex()
+        for fields in kept:
+            index.add(fields, tokenize(fields[2]))
+        self._total_bytes += index.size_bytes - old.size_bytes
+
+    async def add_many(self, chat_id: int, entries: Sequence[EntryLike]) -> None:
+        index = self._chats.get(chat_id)
+        if index is None:
+            index = self._chats[chat_id] = _ChatIndex()
+        else:
+            self._chats.move_to_end(chat_id)
+        for entry in entries:
+            fields = _entry_fields(entry)
+            self._total_bytes += index.add(fields, tokenize(fields[2]))
+        if len(index.docs) > self._max_docs or index.size_bytes > self._max_bytes:
+            self._rebuild(chat_id, index.docs[len(index.docs) // 2:])
+        # Пополненный чат — последний в OrderedDict, вытесняются самые давние
+        while len(self._chats) > 1 and (len(self._chats) > self._max_chats or self._total_bytes > self._max_bytes):
+            _evicted_id, evicted = self._chats.popitem(last=False)
+            self._total_bytes -= evicted.size_bytes
+            self._evicted += 1
+
+    async def search(self, chat_id: int, terms: Sequence[str], limit: int, skip_recent: int = 0) -> List[MemoryHit]:
+        index = self._chats.get(chat_id)
+        if index is None:
+            return []
+        return [MemoryHit(*index.docs[doc_id], score) for score, doc_id in index.search(terms, limit, skip_recent)]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chats": len(self._chats),
+            "docs": sum(len(index.docs) for index in self._chats.values()),
+            "terms": sum(len(index.postings) for index in self._chats.values()),
+            "bytes": self._total_bytes,
+            "evicted_chats": self._evicted,
+        }
+
+    async def close(self) -> None:
+        pass
+
+
+# --- Индекс в Redis ---
+# Элемент списка термина: номер документа, частота термина, длина документа (для BM25 без чтения документов)
+_POSTING = struct.Struct("<IHH")
+
+# KEYS[1] - архив чата (список документов), KEYS[2] - счётчики чата (hash: n, total_len), KEYS[3..] - списки терминов
+# ARGV[1] - документ (JSON), ARGV[2] - длина документа в терминах, ARGV[3..] - частоты терминов (в порядке KEYS[3..])
+_ADD_SCRIPT = """
+local doc_id = redis.call('RPUSH', KEYS[1], ARGV[1]) - 1
+local doc_len = tonumber(ARGV[2])
+for i = 3, #KEYS do
+    redis.call('APPEND', KEYS[i], struct.pack('<IHH', doc_id, tonumber(ARGV[i]), math.min(doc_len, 65535)))
+end
+redis.call('HINCRBY', KEYS[2], 'n', 1)
+redis.call('HINCRBY', KEYS[2], 'total_len', doc_len)
+return doc_id
+"""
+
+
+class RedisMemoryIndex:
+    """
+    Долгая память в Redis (сохраняется между перезапусками):
+    memory:<chat_id>:docs — архив документов (только добавление), memory:<chat_id>:stats — число документов
+    и их суммарная длина, memory:<chat_id>:t:<термин> — упакованный список вхождений термина (растёт через APPEND).
+    Добавление документа — один вызов Lua-скрипта, поиск — два round trip (списки терминов, затем найденные документы).
+    """
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0, max_connections: int = 10, socket_timeout: float = 5.0):
+        self._pool = aioredis.BlockingConnectionPool(
+            host=host, port=port, db=db, max_connections=max_connections, socket_timeout=socket_timeout,
+        )
+        self._client = aioredis.Redis(connection_pool=self._pool)
+        self._add_script = self._client.register_script(_ADD_SCRIPT)
+
+    @staticmethod
+    def _docs_key(chat_id: int) -> str:
+        return f"memory:{chat_id}:docs"
+
+    @staticmethod
+    def _stats_key(chat_id: int) -> str:
+        return f"memory:{chat_id}:stats"
+
+    @staticmethod
+    def _term_key(chat_id: int, term: str) -> str:
+        return f"memory:{chat_id}:t:{term}"
+
+    async def add_many(self, chat_id: int, entries: Sequence[EntryLike]) -> None:
+        async with self._client.pipeline(transaction=False) as pipe:
+            for entry in entries:
+                message_id, user, text, from_bot = _entry_fields(entry)
+                terms = tokenize(text)
+                counts = Counter(terms)
+                doc = json.dumps({"m": message_id, "u": user, "t": text, "b": from_bot}, ensure_ascii=False)
+                await self._add_script(
+                    keys=[self._docs_key(chat_id), self._stats_key(chat_id), *(self._term_key(chat_id, t) for t in counts)],
+                    args=[doc, len(terms), *(min(tf, 0xFFFF) for tf in counts.values())],
+                    client=pipe,
+                )
+            await pipe.execute()
+
+    async def search(self, chat_id: int, terms: Sequence[str], limit: int, skip_recent: int = 0) -> List[MemoryHit]:
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.hmget(self._stats_key(chat_id), "n", "total_len")
+            for term in terms:
+                pipe.get(self._term_key(chat_id, term))
+            (n_docs, total_len), *raw_postings = await pipe.execute()
+        n_docs = int(n_docs or 0)
+        if not n_docs:
+            return []
+        norm_a, norm_b = _length_norm(max(int(total_len or 0) / n_docs, 1.0))
+        first_recent = n_docs - skip_recent
+        max_df = max(n_docs * _MAX_DF_RATIO, _MIN_SKIPPED_DF)
+        raw_postings = sorted((raw for raw in raw_postings if raw and len(raw) // _POSTING.size <= max_df), key=len)
+        del raw_postings[_within_budget(len(raw) // _POSTING.size for raw in raw_postings):]
+        scores: Dict[int, float] = {}
+        for raw in raw_postings:
+            weight = _idf(n_docs, len(raw) // _POSTING.size) * (_K1 + 1)
+            for doc_id, tf, doc_len in _POSTING.iter_unpack(raw):
+                if doc_id >= first_recent:
+                    break
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf / (tf + norm_a + norm_b * doc_len)
+        top = heapq.nlargest(limit, ((score, doc_id) for doc_id, score in scores.items()))
+        if not top:
+            return []
+        async with self._client.pipeline(transaction=False) as pipe:
+            for _score, doc_id in top:
+                pipe.lindex(self._docs_key(chat_id), doc_id)
+            raw_docs = await pipe.execute()
+        hits = []
+        for (score, _doc_id), raw_doc in zip(top, raw_docs):
+            if raw_doc is None:
+                continue
+            doc = json.loads(raw_doc)
+            hits.append(MemoryHit(doc.get("m"), doc.get("u") or "Неизвестный", doc.get("t") or "", bool(doc.get("b")), score))
+        return hits
+
+    async def close(self) -> None:
+        await self._client.aclose()
+        await self._pool.disconnect()
+
+
+class LongTermMemory:
+    """
+    Фасад долгой памяти для хэндлеров: remember() только ставит сообщение в очередь (путь ответа не ждёт
+    записи в индекс), фоновый run() раз в flush_interval секунд пишет очередь в индекс,
+    а recall() ищет старые сообщения, похожие на целевое, строго в пределах timeout.
+    Последние window сообщений архива при поиске пропускаются: они и так есть в окне контекста.
+    """
+    def __init__(self, index: Any, window: int = 0, flush_interval: float = 1.0, max_pending: int = 10000):
+        """
+        Args:
+            index: InMemoryMemoryIndex или RedisMemoryIndex.
+            window: Размер окна контекста чата (CONTEXT_MAX_MESSAGES).
+            flush_interval: Период записи накопленных сообщений в индекс (секунды).
+            max_pending: Сколько сообщений держать в очереди, если индекс недоступен (старые отбрасываются).
+        """
+        self._index = index
+        self._window = window
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._pending: Dict[int, List[EntryLike]] = {}
+        self._pending_count = 0
+
+    def remember(self, chat_id: int, entry: EntryLike) -> None:
+        """Ставит сообщение в очередь на индексацию (сообщения без текста не индексируются)."""
+        if not entry.get("text") or self._pending_count >= self._max_pending:
+            return
+        self._pending.setdefault(chat_id, []).append(entry)
+        self._pending_count += 1
+
+    def pending(self) -> int:
+        """Сколько сообщений ждут индексации (для метрик)."""
+        return self._pending_count
+
+    async def flush(self) -> None:
+        """Пишет очередь в индекс. При ошибке сообщения чата возвращаются в очередь до следующего раза."""
+        batches, self._pending, self._pending_count = self._pending, {}, 0
+        for chat_id, entries in batches.items():
+            try:
+                await self._index.add_many(chat_id, entries)
+                metrics.inc("memory_indexed", len(entries))
+            except Exception as e:
+                logger.warning("Failed to index %d message(s) of chat %d, will retry: %s", len(entries), chat_id, e)
+                self._pending.setdefault(chat_id, [])[:0] = entries
+                self._pending_count += len(entries)
+
+    async def run(self) -> None:
+        """Фоновая запись в индекс."""
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            if self._pending:
+                await self.flush()
+
+    async def recall(self, chat_id: int, text: str, limit: int, timeout: float = 0.15) -> List[MemoryHit]:
+        """
+        Старые сообщения чата (старше окна контекста), наиболее релевантные text по BM25, не больше limit,
+        от самого релевантного. Не дольше timeout секунд: при превышении или ошибке возвращается
+        пустой список — ответ не должен ждать память. Таймаут ограничивает ожидание Redis; подсчёт
+        релевантности синхронный и ограничен заранее (_MAX_SCANNED_POSTINGS).
+        """
+        terms = list(dict.fromkeys(tokenize(text)))[:_MAX_QUERY_TERMS]
+        if not terms or limit <= 0:
+            return []
+        started = time.monotonic()
+        try:
+            hits = await asyncio.wait_for(self._index.search(chat_id, terms, limit, self._window), timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("memory_recalls", result="timeout")
+            logger.debug("Long-term memory recall for chat %d exceeded %.2fs.", chat_id, timeout)
+            return []
+        except Exception as e:
+            metrics.inc("memory_recalls", result="error")
+            logger.warning("Long-term memory recall failed for chat %d: %s", chat_id, e)
+            return []
+        finally:
+            metrics.observe("memory_recall_seconds", time.monotonic() - started)
+        metrics.inc("memory_recalls", result="hit" if hits else "miss")
+        return hits
+
+    async def close(self) -> None:
+        """Дописывает очередь в индекс и закрывает соединения."""
+        await self.flush()
+        await self._index.close()
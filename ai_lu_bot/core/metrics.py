@@ -0,0 +1,106 @@
+# ai_lu_bot/core/metrics.py
+import asyncio
+import bisect
+import logging
+from typing import Any, Callable, Dict, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек по умолчанию (секунды)
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _metric_key(name: str, labels: Dict[str, Any]) -> str:
+    """Формирует ключ метрики вида name{label=value,...}."""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: count, sum и приблизительные перцентили."""
+    __slots__ = ("_bounds", "_counts", "count", "sum")
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self._bounds = tuple(sorted(buckets))
+        self._counts = [0] * (len(self._bounds) + 1) # Последняя корзина — всё, что больше верхней границы
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попадает q-й перцентиль (0 < q <= 1)."""
+        if not self.count:
+            return None
+        threshold = q * self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self._bounds, self._counts):
+            cumulative += bucket_count
+            if cumulative >= threshold:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count, 4) if self.count else None,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+        }
+
+
+class MetricsRegistry:
+    """
+    Простейший реестр метрик процесса: счётчики, гистограммы и gauge-колбэки.
+    Снимок периодически пишется в лог (см. log_metrics_periodically).
+    """
+    def __init__(self):
+        self._counters: Dict[str, float] = {}
+        self._histograms: Dict[str, Histogram] = {}
+        self._gauges: Dict[str, Callable[[], Any]] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels: Any) -> None:
+        key = _metric_key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = _metric_key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def histogram(self, name: str, **labels: Any) -> Optional[Histogram]:
+        return self._histograms.get(_metric_key(name, labels))
+
+    def register_gauge(self, name: str, callback: Callable[[], Any]) -> None:
+        """Регистрирует функцию, возвращающую текущее значение (число или словарь) при снятии снимка."""
+        self._gauges[name] = callback
+
+    def snapshot(self) -> Dict[str, Any]:
+        gauges = {}
+        for name, callback in self._gauges.items():
+            try:
+                gauges[name] = callback()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {
+            "counters": dict(self._counters),
+            "histograms": {key: h.snapshot() for key, h in self._histograms.items()},
+            "gauges": gauges,
+        }
+
+
+# Глобальный реестр метрик процесса
+metrics = MetricsRegistry()
+
+
+async def log_metrics_periodically(interval: float) -> None:
+    """Фоновая задача: раз в interval секунд пишет снимок метрик в лог."""
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("Metrics snapshot: %s", metrics.snapshot())
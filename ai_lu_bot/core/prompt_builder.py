@@ -1,17 +1,154 @@
 # ai_lu_bot/core/prompt_builder.py
 import logging
+from collections import OrderedDict
 # Импортируем необходимые типы для тайп-хинтинга
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 # Импортируем Message из telegram
 from telegram import Message
 # Импортируем ChatType из telegram.constants (исправление Import Error)
 from telegram.constants import ChatType
 
+from ai_lu_bot.core.memory_index import MemoryHit
 # Импортируем шаблон промпта из нового места внутри пакета
 from ai_lu_bot.prompt.base_prompt import BASE_PROMPT_TEMPLATE
 
 logger = logging.getLogger(__name__)
 
+
+# --- Предкомпилированный шаблон промпта ---
+_HISTORY_PLACEHOLDER = "{{CONVERSATION_HISTORY_PLACEHOLDER}}"
+_TASK_PLACEHOLDER = "{{FINAL_TASK_PLACEHOLDER}}"
+
+
+def _compile_template(template: str) -> Tuple[str, str, str]:
+    """
+    Один раз разбивает шаблон на статические сегменты вокруг плейсхолдеров:
+    (до истории, между историей и заданием, после задания).
+    """
+    head, found_history, rest = template.partition(_HISTORY_PLACEHOLDER)
+    middle, found_task, tail = rest.partition(_TASK_PLACEHOLDER)
+    if not found_history or not found_task:
+        raise ValueError("BASE_PROMPT_TEMPLATE must contain history and final task placeholders (in this order)")
+    return head, middle, tail
+
+
+_PROMPT_HEAD, _PROMPT_MIDDLE, _PROMPT_TAIL = _compile_template(BASE_PROMPT_TEMPLATE)
+
+# Персона (Блоки 1-5) не зависит от чата и реплики: её можно отправлять отдельно, как system instruction модели
+# (и кэшировать на стороне API), а в запрос класть только заголовок Блока 6, историю и задание
+PERSONA_INSTRUCTION, _, _TURN_HEAD = _PROMPT_HEAD.rpartition("\n\n")
+if not PERSONA_INSTRUCTION:
+    PERSONA_INSTRUCTION, _TURN_HEAD = _PROMPT_HEAD, ""
+
+
+def _render_prompt(conversation_history_string: str, final_task_string: str, include_persona: bool = True) -> str:
+    """Собирает промпт одним join из готовых сегментов — без повторного сканирования ~12 КБ шаблона."""
+    head = _PROMPT_HEAD if include_persona else _TURN_HEAD
+    return "".join((head, conversation_history_string, _PROMPT_MIDDLE, final_task_string, _PROMPT_TAIL))
+
+
+# --- Бюджет истории в токенах ---
+# Сколько токенов могут занять история переписки и комментируемый пост в промпте
+DEFAULT_HISTORY_TOKEN_BUDGET = 3000
+# Потолок одной записи: длинный пересланный пост обрезается, а не вытесняет весь остальной диалог
+DEFAULT_HISTORY_ENTRY_MAX_TOKENS = 600
+# ~3 символа на токен (так же оценивается лимит TPM в GeminiService); перевод строки и разметка — сверху
+_CHARS_PER_TOKEN = 3
+_LINE_OVERHEAD_TOKENS = 2
+_CLIPPED_MARK = "… [обрезано]"
+
+
+def estimate_tokens(text: str) -> int:
+    """Быстрая локальная оценка числа токенов текста (без токенизатора модели)."""
+    return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+
+
+def _clip(text: str, max_tokens: int) -> str:
+    """Обрезает текст до max_tokens (по оценке estimate_tokens) с пометкой об обрезке."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max(0, max_tokens * _CHARS_PER_TOKEN - len(_CLIPPED_MARK))].rstrip() + _CLIPPED_MARK
+
+
+# --- Кэш отформатированных строк истории ---
+class _HistoryLineCache:
+    """
+    LRU-кэш строк вида "[Пользователь]: текст" и их оценки в токенах для записей контекста.
+    Окно чата между ответами сдвигается на пару записей, поэтому остальные строки
+    берутся из кэша, а не форматируются и не оцениваются заново.
+    """
+    def __init__(self, max_size: int = 4096):
+        self._lines: "OrderedDict[Tuple[int, int, bool], Tuple[str, str, int, str, int]]" = OrderedDict()
+        self._max_size = max_size
+
+    def line(self, chat_id: int, msg: Any, max_tokens: int = DEFAULT_HISTORY_ENTRY_MAX_TOKENS) -> Tuple[str, int]:
+        """Строка истории для записи (обрезанная до max_tokens) и её оценка в токенах."""
+        from_bot = bool(msg.get("from_bot", False))
+        user = msg.get("user", "Неизвестный")
+        # Убедимся, что поле 'text' существует в записи контекста
+        context_text = msg.get("text", "[Сообщение без текста или только с медиа]")
+        message_id = msg.get("message_id")
+        if message_id is None:
+            return _format_history_line(from_bot, user, context_text, max_tokens)
+
+        key = (chat_id, message_id, from_bot)
+        cached = self._lines.get(key)
+        # Сравнение сначала по идентичности: для in-memory хранилищ это те же самые объекты строк
+        if (
+            cached is not None
+            and (cached[1] is context_text or cached[1] == context_text)
+            and cached[0] == user
+            and cached[2] == max_tokens
+        ):
+            self._lines.move_to_end(key)
+            return cached[3], cached[4]
+
+        line, tokens = _format_history_line(from_bot, user, context_text, max_tokens)
+        self._lines[key] = (user, context_text, max_tokens, line, tokens)
+        if len(self._lines) > self._max_size:
+            self._lines.popitem(last=False)
+        return line, tokens
+
+
+def _format_history_line(from_bot: bool, user: str, context_text: str, max_tokens: int) -> Tuple[str, int]:
+    label = "[Бот]" if from_bot else f"[{user}]"
+    line = f"{label}: {_clip(context_text, max_tokens)}"
+    return line, estimate_tokens(line) + _LINE_OVERHEAD_TOKENS
+
+
+_history_lines = _HistoryLineCache()
+
+
+def _replied_post_line(replied_to_message: Optional[Message], max_tokens: int) -> Optional[str]:
+    """Строка "[Комментируемый пост]: текст" для сообщения, на которое ответили, или None, если текста нет."""
+    # Проверка isinstance: в replied_to_message может оказаться не Message
+    if not replied_to_message or not isinstance(replied_to_message, Message):
+        return None
+    # Извлекаем текст или подпись из объекта Message, на который ответили
+    replied_text = (replied_to_message.text or replied_to_message.caption or "").strip()
+    if not replied_text:
+        return None
+    # Определяем, откуда был переслан комментируемый пост (если доступно из Message объекта)
+    forward_info = ""
+    # Используем getattr для безопасного доступа к атрибутам, которые могут отсутствовать
+    if getattr(replied_to_message, 'forward_from_chat', None):
+         # Проверяем, что forward_from_chat это объект ChatType/Chat и у него есть title
+         if hasattr(replied_to_message.forward_from_chat, 'title'):
+            forward_info = f" (из Канала '{replied_to_message.forward_from_chat.title}')"
+         elif hasattr(replied_to_message.forward_from_chat, 'username'): # Если title нет, возможно, есть username
+            forward_info = f" (из Канала '@{replied_to_message.forward_from_chat.username}')"
+    elif getattr(replied_to_message, 'sender_chat', None):
+         # Проверяем, что sender_chat это объект ChatType/Chat и у него есть title
+         if hasattr(replied_to_message.sender_chat, 'title'):
+            forward_info = f" (из Чата '{replied_to_message.sender_chat.title}')"
+         elif hasattr(replied_to_message.sender_chat, 'username'):
+            forward_info = f" (из Чата '@{replied_to_message.sender_chat.username}')"
+
+    logger.debug(f"Added replied-to message text to prompt: '{replied_text[:50]}...'")
+    # Текст комментируемого поста с пометкой; длинный пост обрезается так же, как записи истории
+    return f"[Комментируемый пост{forward_info}]: {_clip(replied_text, max_tokens)}"
+
+
 def build_prompt(
     chat_id: int, # Required: ID чата.
     messages: List[Dict[str, Any]], # Required: Список сообщений для контекста.
@@ -19,7 +156,14 @@ def build_prompt(
     trigger: str, # Required: Тип триггера ответа.
     replied_to_message: Optional[Message] = None, # Optional: Объект сообщения, на которое отвечает target_message. (Со значением по умолчанию)
     media_type: Optional[str] = None, # Optional: Тип медиа в целевом сообщении. (Со значением по умолчанию)
-    media_data_bytes: Optional[bytes] = None # Optional: Байты медиа (не используются для сборки текста). (Со значением по умолчанию)
+    media_data_bytes: Optional[bytes] = None, # Optional: Байты медиа (не используются для сборки текста). (Со значением по умолчанию)
+    image_count: int = 1, # Optional: Сколько изображений прикреплено (больше 1 — альбом).
+    burst_size: int = 1, # Optional: Сколько последних сообщений подряд покрывает ответ.
+    history_token_budget: int = DEFAULT_HISTORY_TOKEN_BUDGET, # Optional: Бюджет истории в токенах.
+    history_entry_max_tokens: int = DEFAULT_HISTORY_ENTRY_MAX_TOKENS, # Optional: Потолок одной записи истории.
+    summary: Optional[str] = None, # Optional: Краткое содержание переписки, вытесненной из окна контекста.
+    recalled: Optional[Sequence[MemoryHit]] = None, # Optional: Давние сообщения, найденные в долгой памяти.
+    include_persona: bool = True, # Optional: False — без Блоков 1-5 (персона уходит как system instruction).
 ) -> str:
     """
     Собирает полный промпт для Gemini API на основе шаблона, переданного контекста
@@ -37,6 +181,17 @@ def build_prompt(
         media_data_bytes: Байты медиафайла. Передается, только если медиа успешно скачано.
                           Используется здесь только для проверки, успешно ли скачано медиа,
                           чтобы добавить "(медиа прикреплено для анализа)" в промпт.
+        image_count: Число изображений, прикреплённых к запросу (для альбома — число фото в нём).
+        burst_size: Сколько последних сообщений пользователь отправил подряд; ответ должен покрыть их все.
+        history_token_budget: Сколько токенов (по оценке estimate_tokens) могут занять история и комментируемый пост.
+                              Не влезающие записи отбрасываются, начиная с самых старых.
+        history_entry_max_tokens: Записи длиннее этого обрезаются с пометкой "[обрезано]".
+        summary: Краткое содержание более ранней переписки (см. services/summarizer.py). Добавляется одним блоком
+                 в начало истории, обрезается так же, как записи, и оплачивается из бюджета первым.
+        recalled: Давние сообщения чата, релевантные целевому (см. core/memory_index.py), от самого релевантного.
+                  Идут блоком после краткого содержания и оплачиваются из бюджета сразу после него.
+        include_persona: Включать ли в промпт персону (PERSONA_INSTRUCTION). False, если модель получает её
+                         отдельно — как system instruction или через кэш контента API.
 
     Returns:
         Строка, содержащая полный промпт для Gemini API.
@@ -65,8 +220,8 @@ def build_prompt(
     # Определяем простой тип сообщения для отображения в промпте
     if media_type == "image" and target_message.photo:
          msg_type_simple = "изображение"
-         # Count PhotoSize objects as a proxy for number of images in an album
-         num_photos = len(target_message.photo)
+         # message.photo — это размеры ОДНОГО фото; число фото альбома передаётся отдельно
+         num_photos = max(image_count, 1)
          if num_photos > 1: msg_type_simple = "изображения" # Plural form for albums
     elif media_type == "audio":
         msg_type_simple = "голосовое"
@@ -80,53 +235,50 @@ def build_prompt(
     # --- Строим строку истории переписки ---
     conversation_history_parts = ["История переписки (самые новые внизу):"]
 
-    # Подготавливаем сообщения из истории, исключая целевое сообщение (оно всегда последнее)
-    context_messages_for_history = [msg for msg in messages if msg.get('message_id') != target_message.message_id]
+    # Комментируемый пост идёт отдельной строкой после истории, поэтому в самой истории он не повторяется
+    replied_post_line = _replied_post_line(replied_to_message, history_entry_max_tokens)
+    excluded_ids = {target_message.message_id} # Целевое сообщение всегда последнее и добавляется ниже
+    if replied_post_line is not None:
+        excluded_ids.add(replied_to_message.message_id)
+    context_messages_for_history = [msg for msg in messages if msg.get('message_id') not in excluded_ids]
 
-    if not context_messages_for_history:
+    # Набираем историю от новых записей к старым, пока хватает бюджета (комментируемый пост оплачивается первым).
+    # Строки и их оценки в токенах берутся из кэша
+    summary_line = f"[Краткое содержание более ранней переписки]: {_clip(summary, history_entry_max_tokens)}" if summary else None
+    remaining = history_token_budget - sum(estimate_tokens(line) for line in (summary_line, replied_post_line) if line)
+    recalled_lines: List[str] = []
+    for hit in recalled or ():
+        line, tokens = _format_history_line(hit.from_bot, hit.user, hit.text, history_entry_max_tokens)
+        if tokens > remaining:
+            break
+        remaining -= tokens
+        recalled_lines.append(line)
+    history_lines: List[str] = []
+    for msg in reversed(context_messages_for_history):
+        line, tokens = _history_lines.line(chat_id, msg, history_entry_max_tokens)
+        if tokens > remaining:
+            break
+        remaining -= tokens
+        history_lines.append(line)
+    dropped = len(context_messages_for_history) - len(history_lines)
+    if summary_line is not None:
+        conversation_history_parts.append(summary_line)
+    if recalled_lines:
+        conversation_history_parts.append("[Из давней переписки]:")
+        conversation_history_parts.extend(recalled_lines)
+        conversation_history_parts.append("[Недавняя переписка]:")
+    if dropped:
+        logger.debug("History for chat %d trimmed to the token budget: %d oldest entries dropped.", chat_id, dropped)
+        conversation_history_parts.append("[Более ранняя переписка опущена]")
+    elif not history_lines and summary_line is None and not recalled_lines:
          conversation_history_parts.append("[Начало диалога]")
 
-    # Добавляем сообщения из контекста в строку истории
-    for msg in context_messages_for_history:
-        label = "[Бот]" if msg.get("from_bot", False) else f"[{msg.get('user', 'Неизвестный')}]"
-        # Убедимся, что поле 'text' существует в словаре сообщения контекста
-        context_text = msg.get('text', '[Сообщение без текста или только с медиа]')
-        conversation_history_parts.append(f"{label}: {context_text}")
+    conversation_history_parts.extend(reversed(history_lines))
 
     conversation_history_parts.append("---") # Разделитель между историей и текущими элементами
 
-
-    # --- Добавляем информацию о комментируемом посте, если она доступна и является объектом Message ---
-    # !!! ИСПРАВЛЕНИЕ: Добавлена проверка isinstance(replied_to_message, Message) !!!
-    if replied_to_message and isinstance(replied_to_message, Message):
-        # Извлекаем текст или подпись из объекта Message, на который ответили
-        replied_text = (replied_to_message.text or replied_to_message.caption or "").strip()
-        if replied_text:
-            # Определяем, откуда был переслан комментируемый пост (если доступно из Message объекта)
-            forward_info = ""
-            # Используем getattr для безопасного доступа к атрибутам, которые могут отсутствовать
-            if getattr(replied_to_message, 'forward_from_chat', None):
-                 # Проверяем, что forward_from_chat это объект ChatType/Chat и у него есть title
-                 if hasattr(replied_to_message.forward_from_chat, 'title'):
-                    forward_info = f" (из Канала '{replied_to_message.forward_from_chat.title}')"
-                 elif hasattr(replied_to_message.forward_from_chat, 'username'): # Если title нет, возможно, есть username
-                    forward_info = f" (из Канала '@{replied_to_message.forward_from_chat.username}')"
-
-            elif getattr(replied_to_message, 'sender_chat', None):
-                 # Проверяем, что sender_chat это объект ChatType/Chat и у него есть title
-                 if hasattr(replied_to_message.sender_chat, 'title'):
-                    forward_info = f" (из Чата '{replied_to_message.sender_chat.title}')"
-                 elif hasattr(replied_to_message.sender_chat, 'username'):
-                    forward_info = f" (из Чата '@{replied_to_message.sender_chat.username}')"
-
-
-            # Добавляем текст комментируемого поста в промпт с пометкой
-            conversation_history_parts.append(f"[Комментируемый пост{forward_info}]: {replied_text}")
-            logger.debug(f"Added replied-to message text to prompt: '{replied_text[:50]}...'")
-        # else:
-             # logger.debug("replied_to_message exists and is Message, but has no text/caption to add to prompt.")
-    # else:
-        # logger.debug("replied_to_message is None or not a Message object. Not adding context.")
+    if replied_post_line is not None:
+        conversation_history_parts.append(replied_post_line)
 
 
     # --- Добавляем целевое сообщение как последнюю реплику ---
@@ -137,7 +289,7 @@ def build_prompt(
     # media_type используется здесь build_prompt только для определения img_tag/метки типа
     if media_data_bytes is not None and media_type in ("image", "audio", "video"):
         if media_type == "image":
-            img_tag = "[Изображение]" if num_photos <= 1 else "[Изображения]"
+            img_tag = "[Изображение]" if num_photos <= 1 else f"[Изображения: {num_photos}]"
             target_message_content = f"{img_tag}{(': ' + target_text) if target_text else ''}"
         elif media_type == "audio":
             target_message_content = "[Голосовое сообщение]"
@@ -160,6 +312,8 @@ def build_prompt(
     # Уточнения задачи в зависимости от триггера (для ИИ)
     if trigger == "channel_post_forwarded_or_sent_as":
         final_task_string = "ЗАДАНИЕ: Напиши комментарий в стиле Лу на ПОСЛЕДНИЙ пост (пересланный или отправленный от имени канала) в истории выше, полностью следуя своей личности, стилю формулирования и всем инструкциям из Блоков 1-5."
+    elif trigger == "dm" and burst_size > 1:
+         final_task_string = f"ЗАДАНИЕ: Пользователь написал тебе в личных сообщениях несколько сообщений подряд (ПОСЛЕДНИЕ {burst_size} в истории выше). Ответь на них все ОДНИМ ответом, полностью следуя своей личности (Лу), стилю формулирования и всем инструкциям из Блоков 1-5."
     elif trigger == "dm":
          final_task_string = "ЗАДАНИЕ: Ответь пользователю в личных сообщениях на его ПОСЛЕДНЕЕ сообщение в истории выше, полностью следуя своей личности (Лу), стилю формулирования и всем инструкциям из Блоков 1-5."
     # Добавляем специальное указание, если отвечает создателю, который отправил целевое сообщение
@@ -170,13 +324,35 @@ def build_prompt(
     # --- Собираем итоговый промпт из всех частей ---
     conversation_history_string = "\n".join(conversation_history_parts)
 
-    final_prompt = BASE_PROMPT_TEMPLATE.replace(
-        "{{CONVERSATION_HISTORY_PLACEHOLDER}}",
-        conversation_history_string
-    ).replace(
-        "{{FINAL_TASK_PLACEHOLDER}}",
-        final_task_string
-    )
+    final_prompt = _render_prompt(conversation_history_string, final_task_string, include_persona)
 
     # logger.debug("Built prompt for chat %d:\n%s", chat_id, final_prompt)
     return final_prompt
+
+
+def build_summary_prompt(previous_summary: Optional[str], entries: List[Any], max_tokens: int) -> str:
+    """
+    Промпт для сжатия вытесненных из окна записей в краткое содержание переписки чата.
+
+    Args:
+        previous_summary: Текущее краткое содержание (или None, если его ещё нет).
+        entries: Записи контекста, вытесненные из окна (старые первыми).
+        max_tokens: Желаемый размер нового содержания в токенах (по оценке estimate_tokens).
+    """
+    lines = [_format_history_line(
+        bool(msg.get("from_bot", False)),
+        msg.get("user", "Неизвестный"),
+        msg.get("text", "[Сообщение без текста или только с медиа]"),
+        DEFAULT_HISTORY_ENTRY_MAX_TOKENS,
+    )[0] for msg in entries]
+    max_chars = max_tokens * _CHARS_PER_TOKEN
+    return "\n".join((
+        "Ты ведёшь краткое содержание переписки в чате Telegram, чтобы участник-бот (Бот) помнил, о чём говорили раньше.",
+        f"Текущее краткое содержание: {previous_summary or '[пока пусто]'}",
+        "Следующие сообщения (самые новые внизу):",
+        *lines,
+        "---",
+        f"ЗАДАНИЕ: Перепиши краткое содержание так, чтобы оно включало и эти сообщения. Не длиннее {max_chars} символов. "
+        "Сохрани то, что пригодится в разговоре позже: кто есть кто, факты о людях, договорённости, обещания, "
+        "повторяющиеся темы и шутки. Старое и неважное сокращай. Пиши сжато, в третьем лице, без вступлений — только сам текст.",
+    ))
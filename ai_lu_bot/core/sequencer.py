@@ -0,0 +1,100 @@
+# ai_lu_bot/core/sequencer.py
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class ChatTicket:
+    """
+    Место в очереди записей в контекст одного чата. Выдаётся синхронно (ChatSequencer.ticket), поэтому
+    порядок билетов — это порядок, в котором обработчики были запущены, а не порядок, в котором они дошли до записи.
+    Билет обязательно освобождается: через turn() или release() (повторный release() ничего не делает).
+    """
+    __slots__ = ("chat_id", "_sequencer", "_ready", "_released")
+
+    def __init__(self, sequencer: "ChatSequencer", chat_id: int):
+        self.chat_id = chat_id
+        self._sequencer = sequencer
+        self._ready = asyncio.get_running_loop().create_future()
+        self._released = False
+
+    async def wait(self) -> None:
+        """Ждёт, пока все более ранние билеты чата будут освобождены."""
+        await asyncio.shield(self._ready)
+
+    def release(self) -> None:
+        """Освобождает место в очереди: следующий билет чата может писать."""
+        if not self._released:
+            self._released = True
+            self._sequencer._release(self)
+
+    @asynccontextmanager
+    async def turn(self) -> AsyncIterator[None]:
+        """Эксклюзивный участок записи в контекст в порядке билетов; по выходе билет освобождается."""
+        try:
+            await self.wait()
+            yield
+        finally:
+            self.release()
+
+
+class ChatSequencer:
+    """
+    Упорядочивает записи в контекст внутри одного чата при параллельной обработке обновлений.
+
+    Обработчик берёт билет чата синхронно, до первого await (обработчики запускаются в порядке поступления
+    обновлений), и перед записью в контекст ждёт, пока освободятся все более ранние билеты этого чата.
+    Так сообщения чата попадают в контекст в порядке поступления, даже если одно из них задержалось
+    в сборе альбома или скачивании, а разные чаты обрабатываются параллельно. Очереди неактивных чатов удаляются.
+    """
+    def __init__(self):
+        self._queues: Dict[int, Deque[ChatTicket]] = {}
+        self._max_depth_seen = 0
+
+    def ticket(self, chat_id: int) -> ChatTicket:
+        """Выдаёт следующий билет чата. Вызывать синхронно при поступлении сообщения."""
+        ticket = ChatTicket(self, chat_id)
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+        queue.append(ticket)
+        depth = len(queue)
+        if depth > self._max_depth_seen:
+            self._max_depth_seen = depth
+        if depth == 1:
+            ticket._ready.set_result(None)
+        else:
+            logger.debug("Chat %s: ticket queued behind %d earlier messages.", chat_id, depth - 1)
+        return ticket
+
+    @asynccontextmanager
+    async def slot(self, chat_id: int) -> AsyncIterator[None]:
+        """Эксклюзивный участок для чата: билет берётся в момент вызова."""
+        async with self.ticket(chat_id).turn():
+            yield
+
+    def _release(self, ticket: ChatTicket) -> None:
+        queue = self._queues[ticket.chat_id]
+        # Билет может освобождаться не первым (обработчик завершился, не дойдя до записи) — он просто уходит из очереди
+        queue.remove(ticket)
+        if not queue:
+            # Никто больше не ждёт — освобождаем память под очередь
+            del self._queues[ticket.chat_id]
+            return
+        head = queue[0]
+        if not head._ready.done():
+            head._ready.set_result(None)
+
+    def queue_depths(self) -> Dict[str, object]:
+        """Текущая глубина очередей по чатам (для метрик)."""
+        busiest = sorted(((chat_id, len(queue)) for chat_id, queue in self._queues.items()), key=lambda item: item[1], reverse=True)[:10]
+        return {
+            "active_chats": len(self._queues),
+            "waiting": sum(len(queue) - 1 for queue in self._queues.values()),
+            "max_depth_seen": self._max_depth_seen,
+            "busiest": {str(chat_id): depth for chat_id, depth in busiest},
+        }
@@ -1,25 +1,46 @@
 # ai_lu_bot/handlers/message.py
 
+import asyncio
+import contextlib
 import logging
 import random
+import time
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Dict, List, Optional, Tuple, TypeVar, Union
 
 from telegram import Update, ReplyKeyboardMarkup, Voice, VideoNote, PhotoSize, Message
-from telegram.constants import ChatType
+from telegram.constants import ChatAction, ChatType
 from telegram.ext import ContextTypes
 
 # Импортируем сервисы и утилиты
 from ai_lu_bot.services.gemini import GeminiService
-from ai_lu_bot.utils.media import download_media, MediaDownloadError
+from ai_lu_bot.services.scheduler import SchedulerRejected
+from ai_lu_bot.utils.media import (
+    DEFAULT_PHOTO_TARGET_SIDE,
+    DEFAULT_PHOTO_TARGET_SIDES,
+    download_media,
+    fit_photo_to_budget,
+    select_photo_size,
+    MediaDownloadError,
+)
+from ai_lu_bot.utils.media_cache import MediaData
 # Удаляем импорт глобального менеджера контекста
 # from ai_lu_bot.core.context import chat_context_manager, MAX_CONTEXT_MESSAGES # УДАЛИТЬ или закомментировать
 # Импортируем только классы менеджеров и константу MAX_CONTEXT_MESSAGES для тайп-хинтинга и использования константы
-from ai_lu_bot.core.context import InMemoryChatContextManager, RedisChatContextManager, MAX_CONTEXT_MESSAGES
+from ai_lu_bot.core.context import InMemoryChatContextManager, RedisChatContextManager, TieredChatContextManager, MAX_CONTEXT_MESSAGES
 
+from ai_lu_bot.core.album import AlbumAggregator
+from ai_lu_bot.core.debounce import BurstSuperseded, ChatDebouncer
+from ai_lu_bot.core.memory_index import LongTermMemory, MemoryHit
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.core.sequencer import ChatSequencer, ChatTicket
 from ai_lu_bot.utils.text_utils import filter_technical_info
 from ai_lu_bot.core.prompt_builder import build_prompt
+from ai_lu_bot.services.summarizer import ContextSummarizer
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 # --- Функция start для команды /start ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -32,12 +53,184 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("Sent /start message to chat %s", update.effective_chat.id)
 
 
+# --- Стадии конвейера обработки сообщения ---
+async def _timed_stage(stage: str, media_label: str, coro: Awaitable[T]) -> T:
+    """Выполняет стадию конвейера, логируя и записывая в метрики её длительность."""
+    started = time.monotonic()
+    try:
+        return await coro
+    finally:
+        elapsed = time.monotonic() - started
+        metrics.observe("handler_stage_seconds", elapsed, stage=stage, media=media_label)
+        logger.debug("Stage '%s' (media: %s) took %.3fs.", stage, media_label, elapsed)
+
+
+async def _send_typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    """Показывает "печатает…" пока готовится ответ. Ошибки не критичны."""
+    try:
+        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    except Exception as e:
+        logger.debug("Failed to send typing action to chat %d: %s", chat_id, e)
+
+
+def _photo_target_side(context: ContextTypes.DEFAULT_TYPE, trigger: str) -> int:
+    """Целевая длинная сторона фото (пиксели) для данного триггера ответа."""
+    target_sides = context.bot_data.get("photo_target_sides", DEFAULT_PHOTO_TARGET_SIDES)
+    return target_sides.get(trigger, DEFAULT_PHOTO_TARGET_SIDE)
+
+
+async def _download_stage(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    message_id: int,
+    media_obj: Union[Voice, VideoNote, PhotoSize],
+    media_type: str,
+    trigger: str,
+    notify: bool = True,
+) -> Tuple[Optional[MediaData], Optional[str]]:
+    """
+    Скачивает медиа целевого сообщения (через кэш медиа, если он настроен). При ошибке возвращает (None, None) —
+    ответ будет только на текст — и, если notify, уведомляет пользователя (кроме случайных ответов в группах).
+    Части альбома скачиваются с notify=False: об их ошибках сообщается одним сообщением (_notify_download_failed).
+    """
+    logger.info("Attempting to download media (Type: %s, ID: %s)...", media_type, getattr(media_obj, 'file_id', 'N/A'))
+    try:
+        media_bytes, mime_type = await download_media(
+            media_obj,
+            media_type,
+            cache=context.bot_data.get("media_cache"),
+            max_bytes=context.bot_data.get("media_max_bytes", {}).get(media_type),
+        )
+        logger.info("Media file (ID: %s) downloaded successfully (%d bytes).", getattr(media_obj, 'file_id', 'N/A'), len(media_bytes))
+        if media_type == "image":
+            # Фото больше бюджета пережимается локально (если установлен Pillow)
+            media_bytes = await fit_photo_to_budget(
+                media_bytes,
+                max_bytes=context.bot_data.get("photo_reencode_max_bytes", 0),
+                max_side=_photo_target_side(context, trigger),
+                trigger=trigger,
+            )
+        return media_bytes, mime_type
+    except MediaDownloadError as e:
+        logger.error("Error downloading media (ID: %s): %s", getattr(media_obj, 'file_id', 'N/A'), e, exc_info=True)
+        if notify:
+            await _notify_download_failed(context, chat_id, message_id, media_type, trigger, failed=1, total=1)
+        return None, None
+
+
+async def _notify_download_failed(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    message_id: int,
+    media_type: str,
+    trigger: str,
+    failed: int,
+    total: int,
+) -> None:
+    """Одно сообщение о том, что медиа (или часть фото альбома) скачать не удалось. Случайным ответам в группах — молча."""
+    if trigger in ["random_group_message"]:
+        return
+    if failed >= total:
+        text = f"(Извини, не смог скачать твой медиафайл ({media_type}). Попробую ответить только на текст, если он был.)"
+    else:
+        text = f"(Извини, не смог скачать {failed} из {total} фото альбома. Отвечу по тем, что дошли.)"
+    try:
+        await context.bot.send_message(chat_id, text, reply_to_message_id=message_id)
+    except Exception as send_err:
+        logger.error("Failed to send media download error message: %s", send_err)
+
+
+# --- Потоковая отправка ответа ---
+# Минимальный интервал между редактированиями сообщения (Telegram ограничивает частоту правок)
+STREAM_EDIT_INTERVAL = 1.5
+
+
+async def _send_streamed_response(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    reply_to_message_id: int,
+    chunks: AsyncIterator[str],
+    edit_interval: float = STREAM_EDIT_INTERVAL,
+) -> Tuple[Message, str]:
+    """
+    Отправляет ответ по мере генерации: первый непустой фрагмент — новым сообщением,
+    затем не чаще раза в edit_interval секунд сообщение редактируется накопленным текстом.
+    Каждая видимая версия проходит filter_technical_info.
+
+    Returns:
+        (отправленное сообщение, финальный отфильтрованный текст)
+    """
+    accumulated = ""
+    sent: Optional[Message] = None
+    shown_text = ""
+    last_edit = 0.0
+    started = time.monotonic()
+
+    async for chunk in chunks:
+        accumulated += chunk
+        visible_text = filter_technical_info(accumulated.strip())
+        if not visible_text:
+            continue
+        now = time.monotonic()
+        if sent is None:
+            sent = await context.bot.send_message(chat_id=chat_id, text=visible_text, reply_to_message_id=reply_to_message_id)
+            shown_text, last_edit = visible_text, now
+            logger.info("First response chunk sent to chat %d after %.2fs (message ID %d).", chat_id, now - started, sent.message_id)
+        elif now - last_edit >= edit_interval and visible_text != shown_text:
+            try:
+                await sent.edit_text(visible_text)
+                shown_text = visible_text
+            except Exception as edit_err:
+                # Например, флуд-контроль Telegram: пропускаем правку, финальная всё равно будет
+                logger.warning("Failed to edit streamed response in chat %d: %s", chat_id, edit_err)
+            last_edit = now
+
+    final_text = filter_technical_info(accumulated.strip()) or "..."
+    if sent is None:
+        sent = await context.bot.send_message(chat_id=chat_id, text=final_text, reply_to_message_id=reply_to_message_id)
+    elif final_text != shown_text:
+        await sent.edit_text(final_text)
+    logger.debug("Streamed response to chat %d finished in %.2fs.", chat_id, time.monotonic() - started)
+    return sent, final_text
+
+
+async def _prepend_chunk(first: str, rest: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Возвращает уже полученный первый фрагмент потока, затем остальные."""
+    yield first
+    async for chunk in rest:
+        yield chunk
+
+
+def _in_turn(ticket: Optional[ChatTicket]) -> AsyncContextManager[None]:
+    """Запись в контекст в порядке билетов чата (без ChatSequencer — сразу)."""
+    return ticket.turn() if ticket is not None else contextlib.nullcontext()
+
+
 # --- Основной Обработчик Сообщений ---
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обрабатывает входящие сообщения (текст, голос, видео, фото).
     Получает менеджер контекста и GeminiService из context.bot_data.
+    Место в очереди записей чата (ChatSequencer) берётся здесь, до первого await, — в порядке поступления обновлений.
     """
+    chat_sequencer: Optional[ChatSequencer] = context.bot_data.get("chat_sequencer")
+    ticket = None
+    if chat_sequencer is not None and update.message and update.effective_chat:
+        ticket = chat_sequencer.ticket(update.effective_chat.id)
+    try:
+        await _handle_message(update, context, chat_sequencer, ticket)
+    finally:
+        # Обработчик мог завершиться, не дойдя до записи (часть альбома, игнорируемое сообщение, ошибка)
+        if ticket is not None:
+            ticket.release()
+
+
+async def _handle_message(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_sequencer: Optional[ChatSequencer],
+    ticket: Optional[ChatTicket],
+) -> None:
     message = update.message
     if not message:
         logger.warning("Received an update without a message object. Skipping.")
@@ -46,7 +239,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # --- Получаем инстансы сервисов и менеджера из bot_data ---
     # Убедимся, что ключи существуют перед доступом
     gemini_service: GeminiService = context.bot_data.get("gemini_service")
-    chat_context_manager_instance: Union[InMemoryChatContextManager, RedisChatContextManager, None] = context.bot_data.get("chat_context_manager")
+    chat_context_manager_instance: Union[InMemoryChatContextManager, RedisChatContextManager, TieredChatContextManager, None] = context.bot_data.get("chat_context_manager")
 
     if not gemini_service:
          logger.critical("GeminiService not found in context.bot_data!")
@@ -111,18 +304,37 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         text = (message.text or message.caption or "").strip()
 
+    # --- Альбом: части с общим media_group_id обрабатываются как одно сообщение ---
+    album_messages: List[Message] = [message]
+    album_aggregator: Optional[AlbumAggregator] = context.bot_data.get("album_aggregator")
+    if message.media_group_id and album_aggregator:
+        collected = await album_aggregator.collect(chat_id, message)
+        if collected is None:
+            # Эту часть забрал обработчик первой части альбома: он и запишет альбом в контекст, и ответит
+            logger.info("Message %d is a part of album %s handled elsewhere. Skipping.", message_id, message.media_group_id)
+            return
+        album_messages = collected
+        if not text:
+            # Подпись альбома обычно только у одной из частей
+            text = next(((m.caption or "").strip() for m in album_messages if m.caption), "")
+    # Фото сообщения (для альбома — всех его частей); каждый элемент — размеры одного фото
+    album_photos = [m.photo for m in album_messages if m.photo]
+    if media_type is None and album_photos:
+        media_type = "image"
+        media_obj = album_photos[0][-1]
+
     log_text_preview = text[:50] + "..." if len(text) > 50 else text
     log_media_info = f", media_type: {media_type}" if media_type else ""
     logger.info("Received message %d from %s (user_id: %s, chat_id: %s%s): '%s'",
                 message_id, username, message.from_user.id if message.from_user else 'N/A', chat_id, log_media_info, log_text_preview)
 
 
-    # --- Записываем в контекст диалога (используем полученный менеджер) ---
+    # --- Готовим запись для контекста диалога ---
     context_entry_text = text
     if not context_entry_text and media_type:
         context_entry_text = f"[{media_type.capitalize()}]"
-        if media_type == "image" and message.photo and len(message.photo) > 1:
-            context_entry_text = "[Изображения]"
+        if media_type == "image" and len(album_photos) > 1:
+            context_entry_text = f"[Изображения: {len(album_photos)}]"
     elif message.forward_from_chat or message.sender_chat:
          if not context_entry_text:
               context_entry_text = "[Post without text]" # Use English consistently? Or stick to Russian
@@ -130,16 +342,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
               context_entry_text = "[Пост без текста]"
 
 
-    chat_context_manager_instance.add( # <-- Используем инстанс из bot_data
-        chat_id,
-        {
-            "user": username,
-            "text": context_entry_text,
-            "from_bot": False,
-            "message_id": message_id,
-        },
-    )
-    # Менеджер сам следит за MAX_CONTEXT_MESSAGES (сейчас 30)
+    incoming_entry = {
+        "user": username,
+        "text": context_entry_text,
+        "from_bot": False,
+        "message_id": message_id,
+    }
+    # Запись в контекст выполняется после принятия решения об ответе:
+    # так запись и чтение окна для ответа укладываются в один вызов add_and_get.
 
 
     # --- Логика принятия решения об ответе ---
@@ -152,8 +362,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # *** ЛОГИКА ИГНОРИРОВАНИЯ КОММЕНТАРИЕВ ОТ ИМЕНИ КАНАЛА ***
     if is_reply_to_message and sender_is_chat and not sender_is_user:
          logger.info("Ignoring message %d from '%s': Identified as a comment sent as channel in group.", message_id, username)
-         should_respond = False
-         chat_context_manager_instance.remove_last(chat_id) # <-- Используем инстанс из bot_data
+         # Такие сообщения не попадают в контекст вовсе (раньше добавлялись и сразу удалялись через remove_last)
          return
     # ******************************************************
 
@@ -196,41 +405,111 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
              logger.info("Skipping response: Message from %s in group does not match any specific trigger.", username)
 
 
+    # При параллельной обработке обновлений билет ChatSequencer сохраняет порядок записей внутри чата
+    context_summarizer: Optional[ContextSummarizer] = context.bot_data.get("context_summarizer")
+    long_term_memory: Optional[LongTermMemory] = context.bot_data.get("long_term_memory")
+
     if not should_respond:
+        # --- Только записываем в контекст диалога ---
+        async with _in_turn(ticket):
+            await chat_context_manager_instance.add(chat_id, incoming_entry)
+        if long_term_memory is not None:
+            long_term_memory.remember(chat_id, incoming_entry)
         logger.info("Final decision: Not responding to message ID %d from %s.", message_id, username)
         return
 
     logger.info("Proceeding to generate response for message ID %d (trigger: %s, media: %s)", message_id, trigger, media_type or 'none')
+    pipeline_started = time.monotonic()
+    media_label = media_type or "text"
+
+    # Серия быстрых сообщений в личке получает один ответ (на последнее сообщение серии)
+    chat_debouncer: Optional[ChatDebouncer] = context.bot_data.get("chat_debouncer") if trigger == "dm" else None
+    burst_seq = chat_debouncer.arrive(chat_id) if chat_debouncer else None
+
+    # --- Независимые стадии запускаются параллельно: "печатает…", скачивание медиа и запись/чтение контекста ---
+    background_tasks = [
+        asyncio.create_task(_timed_stage("typing", media_label, _send_typing(context, chat_id))),
+    ]
+    media_objs = []
+    if media_type == "image":
+        # Вместо самого большого PhotoSize — наименьший, достаточный для этого триггера (для альбома — каждое фото)
+        target_side = _photo_target_side(context, trigger)
+        media_objs = [select_photo_size(sizes, target_side, trigger) for sizes in album_photos]
+    elif media_obj and media_type in ("video", "audio"):
+        media_objs = [media_obj]
+    # Все файлы (несколько — у альбома) скачиваются параллельно; об ошибках альбома — одно сообщение после всех загрузок
+    is_album = len(media_objs) > 1
+    download_tasks = [
+        asyncio.create_task(_timed_stage(
+            "download", media_label,
+            _download_stage(context, chat_id, message_id, obj, media_type, trigger, notify=not is_album),
+        ))
+        for obj in media_objs
+    ]
+    background_tasks.extend(download_tasks)
 
-
-    # --- Скачивание Медиа ---
-    media_bytes = None
-    mime_type = None
-    if media_obj and media_type in ("image", "video", "audio"):
-        logger.info("Attempting to download media (Type: %s, ID: %s)...", media_type, getattr(media_obj, 'file_id', 'N/A'))
-        try:
-            media_bytes, mime_type = await download_media(media_obj, media_type)
-            logger.info("Media file (ID: %s) downloaded successfully (%d bytes).", getattr(media_obj, 'file_id', 'N/A'), len(media_bytes))
-        except MediaDownloadError as e:
-            logger.error("Error downloading media (ID: %s): %s", getattr(media_obj, 'file_id', 'N/A'), e, exc_info=True)
-            if trigger not in ["random_group_message"]:
-                try:
-                    await context.bot.send_message(
-                        chat_id,
-                        f"(Извини, не смог скачать твой медиафайл ({media_type}). Попробую ответить только на текст, если он был.)",
-                        reply_to_message_id=message_id
-                    )
-                except Exception as send_err:
-                         logger.error("Failed to send media download error message: %s", send_err)
-            media_bytes, mime_type = None, None
+    try:
+        # --- Записываем в контекст диалога и получаем окно для ответа ---
+        # Один round trip: RPUSH + LTRIM + чтение актуального окна контекста.
+        # Менеджер сам следит за размером окна (CONTEXT_MAX_MESSAGES); в промпт его обрежет бюджет токенов
+        async def _context_stage() -> List[Dict[str, Any]]:
+            async with _in_turn(ticket):
+                return await chat_context_manager_instance.add_and_get(chat_id, incoming_entry)
+
+        async def _summary_stage() -> Optional[str]:
+            # Краткое содержание обычно уже в кэше процесса; сжатие новых вытесненных записей — в фоне
+            if context_summarizer is None:
+                return None
+            context_summarizer.notify(chat_id)
+            return await context_summarizer.summary_for(chat_id)
+
+        async def _recall_stage() -> List[MemoryHit]:
+            # Поиск по долгой памяти ограничен своим таймаутом и при превышении просто ничего не добавляет
+            if long_term_memory is None:
+                return []
+            recalled = await long_term_memory.recall(
+                chat_id, text or "", context.bot_data.get("memory_recall_k", 3),
+                timeout=context.bot_data.get("memory_recall_timeout", 0.15),
+            )
+            long_term_memory.remember(chat_id, incoming_entry)
+            return recalled
+
+        context_messages_list, context_summary, recalled = await asyncio.gather(
+            _timed_stage("context", media_label, _context_stage()), _summary_stage(), _recall_stage()
+        )
+        # Окно контекста уже в промпте; найденное в памяти не должно его повторять
+        window_ids = {msg.get("message_id") for msg in context_messages_list}
+        recalled = [hit for hit in recalled if hit.message_id not in window_ids]
+        downloads = [result for result in await asyncio.gather(*download_tasks) if result[0] is not None]
+        if is_album and len(downloads) < len(media_objs):
+            await _notify_download_failed(
+                context, chat_id, message_id, media_type, trigger, failed=len(media_objs) - len(downloads), total=len(media_objs),
+            )
+    except BaseException:
+        # Ранняя стадия упала (или обработку отменили) — остальные стадии больше не нужны
+        for task in background_tasks:
+            task.cancel()
+        if burst_seq is not None:
+            chat_debouncer.release(chat_id, burst_seq)
+        raise
+
+    burst_size = 1
+    if burst_seq is not None:
+        # Сообщение уже в контексте; ждём, не придёт ли следом ещё одно
+        burst_size = await _timed_stage("debounce", media_label, chat_debouncer.wait_quiet(chat_id, burst_seq))
+        if burst_size is None:
+            logger.info("Message ID %d in chat %d is followed by a newer message; one response will cover both.", message_id, chat_id)
+            return
+        if burst_size > 1:
+            logger.info("Responding once to a burst of %d messages in chat %d.", burst_size, chat_id)
 
 
     # --- Генерируем ответ с помощью Gemini API ---
-    # Получаем актуальный контекст диалога из менеджера (используем полученный инстанс)
-    context_messages_list = chat_context_manager_instance.get(chat_id) # <-- Используем инстанс из bot_data
+    # Окно контекста уже получено вместе с записью входящего сообщения (add_and_get)
+    # Все скачанные файлы уходят одним запросом: первый — как основное медиа, остальные — extra_media
+    media_bytes, mime_type = downloads[0] if downloads else (None, None)
 
-    logger.debug("Calling GeminiService.generate_response...")
-    response_text = await gemini_service.generate_response( # <-- Используем инстанс из bot_data
+    generation_kwargs = dict(
         chat_id=chat_id,
         messages=context_messages_list,
         target_message=message,
@@ -239,36 +518,84 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         media_type=media_type if media_bytes else None, # Передаем тип медиа ТОЛЬКО если скачано
         media_bytes=media_bytes,
         mime_type=mime_type,
+        extra_media=downloads[1:],
+        burst_size=burst_size,
+        summary=context_summary,
+        recalled=recalled,
     )
-    logger.debug("Received response_text from GeminiService.")
 
+    async def _generation(coro: Awaitable[T]) -> T:
+        """Генерация, которую отменит новое сообщение той же серии (если серии отслеживаются)."""
+        if burst_seq is None:
+            return await coro
+        return await chat_debouncer.run(chat_id, burst_seq, coro)
+
+    def _check_still_latest() -> None:
+        """Перед отправкой: ответ устарел, если серию продолжило новое сообщение."""
+        if burst_seq is not None and not chat_debouncer.commit(chat_id, burst_seq):
+            raise BurstSuperseded()
 
-    # --- Отправляем текстовой ответ в Telegram ---
-    final_text = filter_technical_info(response_text.strip()) or "..."
-    logger.info("Sending response to chat %d (replying to msg ID %d)...", chat_id, message_id)
     try:
-        sent = await context.bot.send_message(
-            chat_id=chat_id,
-            text=final_text,
-            reply_to_message_id=message_id,
-        )
+        if context.bot_data.get("stream_responses"):
+            # --- Потоковый режим: первый фрагмент отправляется сразу, дальше сообщение редактируется ---
+            logger.debug("Calling GeminiService.stream_response...")
+            chunks = gemini_service.stream_response(**generation_kwargs)
+            # Поток закрывается при любом выходе (вытеснение серией, ошибка отправки): иначе ключ пула
+            # остаётся занятым, а его бюджет — несписанным до сборки генератора мусора
+            async with contextlib.aclosing(chunks):
+                # Ожидание первого фрагмента — основная часть задержки; пока ничего не отправлено, её можно отменить
+                first_chunk = await _generation(chunks.__anext__())
+                _check_still_latest()
+                sent, final_text = await _send_streamed_response(
+                    context,
+                    chat_id,
+                    message_id,
+                    _prepend_chunk(first_chunk, chunks),
+                    edit_interval=context.bot_data.get("stream_edit_interval", STREAM_EDIT_INTERVAL),
+                )
+        else:
+            logger.debug("Calling GeminiService.generate_response...")
+            response_text = await _generation(gemini_service.generate_response(**generation_kwargs)) # <-- Используем инстанс из bot_data
+            logger.debug("Received response_text from GeminiService.")
+            _check_still_latest()
+
+            # --- Отправляем текстовой ответ в Telegram ---
+            final_text = filter_technical_info(response_text.strip()) or "..."
+            logger.info("Sending response to chat %d (replying to msg ID %d)...", chat_id, message_id)
+            sent = await context.bot.send_message(
+                chat_id=chat_id,
+                text=final_text,
+                reply_to_message_id=message_id,
+            )
         logger.info("Response sent successfully. New message ID: %d.", sent.message_id)
 
         # --- Сохраняем ответ бота в контекст диалога (используем полученный менеджер) ---
-        chat_context_manager_instance.add( # <-- Используем инстанс из bot_data
-            chat_id,
-            {
-                "user": "Бот",
-                "text": final_text,
-                "from_bot": True,
-                "message_id": sent.message_id,
-            },
-        )
-
+        bot_entry = {
+            "user": "Бот",
+            "text": final_text,
+            "from_bot": True,
+            "message_id": sent.message_id,
+        }
+        # Ответ встаёт в очередь чата сейчас: после сообщений, пришедших до его отправки, и раньше пришедших позже
+        async with _in_turn(chat_sequencer.ticket(chat_id) if chat_sequencer is not None else None):
+            await chat_context_manager_instance.add(chat_id, bot_entry) # <-- Используем инстанс из bot_data
+        if long_term_memory is not None:
+            long_term_memory.remember(chat_id, bot_entry)
+
+    except SchedulerRejected as e:
+        # Фоновый ответ (случайная реплика) отброшен под нагрузкой — важные запросы идут первыми
+        logger.info("Response to message ID %d in chat %d dropped by scheduler: %s", message_id, chat_id, e)
+        return
+    except BurstSuperseded:
+        # Ответит обработчик более нового сообщения — с учётом этого
+        logger.info("Response to message ID %d in chat %d dropped: superseded by a newer message.", message_id, chat_id)
+        return
     except Exception as send_err:
         logger.error("Error sending response message to chat %d: %s", chat_id, str(send_err), exc_info=True)
+    finally:
+        if burst_seq is not None:
+            chat_debouncer.release(chat_id, burst_seq)
 
-
-    except Exception:
-        logger.exception("An unexpected error occurred in handle_message for update %s", update)
-        # Глобальный error handler в app.py должен поймать это и уведомить пользователя.
+    total_elapsed = time.monotonic() - pipeline_started
+    metrics.observe("handler_stage_seconds", total_elapsed, stage="total", media=media_label)
+    logger.info("Response pipeline for message ID %d (media: %s) took %.3fs.", message_id, media_label, total_elapsed)
@@ -0,0 +1,158 @@
+# ai_lu_bot/services/fake_backend.py
+"""
+Локальная заглушка модели Gemini: отвечает без сети, с заданной задержкой и отказами.
+Нужна, чтобы проверять маршрутизацию по ключам, планировщик, повторы и обработку ошибок без обращения к API
+(GEMINI_BACKEND=fake, а также benchmarks/bench_key_pool.py, benchmarks/bench_resilience.py
+и benchmarks/bench_persona_cache.py — кэш персоны здесь тоже имитируется, со сроком жизни и отказами).
+"""
+import asyncio
+import logging
+import random
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, List, Optional, Union, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class FakeResponse:
+    """Ответ с тем же интерфейсом, что у ответа google.generativeai, который читает GeminiService."""
+    def __init__(self, text: str, total_tokens: int, chunks: Optional[List[str]] = None):
+        self.text = text
+        self.parts = [SimpleNamespace(text=text)]
+        self.prompt_feedback = None
+        self.usage_metadata = SimpleNamespace(total_token_count=total_tokens)
+        self._chunks = chunks or [text]
+        self._chunk_delay = 0.0
+
+    async def _iterate(self) -> AsyncIterator["FakeResponse"]:
+        for chunk in self._chunks:
+            await asyncio.sleep(self._chunk_delay)
+            yield SimpleNamespace(text=chunk)
+
+    def __aiter__(self) -> AsyncIterator["FakeResponse"]:
+        return self._iterate()
+
+
+class FakeCachedContent:
+    """Кэш контента заглушки: имя, системная инструкция и срок жизни (по time.monotonic)."""
+    def __init__(self, name: str, system_instruction: str, ttl: float):
+        self.name = name
+        self.system_instruction = system_instruction
+        self.expires_at = time.monotonic() + ttl
+
+
+class FakeModel:
+    """Модель-заглушка одного бэкенда."""
+    def __init__(
+        self,
+        backend: "FakeModelBackend",
+        config: Any,
+        system_instruction: Optional[str] = None,
+        cached_content: Optional[FakeCachedContent] = None,
+    ):
+        self._backend = backend
+        self._config = config
+        self._system_instruction = system_instruction
+        self._cached_content = cached_content
+
+    async def generate_content_async(self, content: List[Union[str, Dict[str, Any]]], stream: bool = False, **kwargs: Any) -> FakeResponse:
+        backend = self._backend
+        backend.calls += 1
+        slow = backend.slow_rate > 0 and random.random() < backend.slow_rate
+        await asyncio.sleep(backend.slow_latency if slow else backend.latency)
+        if backend.failure is not None and random.random() < backend.failure_rate:
+            backend.failures += 1
+            raise backend.failure
+        prompt_chars = sum(len(part) for part in content if isinstance(part, str))
+        cached = self._cached_content
+        if cached is not None:
+            if time.monotonic() >= cached.expires_at or cached.name not in backend.caches:
+                raise RuntimeError(f"404 CachedContent not found (or expired): {cached.name}")
+            backend.cached_calls += 1
+        elif self._system_instruction is not None:
+            backend.system_calls += 1
+            prompt_chars += len(self._system_instruction)
+        # Сколько символов промпта ушло по сети (персона из кэша не передаётся)
+        backend.sent_chars += prompt_chars
+        if cached is not None:
+            prompt_chars += len(cached.system_instruction)
+        text = f"{backend.reply} [{backend.name}, {getattr(self._config, 'model_name', 'model')}]"
+        response = FakeResponse(text, total_tokens=prompt_chars // 3 + len(text) // 3)
+        if stream:
+            # Поток: слова ответа приходят по одному
+            response._chunks = [word + " " for word in text.split(" ")]
+            response._chunk_delay = backend.chunk_delay
+        return response
+
+
+class FakeModelBackend:
+    """
+    Заглушка для одного "ключа API": задержка ответа и доля отказов задаются явно.
+
+    Args:
+        name: Имя бэкенда (попадает в текст ответа).
+        latency: Задержка перед ответом (секунды).
+        failure: Исключение, которым отвечать на часть запросов (например, RuntimeError("429 quota exceeded")).
+        failure_rate: Доля запросов, завершающихся failure (0..1).
+        chunk_delay: Задержка между фрагментами в потоковом режиме (секунды).
+        slow_rate: Доля запросов с "хвостовой" задержкой slow_latency вместо latency (0..1).
+        slow_latency: Задержка медленных запросов (секунды).
+        cache_supported: Поддерживает ли "API" кэш контента (False — create_cache отвечает ошибкой 400).
+        cache_ttl_cap: Потолок срока жизни кэша (секунды; None — без потолка): кэш может истечь раньше,
+                       чем ждёт клиент, как при ручном удалении на стороне API.
+    """
+    def __init__(
+        self,
+        name: str = "fake",
+        latency: float = 0.05,
+        failure: Optional[Exception] = None,
+        failure_rate: float = 0.0,
+        chunk_delay: float = 0.01,
+        reply: str = "Ну, допустим. Это ответ заглушки, никакого ИИ тут нет.",
+        slow_rate: float = 0.0,
+        slow_latency: float = 1.0,
+        cache_supported: bool = True,
+        cache_ttl_cap: Optional[float] = None,
+    ):
+        self.name = name
+        self.latency = latency
+        self.failure = failure
+        self.failure_rate = failure_rate
+        self.chunk_delay = chunk_delay
+        self.reply = reply
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.cache_supported = cache_supported
+        self.cache_ttl_cap = cache_ttl_cap
+        self.calls = 0
+        self.failures = 0
+        self.cached_calls = 0
+        self.system_calls = 0
+        self.sent_chars = 0
+        self.caches: Dict[str, FakeCachedContent] = {}
+        self.caches_created = 0
+        self.caches_extended = 0
+
+    def model(self, config: Any, system_instruction: Optional[str] = None, cached_content: Optional[FakeCachedContent] = None) -> FakeModel:
+        return FakeModel(self, config, system_instruction, cached_content)
+
+    def _ttl(self, ttl: float) -> float:
+        return ttl if self.cache_ttl_cap is None else min(ttl, self.cache_ttl_cap)
+
+    async def create_cache(self, config: Any, system_instruction: str, ttl: float) -> FakeCachedContent:
+        await asyncio.sleep(self.latency)
+        if not self.cache_supported:
+            raise RuntimeError(f"400 Cached content is not supported for {getattr(config, 'model_name', 'model')}")
+        self.caches_created += 1
+        cached = FakeCachedContent(f"cachedContents/{self.name}-{self.caches_created}", system_instruction, self._ttl(ttl))
+        self.caches[cached.name] = cached
+        return cached
+
+    async def extend_cache(self, handle: FakeCachedContent, ttl: float) -> None:
+        await asyncio.sleep(self.latency)
+        cached = self.caches.get(handle.name)
+        if cached is None or time.monotonic() >= cached.expires_at:
+            raise RuntimeError(f"404 CachedContent not found: {handle.name}")
+        self.caches_extended += 1
+        cached.expires_at = time.monotonic() + self._ttl(ttl)
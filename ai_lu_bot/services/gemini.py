@@ -1,21 +1,226 @@
 # ai_lu_bot/services/gemini.py
+import asyncio
 import logging
 import os
+import time
 import traceback
+from dataclasses import dataclass, replace
 # Импортируем необходимые типы для тайп-хинтинга
-from typing import Any, List, Optional, Union, Dict
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Sequence, Tuple, Union, Dict
 # Импортируем Message из telegram для тайп-хинтинга
 from telegram import Message
 
 import google.generativeai as genai
+from google.generativeai.types import HarmBlockThreshold, HarmCategory
 from dotenv import load_dotenv # Используется здесь для загрузки API_KEY
 
 # Импортируем функцию сборки промпта из нашего пакета
-from ai_lu_bot.core.prompt_builder import build_prompt
+from ai_lu_bot.core.memory_index import MemoryHit
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.core.prompt_builder import (
+    DEFAULT_HISTORY_ENTRY_MAX_TOKENS,
+    DEFAULT_HISTORY_TOKEN_BUDGET,
+    PERSONA_INSTRUCTION,
+    build_prompt,
+    build_summary_prompt,
+)
+from ai_lu_bot.services.key_pool import GeminiKeyPool, GenaiKeyBackend, ModelBackend, PooledKey, is_quota_error, is_server_error, mask_key
+from ai_lu_bot.services.persona_cache import PERSONA_MODES, PersonaCache, is_cache_error
+from ai_lu_bot.services.resilience import CircuitOpenError, ResilientCaller
+from ai_lu_bot.services.scheduler import PRIORITY_BACKGROUND, GeminiScheduler, SchedulerRejected
 
 logger = logging.getLogger(__name__)
 
 
+# --- Конфигурация модели ---
+DEFAULT_MODEL_NAME = "gemini-1.5-flash-latest"
+# Облегчённая модель: случайные реплики в группах и текстовые посты каналов, а также запасной вариант основной
+DEFAULT_LIGHT_MODEL_NAME = "gemini-1.5-flash-8b"
+# Сколько секунд ждать ответа (или первого фрагмента потока) от одной модели цепочки, прежде чем перейти к следующей
+DEFAULT_MODEL_TIMEOUT = 45.0
+DEFAULT_TEMPERATURE = 0.75
+# Пороги безопасности по умолчанию (менее строгие для стиля Лу)
+DEFAULT_SAFETY_THRESHOLDS = {
+    "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
+    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_MEDIUM_AND_ABOVE",
+    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_MEDIUM_AND_ABOVE",
+}
+
+# Пауза для всех запросов после ошибки квоты от API (секунды)
+QUOTA_BACKOFF_SECONDS = 30.0
+RATE_LIMITED_TEXT = "(Всё, приехали. Лимит запросов к ИИ исчерпан. Видимо, слишком много умных мыслей на сегодня. Попробуй позже.)"
+
+
+def _estimate_tokens(content: List[Union[str, Dict[str, Any]]]) -> int:
+    """
+    Грубая оценка входных токенов запроса для лимита TPM (уточняется по usage_metadata ответа):
+    ~3 символа текста на токен, фиксированная цена картинки, аудио и видео — по размеру файла.
+    """
+    total = 0
+    for part in content:
+        if isinstance(part, str):
+            total += len(part) // 3
+        elif part.get("mime_type", "").startswith("image/"):
+            total += 258
+        elif part.get("mime_type", "").startswith("audio/"):
+            total += len(part["data"]) // 64 # ~32 токена на секунду Opus ~16 кбит/с
+        else:
+            total += len(part["data"]) // 400 # ~263 токена на секунду видео-кружка
+    return total
+
+
+def _usage_tokens(response: Any) -> Optional[int]:
+    """Фактический расход токенов из ответа модели, если SDK его вернул."""
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) or None
+
+
+@dataclass(frozen=True)
+class ModelConfig:
+    """
+    Неизменяемое описание модели и настроек запроса. Используется как ключ реестра клиентов,
+    поэтому одинаковые конфигурации разделяют один долгоживущий GenerativeModel.
+    """
+    model_name: str = DEFAULT_MODEL_NAME
+    temperature: float = DEFAULT_TEMPERATURE
+    safety_thresholds: Tuple[Tuple[str, str], ...] = tuple(DEFAULT_SAFETY_THRESHOLDS.items())
+
+    @classmethod
+    def from_env(cls) -> "ModelConfig":
+        """
+        Читает конфигурацию из окружения: GEMINI_MODEL, GEMINI_TEMPERATURE и
+        GEMINI_SAFETY_<КАТЕГОРИЯ> (например, GEMINI_SAFETY_HARASSMENT=BLOCK_ONLY_HIGH).
+        """
+        thresholds = tuple(
+            (category, os.getenv(f"GEMINI_SAFETY_{category.removeprefix('HARM_CATEGORY_')}", threshold).upper())
+            for category, threshold in DEFAULT_SAFETY_THRESHOLDS.items()
+        )
+        return cls(
+            model_name=os.getenv("GEMINI_MODEL", DEFAULT_MODEL_NAME),
+            temperature=float(os.getenv("GEMINI_TEMPERATURE", DEFAULT_TEMPERATURE)),
+            safety_thresholds=thresholds,
+        )
+
+    def build_model(self, system_instruction: Optional[str] = None, cached_content: Any = None) -> genai.GenerativeModel:
+        """
+        Создаёт клиент модели с заранее провалидированными настройками.
+        Неизвестная категория или порог безопасности приводят к ValueError при старте, а не в момент ответа.
+
+        Args:
+            system_instruction: Системная инструкция модели (персона), если она не в тексте запроса.
+            cached_content: Кэш контента API (genai.caching.CachedContent) с системной инструкцией.
+        """
+        try:
+            safety_settings = {
+                HarmCategory[category]: HarmBlockThreshold[threshold]
+                for category, threshold in self.safety_thresholds
+            }
+        except KeyError as e:
+            raise ValueError(f"Invalid Gemini safety setting {e} in {self}") from e
+        generation_config = genai.GenerationConfig(temperature=self.temperature)
+        if cached_content is not None:
+            return genai.GenerativeModel.from_cached_content(
+                cached_content, safety_settings=safety_settings, generation_config=generation_config,
+            )
+        return genai.GenerativeModel(
+            self.model_name,
+            safety_settings=safety_settings,
+            generation_config=generation_config,
+            system_instruction=system_instruction,
+        )
+
+
+# Цепочка моделей: первая — основная, остальные — запасные на случай ошибки или таймаута
+ModelChain = Tuple[ModelConfig, ...]
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    """Правило маршрутизации: для каких триггеров и типов медиа (пусто — для любых) какая цепочка моделей."""
+    triggers: frozenset
+    media_types: frozenset
+    chain: ModelChain
+
+    def matches(self, trigger: Optional[str], media_type: str) -> bool:
+        return (not self.triggers or trigger in self.triggers) and (not self.media_types or media_type in self.media_types)
+
+
+class ModelRouter:
+    """
+    Таблица маршрутизации запросов по моделям: первое подходящее правило (по триггеру ответа
+    и типу медиа: 'text', 'image', 'audio', 'video') задаёт цепочку моделей, иначе используется цепочка по умолчанию.
+    """
+    def __init__(self, routes: Sequence[ModelRoute], default_chain: ModelChain):
+        if not default_chain:
+            raise ValueError("ModelRouter needs a non-empty default model chain")
+        self.routes = tuple(routes)
+        self.default_chain = tuple(default_chain)
+
+    def chain_for(self, trigger: Optional[str], media_type: Optional[str]) -> ModelChain:
+        media = media_type or "text"
+        for route in self.routes:
+            if route.matches(trigger, media):
+                return route.chain
+        return self.default_chain
+
+    def configs(self) -> List[ModelConfig]:
+        """Все конфигурации моделей таблицы (без повторов) — для создания клиентов при старте."""
+        seen: Dict[ModelConfig, None] = {}
+        for chain in [route.chain for route in self.routes] + [self.default_chain]:
+            for config in chain:
+                seen.setdefault(config, None)
+        return list(seen)
+
+    @staticmethod
+    def parse_chain(spec: str, base: ModelConfig) -> ModelChain:
+        """'model[@температура]>model[@температура]' → цепочка конфигураций на основе base."""
+        chain = []
+        for item in spec.split(">"):
+            name, _, temperature = item.strip().partition("@")
+            if not name:
+                raise ValueError(f"Empty model name in chain '{spec}'")
+            chain.append(replace(base, model_name=name, temperature=float(temperature) if temperature else base.temperature))
+        return tuple(chain)
+
+    @classmethod
+    def from_env(cls, base: ModelConfig) -> "ModelRouter":
+        """
+        Таблица из окружения. GEMINI_ROUTES — правила через ';' вида
+        'триггер[,триггер][:медиа[,медиа]]=модель[@t]>модель[@t]' ('*' — любые триггеры и цепочка по умолчанию), например:
+        'random_group_message=gemini-1.5-flash-8b>gemini-1.5-flash-latest; *=gemini-1.5-pro>gemini-1.5-flash-latest'.
+        Без GEMINI_ROUTES: облегчённая модель GEMINI_LIGHT_MODEL для случайных реплик, текстовых постов каналов
+        и сжатия контекста, основная (GEMINI_MODEL) — для остального; каждая служит запасной для другой.
+        """
+        light = replace(base, model_name=os.getenv("GEMINI_LIGHT_MODEL", DEFAULT_LIGHT_MODEL_NAME))
+        light_chain: ModelChain = (light, base) if light != base else (base,)
+        default_chain: ModelChain = (base, light) if light != base else (base,)
+        spec = os.getenv("GEMINI_ROUTES", "").strip()
+        if not spec:
+            return cls(
+                [
+                    ModelRoute(frozenset({"random_group_message", "context_summary"}), frozenset(), light_chain),
+                    ModelRoute(frozenset({"channel_post_forwarded_or_sent_as"}), frozenset({"text"}), light_chain),
+                ],
+                default_chain,
+            )
+
+        routes = []
+        for rule in filter(None, (part.strip() for part in spec.split(";"))):
+            selector, _, chain_spec = rule.partition("=")
+            triggers, _, media = selector.strip().partition(":")
+            chain = cls.parse_chain(chain_spec, base)
+            if triggers.strip() == "*" and not media:
+                default_chain = chain
+                continue
+            routes.append(ModelRoute(
+                frozenset(t.strip() for t in triggers.split(",") if t.strip() and t.strip() != "*"),
+                frozenset(m.strip() for m in media.split(",") if m.strip()),
+                chain,
+            ))
+        return cls(routes, default_chain)
+
+
 class GeminiService:
     """
     Обёртка над google.generativeai API.
@@ -23,60 +228,248 @@ class GeminiService:
     Используется как синглтон (один инстанс на всё приложение).
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        model_config: Optional[ModelConfig] = None,
+        scheduler: Optional[GeminiScheduler] = None,
+        key_pool: Optional[GeminiKeyPool] = None,
+        router: Optional[ModelRouter] = None,
+        model_timeout: float = DEFAULT_MODEL_TIMEOUT,
+        resilience: Optional[ResilientCaller] = None,
+        history_token_budget: int = DEFAULT_HISTORY_TOKEN_BUDGET,
+        history_entry_max_tokens: int = DEFAULT_HISTORY_ENTRY_MAX_TOKENS,
+        persona_mode: str = "cached",
+        persona_cache: Optional[PersonaCache] = None,
+    ):
         """
-        Инициализирует сервис Gemini, загружает API ключ и конфигурирует SDK.
+        Инициализирует сервис Gemini, загружает API ключ, конфигурирует SDK
+        и заранее создаёт клиент модели по умолчанию.
         Вызывает RuntimeError при отсутствии API ключа или ошибке конфигурации.
+
+        Args:
+            model_config: Модель и настройки генерации. По умолчанию читаются из окружения (ModelConfig.from_env).
+            scheduler: Планировщик запросов (лимиты RPM/TPM и приоритеты). None — запросы уходят сразу.
+            key_pool: Пул ключей API. По умолчанию — пул из одного ключа API_KEY.
+            router: Таблица выбора моделей по триггеру и типу медиа. По умолчанию — ModelRouter.from_env(model_config).
+            model_timeout: Сколько секунд ждать одну попытку модели цепочки (если resilience не передан).
+            resilience: Сроки по триггерам, повторы, хеджирование и автоматы отключения моделей.
+                        По умолчанию — ResilientCaller с таймаутом попытки model_timeout.
+            history_token_budget: Сколько токенов истории переписки попадает в промпт (см. build_prompt).
+            history_entry_max_tokens: Потолок одной записи истории в промпте.
+            persona_mode: Как модель получает персону (Блоки 1-5 промпта): 'inline' — в тексте каждого запроса,
+                          'system' — отдельной system instruction, 'cached' — через кэш контента API
+                          (пока кэша нет или API его не поддерживает — как 'system').
+            persona_cache: Кэш персоны для режима 'cached'. По умолчанию — PersonaCache с настройками по умолчанию.
         """
-        # Убедимся, что переменные окружения загружены (хотя load_dotenv вызывается и в app.py)
-        load_dotenv()
-        api_key = os.getenv("API_KEY")
-        if not api_key:
-            # Это критическая ошибка, без ключа API сервис не работает
-            logger.critical("GeminiService: API_KEY не найден в переменных окружения!")
-            raise RuntimeError("API_KEY not found in environment")
+        if key_pool is None:
+            # Убедимся, что переменные окружения загружены (хотя load_dotenv вызывается и в app.py)
+            load_dotenv()
+            api_key = os.getenv("API_KEY")
+            if not api_key:
+                # Это критическая ошибка, без ключа API сервис не работает
+                logger.critical("GeminiService: API_KEY не найден в переменных окружения!")
+                raise RuntimeError("API_KEY not found in environment")
+            try:
+                # Клиенты SDK привязываются к ключу, а не настраиваются глобально через genai.configure
+                key_pool = GeminiKeyPool([GenaiKeyBackend(api_key)], labels=[mask_key(api_key)])
+                logger.info("GeminiService: Google Generative AI SDK configured successfully.")
+            except Exception as e:
+                # Логируем и перебрасываем исключение, если конфигурация не удалась
+                logger.critical(f"GeminiService: Failed to configure Google Generative AI SDK: {e}", exc_info=True)
+                raise RuntimeError(f"Failed to configure Google Generative AI SDK: {e}")
 
+        self.key_pool = key_pool
+        self.scheduler = scheduler
+        self.model_config = model_config or ModelConfig.from_env()
+        self.router = router or ModelRouter.from_env(self.model_config)
+        self.model_timeout = model_timeout
+        self.resilience = resilience or ResilientCaller(attempt_timeout=model_timeout)
+        self.history_token_budget = history_token_budget
+        self.history_entry_max_tokens = history_entry_max_tokens
+        if persona_mode not in PERSONA_MODES:
+            raise ValueError(f"Unknown persona mode '{persona_mode}', expected one of {PERSONA_MODES}")
+        self.persona_mode = persona_mode
+        self.persona_cache = (persona_cache or PersonaCache(PERSONA_INSTRUCTION)) if persona_mode == "cached" else None
+        # Персона вне текста запроса всё равно входит в расход токенов (лимит TPM)
+        self._persona_tokens = _estimate_tokens([PERSONA_INSTRUCTION]) if persona_mode != "inline" else 0
         try:
-            # Конфигурируем Google Generative AI SDK с помощью ключа
-            genai.configure(api_key=api_key)
-            logger.info("GeminiService: Google Generative AI SDK configured successfully.")
+            # Клиенты всех моделей таблицы создаются заранее для каждого ключа: ошибки настроек видны при старте
+            for key in self.key_pool.keys:
+                for config in self.router.configs():
+                    key.backend.model(config)
+                    if persona_mode != "inline":
+                        key.backend.model(config, system_instruction=PERSONA_INSTRUCTION)
         except Exception as e:
-            # Логируем и перебрасываем исключение, если конфигурация не удалась
-            logger.critical(f"GeminiService: Failed to configure Google Generative AI SDK: {e}", exc_info=True)
-            raise RuntimeError(f"Failed to configure Google Generative AI SDK: {e}")
+            logger.critical(f"GeminiService: Failed to create model client for {self.model_config}: {e}", exc_info=True)
+            raise RuntimeError(f"Failed to create Gemini model client: {e}")
 
 
-    async def generate_response(
+    def warm_persona_cache(self) -> None:
+        """Запускает фоновое создание кэша персоны для всех ключей и моделей (режим 'cached'; вызывается в event loop)."""
+        if self.persona_cache is None:
+            return
+        for key in self.key_pool.keys:
+            for config in self.router.configs():
+                self.persona_cache.warm(key.backend, config)
+
+
+    async def _generate(
         self,
-        chat_id: int, # ID чата для логирования/контекста
-        messages: List[Dict[str, Any]], # Список сообщений для контекста диалога
-        target_message: Message, # Объект целевого сообщения
-        trigger: str, # Тип триггера ответа
-        replied_to_message: Optional[Message] = None, # Объект сообщения, на которое ответили (опционально)
-        media_type: Optional[str] = None, # Тип медиа в целевом сообщении (если скачано)
-        media_bytes: Optional[bytes] = None, # Байты медиа (если скачано)
-        mime_type: Optional[str] = None, # MIME тип медиа (если скачано)
-    ) -> str:
+        backend: ModelBackend,
+        config: ModelConfig,
+        content: List[Union[str, Dict[str, Any]]],
+        stream: bool,
+        persona: bool,
+        admit: Optional[Callable[[], bool]] = None,
+    ) -> Any:
         """
-        Генерирует текстовый ответ с помощью Google Gemini API.
-        Формирует промпт из контекста диалога и информации о комментируемом посте (если есть).
-        Включает медиафайл в запрос, если он был успешно скачан.
-        Обрабатывает ошибки API и блокировки контента.
+        Один запрос к модели; persona=True — персона передаётся модели отдельно от content (если не режим 'inline').
+        admit разрешает повторную отправку после отказа кэша персоны (None — без ограничений).
+        """
+        if not persona or self.persona_mode == "inline":
+            return await backend.model(config).generate_content_async(content, stream=stream)
+        if self.persona_cache is None:
+            return await backend.model(config, system_instruction=PERSONA_INSTRUCTION).generate_content_async(content, stream=stream)
+        model, cached = self.persona_cache.model(backend, config)
+        try:
+            return await model.generate_content_async(content, stream=stream)
+        except Exception as e:
+            if not cached or not is_cache_error(e) or (admit is not None and not admit()):
+                raise
+            # Кэш персоны отвергнут API (истёк или удалён) — тот же запрос сразу уходит с system instruction
+            self.persona_cache.invalidate(backend, config)
+            return await backend.model(config, system_instruction=PERSONA_INSTRUCTION).generate_content_async(content, stream=stream)
 
-        Args:
-            chat_id: ID чата.
-            messages: Список словарей с историей диалога.
-            target_message: Объект telegram.Message целевого сообщения.
-            trigger: Строка, описывающая триггер ответа.
-            replied_to_message: Объект telegram.Message, на который отвечает target_message, или None.
-            media_type: Тип медиа в target_message ('image', 'audio', 'video') или None.
-                        Передается, только если медиа успешно скачано.
-            media_bytes: Байты медиафайла. Передается, только если медиа успешно скачано.
-            mime_type: MIME тип медиа. Передается, только если медиа успешно скачано.
 
-        Returns:
-            Строка с сгенерированным ответом или сообщением об ошибке/блокировке.
+    async def _call_model(
+        self,
+        config: ModelConfig,
+        content: List[Union[str, Dict[str, Any]]],
+        estimated_tokens: int,
+        stream: bool = False,
+        persona: bool = False,
+        admit: Optional[Callable[[], bool]] = None,
+    ) -> Tuple[PooledKey, Any]:
+        """
+        Отправляет запрос на ключ пула с наибольшим остатком бюджета. Если ключ упёрся в квоту или 5xx,
+        он уходит на скамейку, а запрос один раз повторяется на другом ключе (если admit разрешает ещё один вызов).
+        persona=True — запрос ответа Лу: персона передаётся по persona_mode (см. _generate).
+        Возвращает (ключ, ответ SDK); вызывающий обязан вернуть ключ через key_pool.release().
+        """
+        tried: List[PooledKey] = []
+        attempts = min(2, len(self.key_pool))
+        for attempt in range(attempts):
+            key = self.key_pool.acquire(estimated_tokens, exclude=tried)
+            tried.append(key)
+            try:
+                # Клиент модели с настройками безопасности и генерации берётся из реестра ключа
+                return key, await self._generate(key.backend, config, content, stream, persona, admit)
+            except BaseException as e:
+                self.key_pool.release(key, estimated_tokens, error=e)
+                if not isinstance(e, Exception):
+                    raise
+                retriable = is_quota_error(e) or is_server_error(e)
+                if retriable and attempt + 1 < attempts and (admit is None or admit()):
+                    logger.warning("Gemini request failed on %s (%s), retrying on another key.", key.label, e)
+                    continue
+                if is_quota_error(e) and self.scheduler is not None and self.key_pool.available() == 0:
+                    # Квота исчерпана на всех ключах — остальные запросы подождут в очереди планировщика
+                    self.scheduler.backoff(QUOTA_BACKOFF_SECONDS)
+                raise
+        raise RuntimeError("unreachable")
+
+
+    async def _call_chain(
+        self,
+        trigger: str,
+        media_type: Optional[str],
+        content: List[Union[str, Dict[str, Any]]],
+        estimated_tokens: int,
+        stream: bool = False,
+        persona: bool = False,
+    ) -> Tuple[PooledKey, Any]:
+        """
+        Отправляет запрос по цепочке моделей, выбранной таблицей маршрутизации. Каждая модель вызывается
+        через ResilientCaller: повторы при таймаутах и 5xx, хеджирование (кроме потоков — их второй запрос
+        не отменить без утечки) и автомат отключения. Если модель так и не ответила или её автомат открыт,
+        запрос уходит следующей модели; все попытки укладываются в общий срок триггера.
+        Первый вызов API оплачен допуском планировщика (_admit), каждый следующий списывается отдельно (_extra_call).
+        Ошибка последней модели пробрасывается. В метрики пишется, какой уровень цепочки ответил, и задержка ответа.
         """
+        chain = self.router.chain_for(trigger, media_type)
+        deadline = self.resilience.deadline_for(trigger)
+        sent = 0 # Сколько попыток уже запущено; первая оплачена в _admit
+
+        def admit() -> bool:
+            return self._extra_call(trigger, estimated_tokens)
+
+        def attempt(config: ModelConfig) -> Awaitable[Tuple[PooledKey, Any]]:
+            nonlocal sent
+            sent += 1
+            return self._call_model(config, content, estimated_tokens, stream=stream, persona=persona, admit=admit)
+
+        for tier, config in enumerate(chain):
+            started = time.monotonic()
+            try:
+                key, response = await self.resilience.call(
+                    config.model_name,
+                    lambda config=config: attempt(config),
+                    deadline,
+                    hedge=not stream,
+                    # Ответ проигравшего хеджированного запроса не используется — ключ возвращается в пул
+                    discard=lambda result: self.key_pool.release(result[0], estimated_tokens),
+                    admit=admit,
+                )
+            except Exception as e:
+                elapsed = time.monotonic() - started
+                outcome = (
+                    "timeout" if isinstance(e, asyncio.TimeoutError)
+                    else "circuit_open" if isinstance(e, CircuitOpenError)
+                    else "error"
+                )
+                metrics.inc("gemini_model_requests", model=config.model_name, tier=tier, result=outcome)
+                if outcome != "circuit_open":
+                    metrics.observe("gemini_model_latency_seconds", elapsed, model=config.model_name, tier=tier)
+                if tier + 1 >= len(chain):
+                    raise
+                if sent and not admit():
+                    # Запасная модель — ещё один вызов API, а лимитов на него сейчас нет
+                    logger.warning(
+                        "Gemini model %s (tier %d) failed for trigger '%s' (%s); no rate limit budget to fall back to %s.",
+                        config.model_name, tier, trigger, outcome if outcome == "timeout" else e, chain[tier + 1].model_name,
+                    )
+                    raise
+                logger.warning(
+                    "Gemini model %s (tier %d) failed for trigger '%s' after %.1fs (%s), falling back to %s.",
+                    config.model_name, tier, trigger, elapsed, outcome if outcome == "timeout" else e, chain[tier + 1].model_name,
+                )
+                continue
+            elapsed = time.monotonic() - started
+            metrics.inc("gemini_model_requests", model=config.model_name, tier=tier, result="ok")
+            metrics.observe("gemini_model_latency_seconds", elapsed, model=config.model_name, tier=tier)
+            logger.debug("Gemini model %s (tier %d) answered for trigger '%s' in %.2fs.", config.model_name, tier, trigger, elapsed)
+            return key, response
+        raise RuntimeError("Empty model chain")
+
+
+    def _build_content(
+        self,
+        chat_id: int,
+        messages: List[Dict[str, Any]],
+        target_message: Message,
+        trigger: str,
+        replied_to_message: Optional[Message],
+        media_type: Optional[str],
+        media_bytes: Optional[Union[bytes, memoryview]],
+        mime_type: Optional[str],
+        extra_media: Optional[Sequence[Tuple[Union[bytes, memoryview], str]]] = None,
+        burst_size: int = 1,
+        summary: Optional[str] = None,
+        recalled: Optional[Sequence[MemoryHit]] = None,
+    ) -> List[Union[str, Dict[str, Any]]]:
+        """Собирает список частей запроса: текстовый промпт и (опционально) медиафайлы."""
+        media_parts = [(media_bytes, mime_type)] if media_bytes and mime_type else []
+        media_parts.extend((data, mime) for data, mime in (extra_media or ()) if data and mime)
         # Формируем текстовую часть промпта с использованием build_prompt
         # build_prompt принимает все данные, необходимые для создания текстового промпта
         text_prompt_part_str = build_prompt(
@@ -88,109 +481,298 @@ class GeminiService:
             media_type=media_type, # Передаем тип медиа (нужен build_prompt для текстового маркера)
             # media_bytes здесь не нужен build_prompt, но в сигнатуре он есть, пробрасываем None
             # Если сигнатура build_prompt будет изменена, можно убрать media_bytes
-            media_data_bytes=None # У build_prompt есть этот аргумент, но он не используется для текста промпта
+            media_data_bytes=None, # У build_prompt есть этот аргумент, но он не используется для текста промпта
+            image_count=max(len(media_parts), 1), # Сколько изображений альбома реально прикреплено
+            burst_size=burst_size, # Сколько последних сообщений покрывает ответ
+            history_token_budget=self.history_token_budget, # История набирается по бюджету токенов, а не по числу сообщений
+            history_entry_max_tokens=self.history_entry_max_tokens,
+            summary=summary, # Краткое содержание вытесненной из окна переписки
+            recalled=recalled, # Давние сообщения из долгой памяти, похожие на целевое
+            include_persona=self.persona_mode == "inline", # Иначе персона уходит модели отдельно (см. _generate)
         )
 
         # Собираем список "частей" для запроса к Gemini API
         # Первая часть - всегда текстовый промпт
         content: List[Union[str, Dict[str, Any]]] = [text_prompt_part_str]
 
-        # Вторая часть (опционально) - медиафайл, если он есть и был скачан
-        if media_bytes and mime_type:
+        # Следующие части (опционально) - медиафайлы, если они есть и были скачаны (несколько — для альбома)
+        for part_bytes, part_mime in media_parts:
             try:
                 media_part_dict = {
-                    "mime_type": mime_type,
-                    "data": media_bytes
+                    "mime_type": part_mime,
+                    # Медиа приходит как memoryview (буфер загрузки или mmap). Protobuf-поле Blob.data
+                    # принимает только bytes, поэтому единственная копия делается здесь, на границе SDK.
+                    "data": part_bytes if isinstance(part_bytes, bytes) else bytes(part_bytes)
                 }
                 content.append(media_part_dict)
-                logger.debug("Added media part (%s, %d bytes) to Gemini request content.", mime_type, len(media_bytes))
+                logger.debug("Added media part (%s, %d bytes) to Gemini request content.", part_mime, len(part_bytes))
             except Exception as part_err:
                  # Это крайне маловероятная ошибка, но лучше залогировать
                  logger.error("Critical error creating dict for media part: %s", part_err, exc_info=True)
                  # Не добавляем медиа часть в контент, если ошибка
 
+        return content
+
+
+    def _extract_text(self, response: Any) -> str:
+        """Извлекает текст из ответа Gemini, превращая блокировки и кривые ответы в сообщения в стиле Лу."""
+        # --- Извлечение текста ответа и обработка блокировок ---
+        extracted_text = ""
+        try:
+            # Попытка получить текст ответа напрямую
+            if response.text:
+                 extracted_text = response.text.strip() # Удаляем лишние пробелы по краям
+                 logger.debug("Successfully extracted text from Gemini response.")
+            # Проверка на блокировку API по причинам безопасности (prompt_feedback)
+            elif getattr(response, 'prompt_feedback', None) and getattr(response.prompt_feedback, 'block_reason', None):
+                reason = response.prompt_feedback.block_reason
+                logger.warning("Gemini API response blocked by safety settings. Reason: %s", reason)
+                # Формируем сообщение об ошибке в стиле Лу
+                extracted_text = f"(Так, стоп. Мой ответ завернули из-за цензуры – причина '{reason}'. Видимо, слишком честно или резко получилось для их нежных алгоритмов. Ну и хрен с ними.)"
+            # Если текст отсутствует и нет явной блокировки (неожиданное состояние)
+            else:
+                logger.warning("Gemini API returned response without text and no explicit block reason. Response: %s", response)
+                # Попытка собрать текст из частей ответа, если они есть
+                parts = getattr(response, 'parts', [])
+                extracted_text = "".join(getattr(part, 'text', '') for part in parts).strip()
+                if not extracted_text:
+                     logger.error("Failed to extract text from Gemini response parts, response structure is undefined.")
+                     extracted_text = "(Хм, что-то пошло не так с генерацией. Даже сказать нечего. ИИ молчит как партизан.)"
+                else:
+                     logger.debug("Extracted text from Gemini response parts.")
+
+        except AttributeError as attr_err:
+            # Ошибка доступа к атрибутам объекта response
+            logger.error("AttributeError extracting text from Gemini response: %s. Response: %s", attr_err, response, exc_info=True)
+            extracted_text = "(Черт, не могу разобрать, что там ИИ нагенерил. Техника барахлит, или ответ какой-то кривой пришел.)"
+        except Exception as parse_err:
+            # Любая другая неожиданная ошибка при обработке ответа
+            logger.error("Unexpected error extracting text from Gemini response: %s. Response: %s", parse_err, response, exc_info=True)
+            extracted_text = "(Какая-то хуйня с обработкой ответа ИИ. Забей, видимо, не судьба.)"
+
+        return extracted_text # Возвращаем извлеченный текст или сообщение об ошибке
+
+
+    def _api_error_text(self, e: Exception) -> str:
+        """Сообщение об ошибке вызова Gemini API в стиле Лу."""
+        err_str = str(e).lower()
+        # Формируем специфичные сообщения об ошибках API в стиле Лу
+        if "api key not valid" in err_str:
+            # Эта ошибка должна по идее ловиться при инициализации, но дублируем на всякий случай
+            return "(Бляха, ключ API неверен или истёк.)"
+        if is_quota_error(e) or "limit" in err_str:
+            # Для текста пользователю достаточно широкого совпадения: любой упомянутый лимит — "лимит исчерпан"
+            return RATE_LIMITED_TEXT
+        if any(k in err_str for k in ("503", "internal server", "service unavailable")):
+            return "(Серверы ИИ, похоже, легли отдохнуть. Или от моего сарказма перегрелись. Позже попробуй.)"
+        if isinstance(e, asyncio.TimeoutError) or any(k in err_str for k in ("timeout", "deadline")):
+            return "(Что-то ИИ долго думает, аж время вышло. Видимо, вопрос слишком сложный... или серваки тупят.)"
+        if "model not found" in err_str:
+            return "(Модель, которой я должен думать, сейчас недоступна. Может, на техобслуживании? Попробуй позже, если не лень.)"
+        if "block" in err_str or "safety" in err_str or "filtered" in err_str:
+             # Эта ошибка может возникнуть и на этапе отправки промпта, а не только в ответе
+             return "(Опять цензура! Мой гениальный запрос заблокировали еще на подлете из-за каких-то их правил безопасности. Неженки.)"
+        # Общее сообщение для всех остальных ошибок API
+        return "(Какая-то техническая засада с ИИ. Не сегодня, видимо. Попробуй позже.)"
+
+
+    def _extra_call(self, trigger: str, estimated_tokens: int) -> bool:
+        """Списывает с планировщика ещё один вызов API того же запроса (повтор, хедж, запасная модель, другой ключ)."""
+        return self.scheduler is None or self.scheduler.try_acquire(trigger, estimated_tokens)
+
+
+    async def _admit(self, trigger: str, media_type: Optional[str], estimated_tokens: int) -> Optional[str]:
+        """
+        Ждёт разрешения планировщика на запрос. Возвращает None, если запрос можно отправлять,
+        или текст отказа для важных запросов. Отказ фоновому запросу пробрасывается как SchedulerRejected:
+        такие ответы под нагрузкой просто не отправляются. Если автоматы всех моделей цепочки открыты,
+        отказ возвращается сразу, не занимая очередь планировщика.
+        """
+        chain = self.router.chain_for(trigger, media_type)
+        if all(self.resilience.is_open(config.model_name) for config in chain):
+            logger.warning("All models for trigger '%s' are failing fast (circuit open), not calling Gemini.", trigger)
+            return self._api_error_text(CircuitOpenError(chain[-1].model_name, 0))
+        if self.scheduler is None:
+            return None
+        try:
+            await self.scheduler.acquire(trigger, estimated_tokens)
+            return None
+        except SchedulerRejected as e:
+            if e.priority >= PRIORITY_BACKGROUND:
+                raise
+            return RATE_LIMITED_TEXT
+
+
+    async def generate_response(
+        self,
+        chat_id: int, # ID чата для логирования/контекста
+        messages: List[Dict[str, Any]], # Список сообщений для контекста диалога
+        target_message: Message, # Объект целевого сообщения
+        trigger: str, # Тип триггера ответа
+        replied_to_message: Optional[Message] = None, # Объект сообщения, на которое ответили (опционально)
+        media_type: Optional[str] = None, # Тип медиа в целевом сообщении (если скачано)
+        media_bytes: Optional[Union[bytes, memoryview]] = None, # Байты медиа (если скачано)
+        mime_type: Optional[str] = None, # MIME тип медиа (если скачано)
+        extra_media: Optional[Sequence[Tuple[Union[bytes, memoryview], str]]] = None, # Остальные фото альбома
+        burst_size: int = 1, # Сколько последних сообщений пользователя подряд покрывает ответ
+        summary: Optional[str] = None, # Краткое содержание ранней переписки чата
+        recalled: Optional[Sequence[MemoryHit]] = None, # Давние сообщения, найденные в долгой памяти
+    ) -> str:
+        """
+        Генерирует текстовый ответ с помощью Google Gemini API.
+        Формирует промпт из контекста диалога и информации о комментируемом посте (если есть).
+        Включает медиафайл в запрос, если он был успешно скачан.
+        Обрабатывает ошибки API и блокировки контента.
+
+        Args:
+            chat_id: ID чата.
+            messages: Список словарей с историей диалога.
+            target_message: Объект telegram.Message целевого сообщения.
+            trigger: Строка, описывающая триггер ответа.
+            replied_to_message: Объект telegram.Message, на который отвечает target_message, или None.
+            media_type: Тип медиа в target_message ('image', 'audio', 'video') или None.
+                        Передается, только если медиа успешно скачано.
+            media_bytes: Байты медиафайла. Передается, только если медиа успешно скачано.
+            mime_type: MIME тип медиа. Передается, только если медиа успешно скачано.
+            extra_media: Остальные скачанные медиафайлы альбома [(данные, mime_type), ...];
+                         все они уходят одним запросом вместе с media_bytes.
+            burst_size: Сколько последних сообщений пользователя (серия подряд) покрывает один ответ.
+            summary: Краткое содержание переписки, вытесненной из окна контекста (services/summarizer.py).
+            recalled: Давние сообщения чата, релевантные целевому (core/memory_index.py).
+
+        Returns:
+            Строка с сгенерированным ответом или сообщением об ошибке/блокировке.
+
+        Raises:
+            SchedulerRejected: Фоновый запрос (случайная реплика в группе) отброшен планировщиком под нагрузкой.
+        """
+        content = self._build_content(
+            chat_id, messages, target_message, trigger, replied_to_message, media_type, media_bytes, mime_type, extra_media, burst_size,
+            summary, recalled,
+        )
+        estimated_tokens = _estimate_tokens(content) + self._persona_tokens
+        rejection_text = await self._admit(trigger, media_type, estimated_tokens)
+        if rejection_text is not None:
+            return rejection_text
 
         # --- Вызов Gemini API ---
         try:
-            # Используем модель gemini-1.5-flash-latest
-            model = genai.GenerativeModel("gemini-1.5-flash-latest")
-            logger.debug("Calling Gemini API with %d parts...", len(content))
-
-            # Настройки безопасности (можно настроить по желанию)
-            safety_settings=[
-                 {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"}, # Менее строгие для стиля Лу
-                 {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                 {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                 {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            ]
-            # Настройки генерации (температура влияет на креативность)
-            generation_config={"temperature": 0.75}
-
-            # Отправляем запрос на генерацию контента
-            response = await model.generate_content_async(
-                 content,
-                 safety_settings=safety_settings,
-                 generation_config=generation_config,
-                 # request_options={'timeout': 120} # Пример настройки таймаута (зависит от версии библиотеки)
-            )
+            logger.debug("Calling Gemini API (trigger %s) with %d parts...", trigger, len(content))
 
-            logger.debug("Received raw response from Gemini API.")
+            # Отправляем запрос по цепочке моделей для этого триггера, через пул ключей
+            key, response = await self._call_chain(trigger, media_type, content, estimated_tokens, persona=True)
 
-            # --- Извлечение текста ответа и обработка блокировок ---
-            extracted_text = ""
-            try:
-                # Попытка получить текст ответа напрямую
-                if response.text:
-                     extracted_text = response.text.strip() # Удаляем лишние пробелы по краям
-                     logger.debug("Successfully extracted text from Gemini response.")
-                # Проверка на блокировку API по причинам безопасности (prompt_feedback)
-                elif getattr(response, 'prompt_feedback', None) and getattr(response.prompt_feedback, 'block_reason', None):
-                    reason = response.prompt_feedback.block_reason
-                    logger.warning("Gemini API response blocked by safety settings. Reason: %s", reason)
-                    # Формируем сообщение об ошибке в стиле Лу
-                    extracted_text = f"(Так, стоп. Мой ответ завернули из-за цензуры – причина '{reason}'. Видимо, слишком честно или резко получилось для их нежных алгоритмов. Ну и хрен с ними.)"
-                # Если текст отсутствует и нет явной блокировки (неожиданное состояние)
-                else:
-                    logger.warning("Gemini API returned response without text and no explicit block reason. Response: %s", response)
-                    # Попытка собрать текст из частей ответа, если они есть
-                    parts = getattr(response, 'parts', [])
-                    extracted_text = "".join(getattr(part, 'text', '') for part in parts).strip()
-                    if not extracted_text:
-                         logger.error("Failed to extract text from Gemini response parts, response structure is undefined.")
-                         extracted_text = "(Хм, что-то пошло не так с генерацией. Даже сказать нечего. ИИ молчит как партизан.)"
-                    else:
-                         logger.debug("Extracted text from Gemini response parts.")
-
-            except AttributeError as attr_err:
-                # Ошибка доступа к атрибутам объекта response
-                logger.error("AttributeError extracting text from Gemini response: %s. Response: %s", attr_err, response, exc_info=True)
-                extracted_text = "(Черт, не могу разобрать, что там ИИ нагенерил. Техника барахлит, или ответ какой-то кривой пришел.)"
-            except Exception as parse_err:
-                # Любая другая неожиданная ошибка при обработке ответа
-                logger.error("Unexpected error extracting text from Gemini response: %s. Response: %s", parse_err, response, exc_info=True)
-                extracted_text = "(Какая-то хуйня с обработкой ответа ИИ. Забей, видимо, не судьба.)"
-
-            return extracted_text # Возвращаем извлеченный текст или сообщение об ошибке
+            logger.debug("Received raw response from Gemini API (%s).", key.label)
+            actual_tokens = _usage_tokens(response)
+            self.key_pool.release(key, estimated_tokens, actual_tokens)
+            if self.scheduler is not None:
+                self.scheduler.record_usage(estimated_tokens, actual_tokens)
+            return self._extract_text(response)
 
         # --- Обработка исключений при вызове API ---
+        except CircuitOpenError as e:
+            # Модель признана нездоровой: отвечаем сразу, без трассировки в логе
+            logger.warning("Gemini call for chat %d failed fast: %s", chat_id, e)
+            return self._api_error_text(e)
         except Exception as e:
             # Ловим ошибки, возникающие непосредственно при вызове generate_content_async
             logger.error("Error during generate_content_async call for chat %d: %s", chat_id, str(e), exc_info=True)
-            err_str = str(e).lower()
-            # Формируем специфичные сообщения об ошибках API в стиле Лу
-            if "api key not valid" in err_str:
-                # Эта ошибка должна по идее ловиться при инициализации, но дублируем на всякий случай
-                return "(Бляха, ключ API неверен или истёк.)"
-            if any(k in err_str for k in ("quota", "limit", "rate limit")):
-                return "(Всё, приехали. Лимит запросов к ИИ исчерпан. Видимо, слишком много умных мыслей на сегодня. Попробуй позже.)"
-            if any(k in err_str for k in ("503", "internal server", "service unavailable")):
-                return "(Серверы ИИ, похоже, легли отдохнуть. Или от моего сарказма перегрелись. Позже попробуй.)"
-            if any(k in err_str for k in ("timeout", "deadline")):
-                return "(Что-то ИИ долго думает, аж время вышло. Видимо, вопрос слишком сложный... или серваки тупят.)"
-            if "model not found" in err_str:
-                return "(Модель, которой я должен думать, сейчас недоступна. Может, на техобслуживании? Попробуй позже, если не лень.)"
-            if "block" in err_str or "safety" in err_str or "filtered" in err_str:
-                 # Эта ошибка может возникнуть и на этапе отправки промпта, а не только в ответе
-                 return "(Опять цензура! Мой гениальный запрос заблокировали еще на подлете из-за каких-то их правил безопасности. Неженки.)"
-            # Общее сообщение для всех остальных ошибок API
-            return "(Какая-то техническая засада с ИИ. Не сегодня, видимо. Попробуй позже.)"
+            return self._api_error_text(e)
+
+
+    async def stream_response(
+        self,
+        chat_id: int,
+        messages: List[Dict[str, Any]],
+        target_message: Message,
+        trigger: str,
+        replied_to_message: Optional[Message] = None,
+        media_type: Optional[str] = None,
+        media_bytes: Optional[Union[bytes, memoryview]] = None,
+        mime_type: Optional[str] = None,
+        extra_media: Optional[Sequence[Tuple[Union[bytes, memoryview], str]]] = None,
+        burst_size: int = 1,
+        summary: Optional[str] = None,
+        recalled: Optional[Sequence[MemoryHit]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Потоковая версия generate_response: отдаёт фрагменты ответа по мере генерации.
+        Аргументы те же, что у generate_response.
+
+        Если ошибка или блокировка случились до первого фрагмента, отдаётся одно сообщение
+        об ошибке в стиле Лу (как у generate_response). Ошибка посреди потока завершает его:
+        уже отданный текст остаётся ответом. Отказ планировщика обрабатывается так же, как в generate_response.
+        """
+        content = self._build_content(
+            chat_id, messages, target_message, trigger, replied_to_message, media_type, media_bytes, mime_type, extra_media, burst_size,
+            summary, recalled,
+        )
+        estimated_tokens = _estimate_tokens(content) + self._persona_tokens
+        rejection_text = await self._admit(trigger, media_type, estimated_tokens)
+        if rejection_text is not None:
+            yield rejection_text
+            return
+        produced = False
+        try:
+            logger.debug("Streaming Gemini API (trigger %s) with %d parts...", trigger, len(content))
+            key, response = await self._call_chain(trigger, media_type, content, estimated_tokens, stream=True, persona=True)
+            try:
+                async for chunk in response:
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Фрагмент без текста (например, финальный с причиной остановки) — пропускаем
+                        continue
+                    if text:
+                        produced = True
+                        yield text
+            except BaseException as e:
+                self.key_pool.release(key, estimated_tokens, error=e)
+                raise
+            actual_tokens = _usage_tokens(response)
+            self.key_pool.release(key, estimated_tokens, actual_tokens)
+            if self.scheduler is not None:
+                self.scheduler.record_usage(estimated_tokens, actual_tokens)
+            if not produced:
+                # Текста нет совсем: блокировка или пустой ответ — разбираем как обычный ответ
+                yield self._extract_text(response)
+        except Exception as e:
+            if isinstance(e, CircuitOpenError):
+                logger.warning("Gemini stream for chat %d failed fast: %s", chat_id, e)
+            else:
+                logger.error("Error during streaming generate_content_async call for chat %d: %s", chat_id, str(e), exc_info=True)
+            if not produced:
+                yield self._api_error_text(e)
+
+
+    async def summarize(
+        self,
+        chat_id: int,
+        previous_summary: Optional[str],
+        entries: Sequence[Any],
+        max_tokens: int,
+    ) -> Optional[str]:
+        """
+        Сворачивает вытесненные из окна записи контекста в новое краткое содержание переписки чата.
+        Запрос идёт с триггером 'context_summary' (фоновый приоритет планировщика, облегчённая модель).
+        Возвращает текст содержания или None, если модель недоступна либо ничего не вернула.
+        Ошибки API и SchedulerRejected пробрасываются: решение о повторе принимает ContextSummarizer.
+        """
+        content: List[Union[str, Dict[str, Any]]] = [build_summary_prompt(previous_summary, list(entries), max_tokens)]
+        estimated_tokens = _estimate_tokens(content)
+        if await self._admit("context_summary", None, estimated_tokens) is not None:
+            return None
+        key, response = await self._call_chain("context_summary", None, content, estimated_tokens)
+        actual_tokens = _usage_tokens(response)
+        self.key_pool.release(key, estimated_tokens, actual_tokens)
+        if self.scheduler is not None:
+            self.scheduler.record_usage(estimated_tokens, actual_tokens)
+        try:
+            text = (response.text or "").strip()
+        except ValueError:
+            # Ответ заблокирован или без текстовых частей — содержание остаётся прежним
+            text = ""
+        if not text:
+            logger.warning("Gemini returned an empty context summary for chat %d.", chat_id)
+            return None
+        return text
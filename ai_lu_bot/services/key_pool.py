@@ -0,0 +1,225 @@
+# ai_lu_bot/services/key_pool.py
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Protocol, Sequence
+
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.services.scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# На сколько секунд ключ выводится из ротации после ошибки квоты или сбоя сервера
+DEFAULT_KEY_COOLDOWN = 60.0
+
+
+def is_quota_error(e: Exception) -> bool:
+    """
+    Ошибка исчерпания квоты (429 / Resource exhausted). Сопоставление узкое: от него зависят скамейка ключа
+    и общая пауза планировщика, а слово "limit" встречается и в других ошибках (например, о размере запроса).
+    """
+    err_str = str(e).lower()
+    return any(k in err_str for k in ("429", "resource exhausted", "quota", "rate limit"))
+
+
+def is_server_error(e: Exception) -> bool:
+    """Сбой на стороне API (5xx)."""
+    err_str = str(e).lower()
+    return any(k in err_str for k in ("500", "502", "503", "504", "internal server", "service unavailable", "internal error"))
+
+
+class ModelBackend(Protocol):
+    """Источник клиентов моделей для одного ключа API (настоящий Gemini или локальная заглушка)."""
+    def model(self, config: Any, system_instruction: Optional[str] = None, cached_content: Any = None) -> Any:
+        """
+        Возвращает объект с методом generate_content_async(content, stream=False) для данной конфигурации:
+        с system instruction или поверх кэша контента, созданного create_cache.
+        """
+
+    async def create_cache(self, config: Any, system_instruction: str, ttl: float) -> Any:
+        """Загружает system instruction в кэш контента API для модели config, возвращает описатель кэша."""
+
+    async def extend_cache(self, handle: Any, ttl: float) -> None:
+        """Продлевает кэш ещё на ttl секунд."""
+
+
+class GenaiKeyBackend:
+    """
+    Клиенты google.generativeai, привязанные к одному ключу API.
+    genai.configure настраивает ключ глобально, поэтому для каждого ключа заводится свой менеджер клиентов SDK,
+    а моделям подставляется его асинхронный клиент.
+    """
+    def __init__(self, api_key: str):
+        # Импорт здесь: заглушке (GEMINI_BACKEND=fake) SDK не нужен
+        from google.generativeai import client as genai_client
+
+        self._client_manager = genai_client._ClientManager()
+        self._client_manager.configure(api_key=api_key)
+        self._models: Dict[Any, Any] = {}
+
+    def model(self, config: Any, system_instruction: Optional[str] = None, cached_content: Any = None) -> Any:
+        # Модель поверх кэша одна на конфигурацию: новый описатель (после пересоздания кэша) заменяет старую
+        key = (config, "cached") if cached_content is not None else (config, system_instruction)
+        model = self._models.get(key)
+        if model is None or (cached_content is not None and model.cached_content != cached_content.name):
+            model = config.build_model(system_instruction=system_instruction, cached_content=cached_content)
+            self._models[key] = model
+        if model._async_client is None:
+            # GenerativeModel сам взял бы глобальный клиент (ключ из genai.configure); асинхронный клиент
+            # создаётся внутри event loop, поэтому подставляется при первом запросе, а не при сборке модели
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return model
+            model._async_client = self._client_manager.get_default_client("generative_async")
+        return model
+
+    async def create_cache(self, config: Any, system_instruction: str, ttl: float) -> Any:
+        from google.generativeai import caching, protos
+
+        name = config.model_name if "/" in config.model_name else f"models/{config.model_name}"
+        client = self._client_manager.get_default_client("cache_async")
+        response = await client.create_cached_content(request=protos.CreateCachedContentRequest(
+            cached_content=protos.CachedContent(
+                model=name,
+                system_instruction=protos.Content(parts=[protos.Part(text=system_instruction)]),
+                ttl=timedelta(seconds=ttl),
+            ),
+        ))
+        return caching.CachedContent._from_obj(response)
+
+    async def extend_cache(self, handle: Any, ttl: float) -> None:
+        from google.generativeai import protos
+        from google.protobuf import field_mask_pb2
+
+        client = self._client_manager.get_default_client("cache_async")
+        await client.update_cached_content(request=protos.UpdateCachedContentRequest(
+            cached_content=protos.CachedContent(name=handle.name, ttl=timedelta(seconds=ttl)),
+            update_mask=field_mask_pb2.FieldMask(paths=["ttl"]),
+        ))
+
+
+class PooledKey:
+    """Ключ API в пуле: клиенты, остаток бюджета, скамейка запасных и счётчики использования."""
+    def __init__(self, label: str, backend: ModelBackend, requests_per_minute: float, tokens_per_minute: float):
+        self.label = label
+        self.backend = backend
+        self._requests = TokenBucket(requests_per_minute, requests_per_minute) if requests_per_minute > 0 else None
+        self._tokens = TokenBucket(tokens_per_minute, tokens_per_minute) if tokens_per_minute > 0 else None
+        self.benched_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.tokens_used = 0
+
+    def budget(self, now: float) -> float:
+        """Доля оставшегося минутного бюджета (0..1); без известных лимитов — 1."""
+        return min((bucket.fraction(now) for bucket in (self._requests, self._tokens) if bucket is not None), default=1.0)
+
+    def charge(self, estimated_tokens: int, now: float) -> None:
+        if self._requests is not None:
+            self._requests.consume(1, now)
+        if self._tokens is not None:
+            self._tokens.consume(estimated_tokens, now)
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        if actual_tokens is not None:
+            self.tokens_used += actual_tokens
+            if self._tokens is not None:
+                self._tokens.adjust(estimated_tokens - actual_tokens)
+
+
+class GeminiKeyPool:
+    """
+    Пул ключей Gemini API: каждый запрос уходит на ключ с наибольшим остатком минутного бюджета
+    (при равенстве — с меньшим числом запросов в работе). Ключ, получивший ошибку квоты или 5xx,
+    выводится из ротации на cooldown секунд. Если выведены все ключи, берётся тот, что вернётся раньше.
+    """
+    def __init__(
+        self,
+        backends: Sequence[ModelBackend],
+        labels: Optional[Sequence[str]] = None,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        cooldown: float = DEFAULT_KEY_COOLDOWN,
+    ):
+        """
+        Args:
+            backends: По одному бэкенду на ключ API.
+            labels: Имена ключей для логов и метрик (по умолчанию key0, key1, ...).
+            requests_per_minute: Лимит запросов в минуту на один ключ (0 — неизвестен).
+            tokens_per_minute: Лимит токенов в минуту на один ключ (0 — неизвестен).
+            cooldown: На сколько секунд выводить ключ из ротации после квоты или 5xx.
+        """
+        if not backends:
+            raise ValueError("GeminiKeyPool needs at least one API key backend")
+        labels = list(labels) if labels else [f"key{i}" for i in range(len(backends))]
+        self._keys: List[PooledKey] = [
+            PooledKey(label, backend, requests_per_minute, tokens_per_minute) for label, backend in zip(labels, backends)
+        ]
+        self._cooldown = cooldown
+        logger.info("GeminiKeyPool initialized with %d key(s): %s", len(self._keys), ", ".join(k.label for k in self._keys))
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @property
+    def keys(self) -> List[PooledKey]:
+        return list(self._keys)
+
+    def available(self) -> int:
+        """Сколько ключей сейчас в ротации."""
+        now = time.monotonic()
+        return sum(1 for key in self._keys if key.benched_until <= now)
+
+    def acquire(self, estimated_tokens: int, exclude: Sequence[PooledKey] = ()) -> PooledKey:
+        """Выбирает ключ для запроса и резервирует под него бюджет. Вызывающий обязан вызвать release()."""
+        now = time.monotonic()
+        candidates = [key for key in self._keys if key not in exclude] or self._keys
+        active = [key for key in candidates if key.benched_until <= now]
+        if active:
+            key = max(active, key=lambda k: (k.budget(now), -k.in_flight, -k.requests))
+        else:
+            key = min(candidates, key=lambda k: k.benched_until)
+            logger.warning("GeminiKeyPool: all keys are benched, using %s (back in %.0fs).", key.label, key.benched_until - now)
+        key.charge(estimated_tokens, now)
+        key.in_flight += 1
+        key.requests += 1
+        metrics.inc("gemini_key_requests", key=key.label)
+        return key
+
+    def release(self, key: PooledKey, estimated_tokens: int, actual_tokens: Optional[int] = None, error: Optional[BaseException] = None) -> None:
+        """Завершает запрос: учитывает фактический расход токенов и, при квоте или 5xx, выводит ключ из ротации."""
+        key.in_flight -= 1
+        key.settle(estimated_tokens, actual_tokens)
+        if actual_tokens:
+            metrics.inc("gemini_key_tokens", actual_tokens, key=key.label)
+        if error is None or not isinstance(error, Exception):
+            return
+        key.failures += 1
+        kind = "quota" if is_quota_error(error) else "server" if is_server_error(error) else None
+        metrics.inc("gemini_key_failures", key=key.label, kind=kind or "other")
+        if kind is not None:
+            key.benched_until = time.monotonic() + self._cooldown
+            logger.warning("GeminiKeyPool: %s benched for %.0fs after %s error: %s", key.label, self._cooldown, kind, error)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Использование и состояние ключей (для метрик)."""
+        now = time.monotonic()
+        return {
+            key.label: {
+                "requests": key.requests,
+                "failures": key.failures,
+                "tokens": key.tokens_used,
+                "in_flight": key.in_flight,
+                "budget": round(key.budget(now), 2),
+                "benched_for": max(0, round(key.benched_until - now)),
+            }
+            for key in self._keys
+        }
+
+
+def mask_key(api_key: str) -> str:
+    """Безопасное имя ключа для логов и метрик: только последние 4 символа."""
+    return f"key…{api_key[-4:]}" if len(api_key) > 8 else "key"
@@ -0,0 +1,166 @@
+# ai_lu_bot/services/persona_cache.py
+import asyncio
+import logging
+import math
+import re
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.core.prompt_builder import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Способы передачи персоны модели: целиком в тексте запроса, как system instruction, через кэш контента API
+PERSONA_MODES = ("inline", "system", "cached")
+# Время жизни кэша персоны в API и запас, за который он продлевается (секунды)
+DEFAULT_PERSONA_CACHE_TTL = 3600.0
+DEFAULT_PERSONA_REFRESH_MARGIN = 600.0
+# Через сколько секунд снова пробовать создать кэш, если API отказал (модель не поддерживает кэш, персона слишком мала…)
+DEFAULT_PERSONA_RETRY_AFTER = 1800.0
+# Явный кэш контента Gemini: минимальный размер кэшируемого текста (токены) по семейству модели.
+# Модели 1.5 кэшируются только с закреплённой версией (-001/-002) и от 32768 токенов; для неизвестных
+# моделей берётся этот же, самый строгий порог
+_MIN_CACHE_TOKENS = (("gemini-2.5-flash", 1024), ("gemini-2.5-pro", 4096))
+DEFAULT_MIN_CACHE_TOKENS = 32768
+_PINNED_VERSION_RE = re.compile(r"-\d{3}$")
+
+
+def cache_unsupported_reason(model_name: str, tokens: int) -> Optional[str]:
+    """Почему текст размером tokens нельзя положить в кэш контента модели model_name (None — можно пробовать)."""
+    if model_name.startswith("gemini-1.5") and not _PINNED_VERSION_RE.search(model_name):
+        return "Gemini 1.5 caches only pinned model versions (-001/-002)"
+    min_tokens = next((tokens for prefix, tokens in _MIN_CACHE_TOKENS if model_name.startswith(prefix)), DEFAULT_MIN_CACHE_TOKENS)
+    if tokens < min_tokens:
+        return f"~{tokens} tokens is below the {min_tokens}-token cache minimum"
+    return None
+
+
+def is_cache_error(e: Exception) -> bool:
+    """Запрос отклонён из-за кэша контента (кэш истёк или удалён)."""
+    err_str = str(e).lower()
+    return "cachedcontent" in err_str or "cached content" in err_str
+
+
+class _CacheEntry:
+    """Кэш персоны для одной модели на одном ключе API."""
+    __slots__ = ("handle", "expires_at", "failed_until", "task")
+
+    def __init__(self):
+        self.handle: Any = None
+        self.expires_at = 0.0
+        self.failed_until = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+
+class PersonaCache:
+    """
+    Персона Лу (Блоки 1-5 промпта), загруженная в API один раз как кэш контента и общая для всех чатов.
+
+    Кэш живёт на стороне API и привязан к ключу и модели, поэтому хранится по паре (бэкенд ключа, конфигурация модели).
+    Создание и продление идут фоновыми задачами: запрос никогда не ждёт API кэша, а пока кэша нет
+    (ещё не создан, истёк, API отказал) персона уходит обычным system instruction.
+    Кэш работает не для всех моделей: Gemini 1.5 — только версии с номером (-001/-002) и от 32768 токенов,
+    2.5 Flash — от 1024, 2.5 Pro — от 4096. Персона Лу (~2-3 тыс. токенов) кэшируется только 2.5 Flash;
+    для остальных создание кэша не вызывается вовсе (см. cache_unsupported_reason).
+    Бэкенд ключа должен уметь model(config, system_instruction=..., cached_content=...),
+    create_cache(config, system_instruction, ttl) и extend_cache(handle, ttl).
+    """
+    def __init__(
+        self,
+        persona: str,
+        ttl: float = DEFAULT_PERSONA_CACHE_TTL,
+        refresh_margin: float = DEFAULT_PERSONA_REFRESH_MARGIN,
+        retry_after: float = DEFAULT_PERSONA_RETRY_AFTER,
+    ):
+        """
+        Args:
+            persona: Текст персоны (prompt_builder.PERSONA_INSTRUCTION).
+            ttl: Время жизни кэша в API (секунды).
+            refresh_margin: За сколько секунд до истечения кэш продлевается (при очередном запросе).
+            retry_after: Пауза перед новой попыткой после отказа API.
+        """
+        self.persona = persona
+        self._ttl = ttl
+        self._margin = min(refresh_margin, ttl / 2)
+        self._retry_after = retry_after
+        self._entries: Dict[Tuple[Any, Any], _CacheEntry] = {}
+        self._tokens = estimate_tokens(persona)
+
+    def _entry(self, backend: Any, config: Any) -> _CacheEntry:
+        entry = self._entries.get((backend, config))
+        if entry is None:
+            entry = self._entries[(backend, config)] = _CacheEntry()
+            model_name = getattr(config, "model_name", str(config))
+            reason = cache_unsupported_reason(model_name, self._tokens)
+            if reason is not None:
+                # Создание кэша заведомо отклонится — не тратим на него вызовы API
+                entry.failed_until = math.inf
+                metrics.inc("persona_cache_refreshes", model=model_name, result="unsupported")
+                logger.info("Persona cache disabled for %s (%s); sending the persona as a system instruction.", model_name, reason)
+        return entry
+
+    def model(self, backend: Any, config: Any) -> Tuple[Any, bool]:
+        """
+        Клиент модели с персоной: (модель, True) — через живой кэш, (модель, False) — с персоной в system instruction.
+        Заодно при необходимости запускает фоновое создание или продление кэша.
+        """
+        entry = self._entry(backend, config)
+        now = time.monotonic()
+        if entry.handle is not None and now < entry.expires_at:
+            if now >= entry.expires_at - self._margin:
+                self._schedule(entry, backend, config, now)
+            metrics.inc("persona_requests", mode="cached")
+            return backend.model(config, cached_content=entry.handle), True
+        self._schedule(entry, backend, config, now)
+        metrics.inc("persona_requests", mode="system")
+        return backend.model(config, system_instruction=self.persona), False
+
+    def invalidate(self, backend: Any, config: Any) -> None:
+        """Забывает кэш, который API отверг (истёк раньше срока или удалён): следующий запрос создаст новый."""
+        entry = self._entries.get((backend, config))
+        if entry is not None and entry.handle is not None:
+            logger.warning("Persona cache for %s was rejected by the API, recreating it.", getattr(config, "model_name", config))
+            entry.handle = None
+
+    def warm(self, backend: Any, config: Any) -> None:
+        """Заранее создаёт кэш (при старте), чтобы первые ответы уже шли через него."""
+        entry = self._entry(backend, config)
+        self._schedule(entry, backend, config, time.monotonic())
+
+    def _schedule(self, entry: _CacheEntry, backend: Any, config: Any, now: float) -> None:
+        if now < entry.failed_until or (entry.task is not None and not entry.task.done()):
+            return
+        entry.task = asyncio.create_task(self._refresh(entry, backend, config), name="persona-cache-refresh")
+
+    async def _refresh(self, entry: _CacheEntry, backend: Any, config: Any) -> None:
+        model_name = getattr(config, "model_name", config)
+        started = time.monotonic()
+        try:
+            if entry.handle is not None and started < entry.expires_at:
+                await backend.extend_cache(entry.handle, self._ttl)
+                result = "extended"
+            else:
+                entry.handle = await backend.create_cache(config, self.persona, self._ttl)
+                result = "created"
+        except Exception as e:
+            # Без кэша персона продолжает уходить system instruction; до истечения живой кэш ещё используется
+            entry.failed_until = time.monotonic() + self._retry_after
+            metrics.inc("persona_cache_refreshes", model=model_name, result="error")
+            logger.warning(
+                "Failed to cache the persona for %s, sending it as a system instruction for the next %.0fs: %s",
+                model_name, self._retry_after, e,
+            )
+            return
+        entry.expires_at = started + self._ttl
+        metrics.inc("persona_cache_refreshes", model=model_name, result=result)
+        logger.info("Persona cache for %s %s (ttl %.0fs).", model_name, result, self._ttl)
+
+    def stats(self) -> Dict[str, int]:
+        """Сколько кэшей персоны сейчас живо, сколько моделей ждут повторной попытки и сколько кэш не поддерживают (для метрик)."""
+        now = time.monotonic()
+        return {
+            "live": sum(1 for entry in self._entries.values() if entry.handle is not None and now < entry.expires_at),
+            "failed": sum(1 for entry in self._entries.values() if now < entry.failed_until < math.inf),
+            "unsupported": sum(1 for entry in self._entries.values() if entry.failed_until == math.inf),
+        }
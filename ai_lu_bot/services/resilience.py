@@ -0,0 +1,284 @@
+# ai_lu_bot/services/resilience.py
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, TypeVar
+
+from ai_lu_bot.core.metrics import Histogram, metrics
+from ai_lu_bot.services.key_pool import is_server_error
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Общий срок на ответ модели по триггеру (секунды): все попытки, повторы и запасные модели вместе
+DEFAULT_TRIGGER_DEADLINES: Dict[str, float] = {
+    "dm": 60.0,
+    "reply_to_bot": 60.0,
+    "creator_message_user": 90.0,
+    "channel_post_forwarded_or_sent_as": 45.0,
+    "random_group_message": 20.0,
+}
+DEFAULT_DEADLINE = 60.0
+# Сколько наблюдений задержки нужно, прежде чем доверять p95 для хеджирования
+_MIN_HEDGE_SAMPLES = 20
+
+
+class CircuitOpenError(Exception):
+    """Модель признана нездоровой: запрос отклонён сразу, без обращения к API."""
+    def __init__(self, name: str, retry_in: float):
+        # Текст похож на 503, чтобы ответ пользователю был тем же, что и при недоступности серверов
+        super().__init__(f"503 Service unavailable: circuit open for {name}, retry in {retry_in:.0f}s")
+        self.name = name
+
+
+def is_retryable(e: BaseException) -> bool:
+    """Повторять имеет смысл таймауты и сбои сервера (5xx); ошибки запроса и квоты — нет."""
+    return isinstance(e, asyncio.TimeoutError) or (isinstance(e, Exception) and is_server_error(e))
+
+
+class CircuitBreaker:
+    """
+    Автомат "закрыт → открыт → полуоткрыт" для одной модели.
+    После failure_threshold сбоев подряд запросы отклоняются reset_timeout секунд,
+    затем пропускается один пробный запрос: успех закрывает автомат, сбой открывает снова.
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self._reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> None:
+        """Бросает CircuitOpenError, если запрос сейчас пропускать нельзя."""
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True # Один пробный запрос
+            return
+        retry_in = max(0.0, self._reset_timeout - (time.monotonic() - self._opened_at))
+        metrics.inc("gemini_circuit_rejections", model=self.name)
+        raise CircuitOpenError(self.name, retry_in)
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info("Circuit for %s closed: backend is healthy again.", self.name)
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    def record_neutral(self) -> None:
+        """Попытка завершилась без вывода о здоровье модели: пробный запрос можно повторить."""
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        probe_failed = self._probe_in_flight
+        self._probe_in_flight = False
+        if probe_failed or (self._opened_at is None and self._failures >= self._failure_threshold):
+            self._opened_at = time.monotonic()
+            metrics.inc("gemini_circuit_opened", model=self.name)
+            logger.warning("Circuit for %s opened after %d failures; failing fast for %.0fs.", self.name, self._failures, self._reset_timeout)
+
+
+class ResilientCaller:
+    """
+    Устойчивый вызов модели: срок по триггеру, повторы с экспоненциальной задержкой и случайным разбросом
+    для таймаутов и 5xx, необязательный хеджированный второй запрос после задержки, равной p95,
+    и автомат отключения (CircuitBreaker) для каждой модели.
+    """
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        attempt_timeout: float = 45.0,
+        hedge: bool = False,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 30.0,
+        deadlines: Optional[Dict[str, float]] = None,
+    ):
+        """
+        Args:
+            max_attempts: Сколько всего попыток на одну модель (1 — без повторов).
+            base_delay: Базовая задержка перед повтором (секунды), удваивается с каждой попыткой.
+            max_delay: Верхняя граница задержки перед повтором (секунды).
+            attempt_timeout: Таймаут одной попытки (секунды).
+            hedge: Отправлять ли второй запрос, если первый не ответил за p95 задержки этой модели.
+            breaker_threshold: Сколько сбоев подряд открывают автомат модели.
+            breaker_reset: Сколько секунд автомат остаётся открытым.
+            deadlines: Общий срок на ответ по триггерам (по умолчанию DEFAULT_TRIGGER_DEADLINES).
+        """
+        self._max_attempts = max(1, max_attempts)
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._attempt_timeout = attempt_timeout
+        self._hedge = hedge
+        self._breaker_threshold = breaker_threshold
+        self._breaker_reset = breaker_reset
+        self._deadlines = dict(DEFAULT_TRIGGER_DEADLINES if deadlines is None else deadlines)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[str, Histogram] = {}
+
+    def deadline_for(self, trigger: Optional[str]) -> float:
+        """Момент (по часам event loop), к которому ответ для этого триггера должен быть получен."""
+        return asyncio.get_running_loop().time() + self._deadlines.get(trigger, DEFAULT_DEADLINE)
+
+    def breaker(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name, self._breaker_threshold, self._breaker_reset)
+        return breaker
+
+    def is_open(self, name: str) -> bool:
+        """Автомат модели открыт: запрос к ней сейчас будет отклонён."""
+        breaker = self._breakers.get(name)
+        return breaker is not None and breaker.state == "open"
+
+    def _hedge_delay(self, name: str) -> Optional[float]:
+        histogram = self._latencies.get(name)
+        if not self._hedge or histogram is None or histogram.count < _MIN_HEDGE_SAMPLES:
+            return None
+        p95 = histogram.percentile(0.95)
+        return p95 if p95 not in (None, float("inf")) else None
+
+    async def call(
+        self,
+        name: str,
+        factory: Callable[[], Awaitable[T]],
+        deadline: float,
+        hedge: bool = True,
+        discard: Optional[Callable[[T], None]] = None,
+        admit: Optional[Callable[[], bool]] = None,
+    ) -> T:
+        """
+        Выполняет factory() с повторами до срока deadline. Бросает CircuitOpenError, если модель name
+        признана нездоровой, asyncio.TimeoutError по истечении срока или последнюю ошибку вызова.
+
+        Args:
+            name: Имя модели (автомат и статистика задержек ведутся по нему).
+            factory: Создаёт новую попытку вызова.
+            deadline: Срок по часам event loop (см. deadline_for).
+            hedge: Разрешить хеджирование для этого вызова (например, не для потоков).
+            discard: Вызывается для результата проигравшей хеджированной попытки (освободить ресурсы).
+            admit: Спрашивается перед каждым повтором и хеджированным запросом (первая попытка уже допущена);
+                   False — вызов не отправляется (например, планировщику не хватает лимитов).
+        """
+        loop = asyncio.get_running_loop()
+        breaker = self.breaker(name)
+        for attempt in range(self._max_attempts):
+            breaker.allow()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"Deadline exceeded for {name}")
+            timeout = min(remaining, self._attempt_timeout)
+            started = loop.time()
+            try:
+                hedge_delay = self._hedge_delay(name) if hedge else None
+                if hedge_delay is not None and hedge_delay < timeout:
+                    result = await asyncio.wait_for(self._hedged(name, factory, hedge_delay, discard, admit), timeout)
+                else:
+                    result = await asyncio.wait_for(factory(), timeout)
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.record_neutral() # Ошибка запроса или квоты не говорит о здоровье модели
+                if not retryable or attempt + 1 >= self._max_attempts:
+                    raise
+                # Экспоненциальная задержка с полным случайным разбросом, но не дальше срока
+                delay = random.uniform(0, min(self._max_delay, self._base_delay * (2 ** attempt)))
+                if loop.time() + delay >= deadline:
+                    raise
+                if admit is not None and not admit():
+                    logger.warning("Gemini call to %s failed (%s), not retrying: no rate limit budget for another call.", name, e or type(e).__name__)
+                    raise
+                metrics.inc("gemini_retries", model=name)
+                logger.warning("Gemini call to %s failed (%s), retry %d in %.2fs.", name, e or type(e).__name__, attempt + 1, delay)
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Попытку отменили (вытеснена новым сообщением, истёк внешний срок): о здоровье модели это
+                # ничего не говорит, а флаг пробного запроса иначе остался бы поднятым навсегда
+                breaker.record_neutral()
+                raise
+            breaker.record_success()
+            self._latencies.setdefault(name, Histogram()).observe(loop.time() - started)
+            return result
+        raise RuntimeError("unreachable")
+
+    async def _hedged(
+        self,
+        name: str,
+        factory: Callable[[], Awaitable[T]],
+        hedge_delay: float,
+        discard: Optional[Callable[[T], None]],
+        admit: Optional[Callable[[], bool]] = None,
+    ) -> T:
+        """
+        Первая попытка; если она не ответила за hedge_delay (и admit разрешает ещё один вызов), параллельно
+        запускается вторая. Побеждает первый успешный ответ.
+        """
+        tasks = [asyncio.ensure_future(factory())]
+        winner: Optional[asyncio.Future] = None
+        try:
+            done, _pending = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done and (admit is None or admit()):
+                metrics.inc("gemini_hedged_requests", model=name)
+                logger.debug("Gemini call to %s is slower than p95 (%.2fs), sending a hedged request.", name, hedge_delay)
+                tasks.append(asyncio.ensure_future(factory()))
+            last_error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is not tasks[0]:
+                            metrics.inc("gemini_hedge_wins", model=name)
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await self._discard_losers(tasks, winner, discard)
+
+    @staticmethod
+    async def _discard_losers(
+        tasks: Sequence[asyncio.Future], winner: Optional[asyncio.Future], discard: Optional[Callable[[Any], None]],
+    ) -> None:
+        """
+        Дожидается отменённых попыток и освобождает результаты всех успешных, кроме winner (его результат уже отдан;
+        None — не отдан ничей, например _hedged отменили).
+        """
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if discard is None:
+            return
+        for task in tasks:
+            if task is not winner and not task.cancelled() and task.exception() is None:
+                discard(task.result())
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Состояние автоматов и p95 задержек по моделям (для метрик)."""
+        return {
+            name: {
+                "circuit": breaker.state,
+                "p95": self._latencies[name].percentile(0.95) if name in self._latencies else None,
+            }
+            for name, breaker in self._breakers.items()
+        }
@@ -0,0 +1,262 @@
+# ai_lu_bot/services/scheduler.py
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from ai_lu_bot.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета запросов к модели (меньше — важнее)
+PRIORITY_INTERACTIVE = 0 # Личка, ответы боту, Создатель
+PRIORITY_NORMAL = 1 # Комментарии к постам каналов
+PRIORITY_BACKGROUND = 2 # Случайные реплики в группах: первыми задерживаются и отбрасываются
+
+TRIGGER_PRIORITIES: Dict[str, int] = {
+    "dm": PRIORITY_INTERACTIVE,
+    "reply_to_bot": PRIORITY_INTERACTIVE,
+    "creator_message_user": PRIORITY_INTERACTIVE,
+    "channel_post_forwarded_or_sent_as": PRIORITY_NORMAL,
+    "random_group_message": PRIORITY_BACKGROUND,
+    "context_summary": PRIORITY_BACKGROUND, # Сжатие вытесненного контекста (services/summarizer.py)
+}
+# Сколько секунд запрос каждого класса может ждать в очереди (по индексу приоритета)
+DEFAULT_QUEUE_TIMEOUTS: Tuple[float, ...] = (20.0, 10.0, 3.0)
+
+
+def priority_for(trigger: Optional[str]) -> int:
+    """Класс приоритета для триггера ответа (неизвестные триггеры — обычный приоритет)."""
+    return TRIGGER_PRIORITIES.get(trigger, PRIORITY_NORMAL)
+
+
+class SchedulerRejected(Exception):
+    """Запрос к модели не допущен: очередь переполнена или время ожидания в ней истекло."""
+    def __init__(self, priority: int, reason: str):
+        super().__init__(f"Gemini request rejected ({reason}, priority {priority})")
+        self.priority = priority
+        self.reason = reason
+
+
+class TokenBucket:
+    """
+    Корзина токенов с пополнением rate_per_minute в минуту и ёмкостью capacity.
+    Уровень может уходить в минус: запрос крупнее ёмкости допускается при полной корзине,
+    а фактический расход сверх оценки записывается как долг (см. adjust).
+    """
+    __slots__ = ("_rate", "_capacity", "_level", "_updated")
+
+    def __init__(self, rate_per_minute: float, capacity: float):
+        self._rate = rate_per_minute / 60.0
+        self._capacity = capacity
+        self._level = capacity
+        self._updated: Optional[float] = None # Время event loop; отсчёт начинается с первого обращения
+
+    def _refill(self, now: float) -> None:
+        if self._updated is None:
+            self._updated = now
+        self._level = min(self._capacity, self._level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Через сколько секунд можно будет списать amount (0 — прямо сейчас)."""
+        self._refill(now)
+        needed = min(amount, self._capacity)
+        if self._level >= needed:
+            return 0.0
+        return (needed - self._level) / self._rate
+
+    def consume(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self._level -= amount
+
+    def adjust(self, amount: float) -> None:
+        """Возвращает (amount > 0) или дополнительно списывает (amount < 0) токены."""
+        self._level = min(self._capacity, self._level + amount)
+
+    def fraction(self, now: float) -> float:
+        """Доля заполнения корзины на момент now (0..1)."""
+        self._refill(now)
+        return max(self._level, 0.0) / self._capacity
+
+    @property
+    def level(self) -> float:
+        return self._level
+
+
+class GeminiScheduler:
+    """
+    Допуск запросов к модели с учётом лимитов RPM/TPM и приоритета по триггеру ответа.
+
+    - Пока лимиты позволяют и очередь пуста, запрос проходит сразу.
+    - Иначе запрос встаёт в очередь по приоритету; первым обслуживается самый важный класс,
+      поэтому под нагрузкой задерживаются прежде всего фоновые запросы.
+    - Время ожидания каждого класса ограничено; при переполнении очереди вытесняется
+      самый неважный запрос. В обоих случаях бросается SchedulerRejected.
+    - После ошибки квоты от API все запросы приостанавливаются на время backoff.
+    - Лимиты списываются за каждый вызов API, а не за логический запрос. Первый вызов ждёт в очереди (acquire);
+      повторы, хеджированные запросы, запасные модели и повтор на другом ключе списываются через try_acquire
+      без ожидания. Если лимиты не позволяют вызов прямо сейчас или в очереди кто-то ждёт, дополнительный
+      вызов не отправляется: запрос завершается последней ошибкой (хедж — просто ждёт первую попытку).
+    """
+    def __init__(
+        self,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_queue: int = 100,
+        queue_timeouts: Sequence[float] = DEFAULT_QUEUE_TIMEOUTS,
+    ):
+        """
+        Args:
+            requests_per_minute: Лимит запросов в минуту (0 — без лимита).
+            tokens_per_minute: Лимит токенов в минуту (0 — без лимита).
+            max_queue: Максимум запросов, ожидающих в очереди.
+            queue_timeouts: Максимальное ожидание в очереди (секунды) для каждого класса приоритета.
+        """
+        # Корзины вмещают четверть минутного лимита, чтобы не выпускать весь лимит одним залпом
+        self._requests = TokenBucket(requests_per_minute, max(1.0, requests_per_minute / 4)) if requests_per_minute > 0 else None
+        self._tokens = TokenBucket(tokens_per_minute, max(1.0, tokens_per_minute / 4)) if tokens_per_minute > 0 else None
+        self._max_queue = max_queue
+        self._queue_timeouts = tuple(queue_timeouts)
+        self._queue: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        logger.info(
+            "GeminiScheduler initialized: rpm = %s, tpm = %s, max_queue = %d, queue timeouts = %s",
+            requests_per_minute or "unlimited", tokens_per_minute or "unlimited", max_queue, self._queue_timeouts,
+        )
+
+    def _timeout_for(self, priority: int) -> float:
+        return self._queue_timeouts[min(priority, len(self._queue_timeouts) - 1)]
+
+    def _delay(self, tokens: float, now: float) -> float:
+        delay = max(0.0, self._paused_until - now)
+        if self._requests is not None:
+            delay = max(delay, self._requests.delay(1, now))
+        if self._tokens is not None:
+            delay = max(delay, self._tokens.delay(tokens, now))
+        return delay
+
+    def _consume(self, tokens: float, now: float) -> None:
+        if self._requests is not None:
+            self._requests.consume(1, now)
+        if self._tokens is not None:
+            self._tokens.consume(tokens, now)
+
+    async def acquire(self, trigger: Optional[str], estimated_tokens: int) -> None:
+        """
+        Ждёт разрешения на запрос к модели. Бросает SchedulerRejected, если запрос отброшен
+        (переполнение очереди или истёкшее время ожидания для его класса).
+        """
+        loop = asyncio.get_running_loop()
+        priority = priority_for(trigger)
+        started = loop.time()
+        if not self._queue and self._delay(estimated_tokens, started) <= 0:
+            self._consume(estimated_tokens, started)
+            metrics.observe("gemini_queue_wait_seconds", 0.0, priority=priority)
+            metrics.inc("gemini_scheduler_requests", priority=priority, result="granted")
+            return
+
+        if len(self._queue) >= self._max_queue:
+            self._shed(priority)
+
+        future = loop.create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), float(estimated_tokens), future))
+        self._wake()
+        try:
+            await asyncio.wait_for(future, self._timeout_for(priority))
+        except asyncio.TimeoutError:
+            metrics.inc("gemini_scheduler_requests", priority=priority, result="timeout")
+            logger.warning("Gemini request (trigger %s) timed out after %.1fs in scheduler queue.", trigger, loop.time() - started)
+            raise SchedulerRejected(priority, "queue timeout")
+        except SchedulerRejected:
+            metrics.inc("gemini_scheduler_requests", priority=priority, result="shed")
+            logger.warning("Gemini request (trigger %s) shed from a full scheduler queue.", trigger)
+            raise
+        finally:
+            metrics.observe("gemini_queue_wait_seconds", loop.time() - started, priority=priority)
+        metrics.inc("gemini_scheduler_requests", priority=priority, result="granted")
+
+    def try_acquire(self, trigger: Optional[str], estimated_tokens: int) -> bool:
+        """
+        Разрешение на дополнительный вызов уже допущенного запроса, без ожидания и без очереди.
+        True — лимиты списаны и вызов можно отправлять; False — вызов не отправляется.
+        """
+        loop = asyncio.get_running_loop()
+        priority = priority_for(trigger)
+        now = loop.time()
+        # Ожидающие в очереди ещё не сделали ни одного вызова — дополнительные попытки их не обгоняют
+        if self._queue or self._delay(estimated_tokens, now) > 0:
+            metrics.inc("gemini_scheduler_extra_calls", priority=priority, result="skipped")
+            return False
+        self._consume(estimated_tokens, now)
+        metrics.inc("gemini_scheduler_extra_calls", priority=priority, result="granted")
+        return True
+
+    def _shed(self, priority: int) -> None:
+        """Освобождает место в полной очереди: вытесняет самый неважный запрос или отвергает новый."""
+        worst_index = max(range(len(self._queue)), key=lambda i: (self._queue[i][0], self._queue[i][1]))
+        worst_priority, _seq, _tokens, worst_future = self._queue[worst_index]
+        if worst_priority <= priority:
+            metrics.inc("gemini_scheduler_requests", priority=priority, result="shed")
+            raise SchedulerRejected(priority, "queue full")
+        self._queue.pop(worst_index)
+        heapq.heapify(self._queue)
+        if not worst_future.done():
+            worst_future.set_exception(SchedulerRejected(worst_priority, "queue full"))
+
+    def _wake(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch(), name="gemini-scheduler")
+
+    async def _dispatch(self) -> None:
+        """Выдаёт разрешения ожидающим по приоритету, как только лимиты это позволяют."""
+        loop = asyncio.get_running_loop()
+        while self._queue:
+            _priority, _seq, tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue) # Истёк таймаут или вытеснен
+                continue
+            now = loop.time()
+            delay = self._delay(tokens, now)
+            if delay <= 0:
+                heapq.heappop(self._queue)
+                self._consume(tokens, now)
+                future.set_result(None)
+                continue
+            # Ждём пополнения корзин или нового (возможно, более важного) запроса
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """Корректирует корзину токенов по фактическому расходу из ответа модели."""
+        if self._tokens is not None and actual_tokens is not None:
+            self._tokens.adjust(estimated_tokens - actual_tokens)
+
+    def backoff(self, seconds: float) -> None:
+        """Приостанавливает выдачу разрешений (после ошибки квоты от API)."""
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+        metrics.inc("gemini_scheduler_backoffs")
+        logger.warning("GeminiScheduler: pausing requests for %.1fs after a quota error.", seconds)
+
+    def stats(self) -> Dict[str, object]:
+        """Состояние очереди и корзин (для метрик)."""
+        depths: Dict[int, int] = {}
+        for priority, _seq, _tokens, future in self._queue:
+            if not future.done():
+                depths[priority] = depths.get(priority, 0) + 1
+        return {
+            "queued": depths,
+            "rpm_bucket": round(self._requests.level, 1) if self._requests is not None else None,
+            "tpm_bucket": round(self._tokens.level) if self._tokens is not None else None,
+        }
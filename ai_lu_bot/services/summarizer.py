@@ -0,0 +1,128 @@
+# ai_lu_bot/services/summarizer.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Set, Tuple
+
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.services.scheduler import SchedulerRejected
+
+logger = logging.getLogger(__name__)
+
+# Размер краткого содержания по умолчанию (токены по оценке prompt_builder.estimate_tokens)
+DEFAULT_SUMMARY_MAX_TOKENS = 300
+
+
+class ContextSummarizer:
+    """
+    Фоновое сжатие вытесненного контекста: записи, выпавшие из окна чата, раз в interval секунд
+    сворачиваются моделью в краткое содержание, которое хранится рядом с окном в менеджере контекста.
+    build_prompt добавляет его одним блоком, так что давняя переписка не теряется, а промпт не растёт.
+
+    Сжатие идёт вне пути ответа: хэндлер только отмечает чат (notify), а запросы к модели уходят
+    с фоновым приоритетом планировщика и под нагрузкой просто откладываются до следующего прохода.
+    """
+    def __init__(
+        self,
+        context_manager: Any,
+        gemini_service: Any,
+        interval: float = 60.0,
+        min_batch: int = 20,
+        max_summary_tokens: int = DEFAULT_SUMMARY_MAX_TOKENS,
+        cache_size: int = 2000,
+        cache_ttl: float = 600.0,
+    ):
+        """
+        Args:
+            context_manager: Менеджер контекста с get_evicted/get_summary/set_summary.
+            gemini_service: GeminiService (метод summarize).
+            interval: Период фонового прохода по отмеченным чатам (секунды).
+            min_batch: Сколько вытесненных записей должно накопиться, чтобы обновить содержание.
+            max_summary_tokens: Желаемый размер краткого содержания в токенах.
+            cache_size: Сколько содержаний держать в памяти процесса для пути ответа (LRU).
+            cache_ttl: Через сколько секунд содержание из кэша перечитывается (его мог обновить другой инстанс).
+        """
+        self._context = context_manager
+        self._gemini = gemini_service
+        self._interval = interval
+        self._min_batch = min_batch
+        self._max_tokens = max_summary_tokens
+        self._cache: "OrderedDict[int, Tuple[Optional[str], float]]" = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._dirty: Set[int] = set()
+        logger.info(
+            "ContextSummarizer initialized: interval = %.0fs, min_batch = %d, max_summary_tokens = %d",
+            interval, min_batch, max_summary_tokens,
+        )
+
+    def notify(self, chat_id: int) -> None:
+        """Отмечает чат, в который пришли новые записи: при следующем проходе проверится, не пора ли сжимать."""
+        self._dirty.add(chat_id)
+
+    def pending(self) -> int:
+        """Сколько чатов ждут проверки (для метрик)."""
+        return len(self._dirty)
+
+    def _remember(self, chat_id: int, summary: Optional[str]) -> None:
+        self._cache[chat_id] = (summary, time.monotonic())
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def summary_for(self, chat_id: int) -> Optional[str]:
+        """Краткое содержание для промпта: из кэша процесса, при промахе — из менеджера контекста. Ошибки не пробрасываются."""
+        cached = self._cache.get(chat_id)
+        if cached is not None and time.monotonic() - cached[1] < self._cache_ttl:
+            self._cache.move_to_end(chat_id)
+            return cached[0]
+        try:
+            summary = await self._context.get_summary(chat_id)
+        except Exception as e:
+            logger.warning("Failed to load context summary for chat %d: %s", chat_id, e)
+            return cached[0] if cached is not None else None
+        self._remember(chat_id, summary)
+        return summary
+
+    async def compact(self, chat_id: int) -> bool:
+        """
+        Сворачивает накопившиеся вытесненные записи чата в краткое содержание.
+        Возвращает True, если чат больше не нужно проверять (сжат или записей мало),
+        и False, если попытку надо повторить позже.
+        """
+        try:
+            entries = await self._context.get_evicted(chat_id)
+            if len(entries) < self._min_batch:
+                return True
+            previous = await self.summary_for(chat_id)
+            started = time.monotonic()
+            summary = await self._gemini.summarize(chat_id, previous, entries, self._max_tokens)
+            if not summary:
+                return False
+            await self._context.set_summary(chat_id, summary, len(entries))
+        except SchedulerRejected:
+            # Планировщик занят ответами пользователям — сожмём в следующий раз
+            metrics.inc("context_summaries", result="deferred")
+            return False
+        except Exception as e:
+            metrics.inc("context_summaries", result="error")
+            logger.warning("Failed to summarize evicted context of chat %d: %s", chat_id, e)
+            return False
+        self._remember(chat_id, summary)
+        metrics.inc("context_summaries", result="ok")
+        metrics.inc("context_summary_entries", len(entries))
+        logger.info(
+            "Folded %d evicted entries of chat %d into its summary (%d chars) in %.1fs.",
+            len(entries), chat_id, len(summary), time.monotonic() - started,
+        )
+        return True
+
+    async def run(self) -> None:
+        """Фоновый цикл: раз в interval секунд обходит отмеченные чаты по одному."""
+        while True:
+            await asyncio.sleep(self._interval)
+            chat_ids, self._dirty = self._dirty, set()
+            for chat_id in chat_ids:
+                if not await self.compact(chat_id):
+                    self._dirty.add(chat_id)
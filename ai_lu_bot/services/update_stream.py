@@ -0,0 +1,393 @@
+# ai_lu_bot/services/update_stream.py
+"""
+Очередь обновлений Telegram в Redis Streams для раздельного приёма и обработки (BOT_ROLE=ingest / worker).
+
+Приём (UpdateStreamPublisher) пишет сырые обновления в один из потоков updates:stream:<p>, p = chat_id % partitions.
+Обработчики (UpdateStreamWorker) читают потоки через общую группу потребителей. Каждым потоком в каждый момент
+владеет ровно один обработчик (аренда updates:lease:<p> с TTL), поэтому обновления одного чата обрабатываются
+одним процессом в порядке записи — дальше порядок внутри чата обеспечивает тот же ChatSequencer, что и в одном процессе.
+Потоки делятся между живыми обработчиками поровну (список — updates:workers); при добавлении обработчика лишние
+потоки дочитываются и отпускаются, при падении — аренда истекает и поток забирает другой обработчик вместе
+с неподтверждёнными записями (XAUTOCLAIM). Доставка — "хотя бы один раз": обновление, обработанное упавшим
+процессом до XACK, будет обработано повторно.
+"""
+import asyncio
+import logging
+import math
+import os
+import random
+import socket
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError, ResponseError
+
+from ai_lu_bot.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Число потоков (партиций): верхняя граница числа одновременно работающих обработчиков
+DEFAULT_PARTITIONS = 16
+# Примерная максимальная длина одного потока (XADD MAXLEN ~): защита Redis от переполнения, если обработчики стоят
+DEFAULT_STREAM_MAXLEN = 100000
+# Срок аренды потока (секунды): за это время поток упавшего обработчика переходит к другому
+DEFAULT_LEASE_TTL = 15.0
+# Через сколько секунд без подтверждения запись считается зависшей и обрабатывается заново
+DEFAULT_CLAIM_IDLE = 60.0
+
+_GROUP = "workers"
+_WORKERS_KEY = "updates:workers"
+_FIELD = b"update"
+
+# Продление и снятие аренды — только если она всё ещё наша
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def partition_for(chat_id: Optional[int], partitions: int) -> int:
+    """Номер потока для чата (обновления без чата — в поток 0)."""
+    return chat_id % partitions if chat_id is not None else 0
+
+
+def stream_key(partition: int) -> str:
+    return f"updates:stream:{partition}"
+
+
+def lease_key(partition: int) -> str:
+    return f"updates:lease:{partition}"
+
+
+def _client(host: str, port: int, db: int, max_connections: int, socket_timeout: float) -> aioredis.Redis:
+    pool = aioredis.BlockingConnectionPool(
+        host=host, port=port, db=db, max_connections=max_connections, socket_timeout=socket_timeout,
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+class UpdateStreamPublisher:
+    """
+    Сторона приёма: вместо обработки кладёт обновление (Update.to_json()) в поток его чата.
+    Регистрируется в Application как TypeHandler(Update, publisher.handle).
+    """
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        partitions: int = DEFAULT_PARTITIONS,
+        maxlen: int = DEFAULT_STREAM_MAXLEN,
+        max_connections: int = 20,
+        socket_timeout: float = 5.0,
+        attempts: int = 3,
+    ):
+        """
+        Args:
+            host, port, db: Параметры подключения к Redis.
+            partitions: Число потоков (должно совпадать у приёма и обработчиков).
+            maxlen: Примерная максимальная длина потока (0 — без ограничения).
+            max_connections, socket_timeout: Пул соединений клиента Redis.
+            attempts: Сколько раз пробовать записать обновление, прежде чем потерять его.
+        """
+        self._address = f"redis://{host}:{port}/{db}"
+        self._partitions = partitions
+        self._maxlen = maxlen or None
+        self._attempts = max(attempts, 1)
+        self._client = _client(host, port, db, max_connections, socket_timeout)
+
+    async def connect(self) -> bool:
+        try:
+            await self._client.ping()
+        except RedisError as e:
+            logger.error("Update stream publisher failed to connect to %s: %s", self._address, e)
+            return False
+        logger.info("Update stream publisher connected to %s (%d partitions).", self._address, self._partitions)
+        return True
+
+    async def publish(self, chat_id: Optional[int], payload: str) -> Any:
+        """Записывает обновление в поток чата; возвращает id записи."""
+        partition = partition_for(chat_id, self._partitions)
+        for attempt in range(self._attempts):
+            try:
+                entry_id = await self._client.xadd(stream_key(partition), {_FIELD: payload}, maxlen=self._maxlen, approximate=True)
+            except RedisError:
+                if attempt + 1 == self._attempts:
+                    metrics.inc("updates_published", result="error")
+                    raise
+                await asyncio.sleep(0.2 * 2 ** attempt)
+                continue
+            metrics.inc("updates_published", result="ok")
+            return entry_id
+
+    async def handle(self, update: Any, context: Any) -> None:
+        """Callback для TypeHandler: Telegram уже получил подтверждение, поэтому обновление нужно сохранить здесь."""
+        chat = update.effective_chat
+        await self.publish(chat.id if chat is not None else None, update.to_json())
+
+    async def close(self) -> None:
+        await self._client.aclose()
+        await self._client.connection_pool.disconnect()
+
+
+class UpdateStreamWorker:
+    """
+    Обработчик: владеет частью потоков, читает их через группу потребителей и передаёт каждое обновление
+    в handler (обычно Application.process_update) с ограничением параллелизма. Запись подтверждается (XACK)
+    после обработки — в том числе неуспешной: ошибку уже разобрал error handler, а повтор её не исправит.
+    """
+    def __init__(
+        self,
+        handler: Callable[[str], Awaitable[None]],
+        host: str = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        partitions: int = DEFAULT_PARTITIONS,
+        consumer: Optional[str] = None,
+        concurrency: int = 32,
+        lease_ttl: float = DEFAULT_LEASE_TTL,
+        claim_idle: float = DEFAULT_CLAIM_IDLE,
+        batch: int = 50,
+        block: float = 1.0,
+        max_connections: int = 20,
+        socket_timeout: float = 5.0,
+    ):
+        """
+        Args:
+            handler: Корутина обработки одного обновления (JSON из Update.to_json()).
+            host, port, db: Параметры подключения к Redis.
+            partitions: Число потоков (как у приёма).
+            consumer: Имя обработчика в группе (по умолчанию <hostname>-<pid>).
+            concurrency: Сколько обновлений обрабатывается одновременно.
+            lease_ttl: Срок аренды потока; продлевается каждые lease_ttl / 3 секунды.
+            claim_idle: Через сколько секунд без подтверждения запись забирается и обрабатывается заново.
+            batch: Сколько записей читать из потока за раз.
+            block: Сколько ждать новых записей в одном XREADGROUP (секунды, меньше socket_timeout).
+            max_connections, socket_timeout: Пул соединений клиента Redis.
+        """
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self._handler = handler
+        self._partitions = partitions
+        self._concurrency = max(concurrency, 1)
+        self._lease_ms = int(lease_ttl * 1000)
+        self._rebalance_interval = lease_ttl / 3
+        self._claim_idle_ms = int(claim_idle * 1000)
+        self._batch = batch
+        self._block_ms = int(min(block, socket_timeout / 2) * 1000)
+        self._address = f"redis://{host}:{port}/{db}"
+        self._client = _client(host, port, db, max_connections, socket_timeout)
+        self._renew_script = self._client.register_script(_RENEW_SCRIPT)
+        self._release_script = self._client.register_script(_RELEASE_SCRIPT)
+        self._owned: Set[int] = set()
+        # Потоки, которые отдаются другим обработчикам: новые записи не читаются, ждём завершения начатых
+        self._draining: Set[int] = set()
+        # Только что полученные потоки: сначала забираются неподтверждённые записи прежнего владельца
+        self._fresh: Set[int] = set()
+        self._in_flight: Dict[Tuple[int, bytes], asyncio.Task] = {}
+        self._slots = asyncio.Semaphore(self._concurrency)
+        self._stopping = asyncio.Event()
+
+    async def connect(self) -> bool:
+        try:
+            await self._client.ping()
+        except RedisError as e:
+            logger.error("Update stream worker failed to connect to %s: %s", self._address, e)
+            return False
+        logger.info("Update stream worker %s connected to %s (%d partitions).", self.consumer, self._address, self._partitions)
+        return True
+
+    def stop(self) -> None:
+        """Просит run() завершиться: чтение прекращается, начатые обновления дорабатываются."""
+        self._stopping.set()
+
+    def stats(self) -> Dict[str, int]:
+        """Сколько потоков у обработчика, сколько из них отдаётся и сколько обновлений обрабатывается (для метрик)."""
+        return {"owned": len(self._owned), "draining": len(self._draining), "in_flight": len(self._in_flight)}
+
+    async def run(self) -> None:
+        """
+        Основной цикл: чтение новых записей и подбор зависших. Аренды продлеваются отдельной задачей,
+        чтобы долгие ответы модели не задерживали продление. Возвращается после stop().
+        """
+        lease_task = asyncio.create_task(self._lease_loop(), name="update-stream-leases")
+        next_claim = 0.0
+        try:
+            while not self._stopping.is_set():
+                try:
+                    # Неподтверждённые записи прежнего владельца идут первыми, до новых — порядок в чате сохраняется
+                    for partition in sorted(self._fresh):
+                        await self._claim(partition, 0)
+                        self._fresh.discard(partition)
+                    if time.monotonic() >= next_claim:
+                        for partition in sorted(self._owned - self._draining):
+                            await self._claim(partition, self._claim_idle_ms)
+                        next_claim = time.monotonic() + self._claim_idle_ms / 2000
+                    await self._read()
+                except RedisError as e:
+                    metrics.inc("update_stream_errors")
+                    logger.warning("Update stream worker %s: Redis error, retrying in 1s: %s", self.consumer, e)
+                    await self._sleep(1.0)
+        finally:
+            lease_task.cancel()
+            await self._shutdown()
+
+    async def _sleep(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _lease_loop(self) -> None:
+        while True:
+            try:
+                await self._rebalance()
+            except RedisError as e:
+                metrics.inc("update_stream_errors")
+                logger.warning("Update stream worker %s failed to renew its leases: %s", self.consumer, e)
+            await asyncio.sleep(self._rebalance_interval)
+
+    async def _rebalance(self) -> None:
+        """Продлевает свои аренды, отдаёт лишние потоки и берёт свободные, чтобы у каждого было ~partitions / workers."""
+        now = time.time()
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.zadd(_WORKERS_KEY, {self.consumer: now})
+            pipe.zremrangebyscore(_WORKERS_KEY, "-inf", now - self._lease_ms / 1000)
+            pipe.zcard(_WORKERS_KEY)
+            _, _, live_workers = await pipe.execute()
+        target = math.ceil(self._partitions / max(live_workers, 1))
+
+        for partition in sorted(self._owned):
+            if not await self._renew_script(keys=[lease_key(partition)], args=[self.consumer, self._lease_ms]):
+                # Аренда истекла (процесс надолго зависал) и, возможно, уже у другого: поток больше не читаем
+                self._owned.discard(partition)
+                self._draining.discard(partition)
+                self._fresh.discard(partition)
+                metrics.inc("update_stream_leases", result="lost")
+                logger.warning("Update stream worker %s lost the lease on partition %d.", self.consumer, partition)
+
+        # Отдаваемый поток отпускается не раньше следующего прохода: чтение, начатое до пометки, успевает завершиться
+        for partition in sorted(self._draining):
+            if not any(p == partition for p, _ in self._in_flight):
+                await self._release_script(keys=[lease_key(partition)], args=[self.consumer])
+                self._owned.discard(partition)
+                self._draining.discard(partition)
+                metrics.inc("update_stream_leases", result="released")
+        active = sorted(self._owned - self._draining)
+        for partition in active[target:]:
+            self._draining.add(partition)
+            self._fresh.discard(partition)
+            logger.info("Update stream worker %s hands partition %d over (%d live workers).", self.consumer, partition, live_workers)
+
+        if len(self._owned) >= target:
+            return
+        free = [p for p in range(self._partitions) if p not in self._owned]
+        random.shuffle(free)
+        for partition in free:
+            if len(self._owned) >= target:
+                break
+            if not await self._client.set(lease_key(partition), self.consumer, nx=True, px=self._lease_ms):
+                continue
+            await self._ensure_group(partition)
+            self._owned.add(partition)
+            self._fresh.add(partition)
+            metrics.inc("update_stream_leases", result="acquired")
+            logger.info("Update stream worker %s took partition %d.", self.consumer, partition)
+
+    async def _ensure_group(self, partition: int) -> None:
+        try:
+            await self._client.xgroup_create(stream_key(partition), _GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _claim(self, partition: int, min_idle_ms: int) -> None:
+        """Забирает себе неподтверждённые записи потока, пролежавшие дольше min_idle_ms, и обрабатывает их."""
+        start = "0-0"
+        while True:
+            start, entries, *_ = await self._client.xautoclaim(
+                stream_key(partition), _GROUP, self.consumer, min_idle_ms, start_id=start, count=self._batch,
+            )
+            for entry_id, fields in entries:
+                if (partition, entry_id) in self._in_flight:
+                    continue
+                metrics.inc("updates_reclaimed")
+                await self._dispatch(partition, entry_id, fields)
+            if start in (b"0-0", "0-0"):
+                return
+
+    async def _read(self) -> None:
+        readable = self._owned - self._draining - self._fresh
+        if not readable:
+            await self._sleep(self._block_ms / 1000)
+            return
+        # Не читаем больше, чем можем сразу начать обрабатывать: остальное пусть ждёт в Redis
+        free = self._concurrency - len(self._in_flight)
+        if free <= 0:
+            async with self._slots:
+                return
+        response = await self._client.xreadgroup(
+            _GROUP, self.consumer, {stream_key(p): ">" for p in sorted(readable)},
+            count=min(self._batch, free), block=self._block_ms,
+        )
+        for stream, entries in response or ():
+            partition = int(stream.rsplit(b":", 1)[-1] if isinstance(stream, bytes) else stream.rsplit(":", 1)[-1])
+            for entry_id, fields in entries:
+                await self._dispatch(partition, entry_id, fields)
+
+    async def _dispatch(self, partition: int, entry_id: bytes, fields: Optional[Dict[bytes, bytes]]) -> None:
+        # Задачи создаются в порядке записей потока и в этом же порядке (до первого await обработчика) берут билеты ChatSequencer
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(partition, entry_id, fields), name=f"update-{partition}-{entry_id}")
+        self._in_flight[(partition, entry_id)] = task
+
+    async def _process(self, partition: int, entry_id: bytes, fields: Optional[Dict[bytes, bytes]]) -> None:
+        started = time.perf_counter()
+        result = "ok"
+        try:
+            payload = (fields or {}).get(_FIELD)
+            if payload is None:
+                # Запись удалена обрезкой потока (MAXLEN) раньше, чем её обработали
+                result = "trimmed"
+            else:
+                await self._handler(payload.decode("utf-8"))
+        except Exception:
+            result = "error"
+            logger.exception("Update stream worker %s failed to process entry %s of partition %d.", self.consumer, entry_id, partition)
+        finally:
+            try:
+                await self._client.xack(stream_key(partition), _GROUP, entry_id)
+            except RedisError as e:
+                # Без подтверждения запись через claim_idle обработает этот или другой обработчик
+                logger.warning("Update stream worker %s failed to ack entry %s: %s", self.consumer, entry_id, e)
+            self._in_flight.pop((partition, entry_id), None)
+            self._slots.release()
+            metrics.inc("updates_processed", result=result)
+            metrics.observe("update_process_seconds", time.perf_counter() - started)
+
+    async def _shutdown(self, timeout: float = 30.0) -> None:
+        tasks: List[asyncio.Task] = list(self._in_flight.values())
+        if tasks:
+            logger.info("Update stream worker %s: waiting for %d updates in progress...", self.consumer, len(tasks))
+            await asyncio.wait(tasks, timeout=timeout)
+        try:
+            for partition in sorted(self._owned):
+                await self._release_script(keys=[lease_key(partition)], args=[self.consumer])
+            await self._client.zrem(_WORKERS_KEY, self.consumer)
+        except RedisError as e:
+            logger.warning("Update stream worker %s failed to release its leases: %s", self.consumer, e)
+        self._owned.clear()
+        self._draining.clear()
+        self._fresh.clear()
+
+    async def close(self) -> None:
+        await self._client.aclose()
+        await self._client.connection_pool.disconnect()
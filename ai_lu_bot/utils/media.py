@@ -1,35 +1,218 @@
 # ai_lu_bot/utils/media.py
+import asyncio
 import io
 import logging
+import mmap
+import re
+import tempfile
+from typing import Dict, Optional, Sequence, Tuple
+
 from telegram import Voice, VideoNote, PhotoSize
 
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.utils.media_cache import MediaCache, MediaData
+
+try: # Pillow опционален: без него фото не перекодируются локально
+    from PIL import Image
+except ImportError:
+    Image = None
+
 logger = logging.getLogger(__name__)
 
+MIME_TYPES = {"image": "image/jpeg", "audio": "audio/ogg", "video": "video/mp4"}
+# Максимальный размер медиа по типу (байты) по умолчанию; переопределяется через download_media(max_bytes=...)
+DEFAULT_MAX_MEDIA_BYTES: Dict[str, int] = {
+    "image": 10 * 1024 * 1024,
+    "audio": 20 * 1024 * 1024,
+    "video": 20 * 1024 * 1024,
+}
+# Файлы крупнее этого порога скачиваются во временный файл на диске, а не в память
+SPOOL_TO_DISK_BYTES = 4 * 1024 * 1024
+# Токен бота в URL файлов Bot API (https://api.telegram.org/file/bot<TOKEN>/...): в логи и ошибки он не попадает
+_BOT_TOKEN_RE = re.compile(r"bot\d+:[\w-]+")
+
+# Целевая длинная сторона фото (пиксели) по триггеру ответа: берётся наименьший PhotoSize, не меньше цели.
+# Случайные ответы в группах — "мимоходом", им хватает превью поменьше.
+DEFAULT_PHOTO_TARGET_SIDE = 1280
+DEFAULT_PHOTO_TARGET_SIDES: Dict[str, int] = {
+    "dm": 1280,
+    "reply_to_bot": 1280,
+    "creator_message_user": 1280,
+    "channel_post_forwarded_or_sent_as": 1280,
+    "random_group_message": 800,
+}
+# Ступени качества JPEG при локальном перекодировании в бюджет
+_REENCODE_QUALITIES = (85, 75, 60, 45)
 
 class MediaDownloadError(Exception):
     """Ошибка при скачивании медиа из Telegram."""
 
 
-async def download_media(media_obj: Voice | VideoNote | PhotoSize, media_type: str) -> tuple[bytes, str]:
+class MediaTooLargeError(MediaDownloadError):
+    """Медиафайл превышает допустимый размер для своего типа."""
+
+
+class _CappedBuffer:
     """
-    Скачивает media_obj в память, возвращает (bytes, mime_type).
-    Бросает MediaDownloadError при любых проблемах.
+    Приёмник скачиваемых данных с жёстким лимитом размера.
+    При известном размере память выделяется один раз заранее; крупные файлы пишутся
+    во временный файл и отдаются через mmap. Результат — memoryview без копирования данных.
     """
+    def __init__(self, expected_size: Optional[int], max_bytes: int):
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._expected = expected_size or 0
+        self._file = None
+        self._buffer: Optional[bytearray] = None
+        if expected_size and expected_size > SPOOL_TO_DISK_BYTES:
+            self._file = tempfile.TemporaryFile()
+        else:
+            # Буфер точного размера; если размер неизвестен — растущий bytearray
+            self._buffer = bytearray(self._expected)
+
+    def write(self, chunk: bytes) -> int:
+        new_size = self._size + len(chunk)
+        if new_size > self._max_bytes:
+            raise MediaTooLargeError(f"Файл больше допустимых {self._max_bytes} байт")
+        if self._file is not None:
+            self._file.write(chunk)
+        elif new_size <= self._expected:
+            self._buffer[self._size:new_size] = chunk # Запись в заранее выделенную память без realloc
+        else:
+            self._buffer[self._size:] = chunk # Размер оказался больше заявленного — буфер растёт
+        self._size = new_size
+        return len(chunk)
+
+    def result(self) -> memoryview:
+        if self._file is not None:
+            self._file.flush()
+            mapping = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._file.close() # Отображение остаётся валидным и после закрытия файла
+            return memoryview(mapping)
+        return memoryview(self._buffer)[:self._size]
+
+    def close(self) -> None:
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+
+def _redact(text: str) -> str:
+    """Убирает токен бота из текста ошибки."""
+    return _BOT_TOKEN_RE.sub("bot<token>", text)
+
+
+async def _fetch_media(media_obj: Voice | VideoNote | PhotoSize, media_type: str, max_bytes: int) -> Tuple[memoryview, str]:
+    """
+    Скачивает media_obj из Telegram, возвращает (memoryview, mime_type).
+    Скачивание идёт через PTB (его прокси, таймауты и пул соединений) в приёмник с лимитом размера.
+    Размер проверяется до скачивания (по file_size) и при записи — превышение лимита прерывает загрузку.
+    """
+    mime = MIME_TYPES.get(media_type)
+    if not mime:
+        raise MediaDownloadError(f"Неизвестный media_type: {media_type}")
+
+    declared_size = getattr(media_obj, "file_size", None)
+    if declared_size and declared_size > max_bytes:
+        raise MediaTooLargeError(f"Файл {declared_size} байт больше допустимых {max_bytes} байт для {media_type}")
+
+    buffer = None
     try:
         tg_file = await media_obj.get_file()
-        buffer = io.BytesIO()
+        expected_size = tg_file.file_size or declared_size
+        if expected_size and expected_size > max_bytes:
+            raise MediaTooLargeError(f"Файл {expected_size} байт больше допустимых {max_bytes} байт для {media_type}")
+
+        buffer = _CappedBuffer(expected_size, max_bytes)
         await tg_file.download_to_memory(buffer)
-        data = buffer.getvalue()
-        buffer.close()
+
+        data = buffer.result()
         if not data:
             raise MediaDownloadError("Пустые данные после скачивания")
-
-        mime_map = {"image": "image/jpeg", "audio": "audio/ogg", "video": "video/mp4"}
-        mime = mime_map.get(media_type)
-        if not mime:
-            raise MediaDownloadError(f"Неизвестный media_type: {media_type}")
         return data, mime
 
+    except MediaDownloadError:
+        logger.warning("download_media rejected %s file: size limit or empty data", media_type, exc_info=True)
+        raise
+    except Exception as e:
+        # Текст ошибки сети может содержать URL файла вместе с токеном бота — без трассировки и без исходной ошибки
+        reason = f"{type(e).__name__}: {_redact(str(e))}"
+        logger.error("download_media error for %s file: %s", media_type, reason)
+        raise MediaDownloadError(f"Не удалось скачать {media_type}: {reason}") from None
+    finally:
+        if buffer is not None:
+            buffer.close()
+
+
+async def download_media(
+    media_obj: Voice | VideoNote | PhotoSize,
+    media_type: str,
+    cache: Optional[MediaCache] = None,
+    max_bytes: Optional[int] = None,
+) -> tuple[MediaData, str]:
+    """
+    Скачивает media_obj, возвращает (данные, mime_type). Данные — memoryview поверх
+    буфера загрузки (или mmap для крупных файлов), без промежуточных копий.
+    Если передан cache, файл ищется по file_unique_id (одинаков во всех чатах),
+    а одновременные запросы одного файла объединяются в одно скачивание.
+    Бросает MediaDownloadError при любых проблемах (MediaTooLargeError — при превышении max_bytes).
+    """
+    limit = max_bytes or DEFAULT_MAX_MEDIA_BYTES.get(media_type, SPOOL_TO_DISK_BYTES)
+    file_unique_id = getattr(media_obj, "file_unique_id", None)
+    if cache is None or not file_unique_id:
+        return await _fetch_media(media_obj, media_type, limit)
+    return await cache.get_or_load(f"{file_unique_id}:{media_type}", lambda: _fetch_media(media_obj, media_type, limit))
+
+
+def select_photo_size(photo_sizes: Sequence[PhotoSize], target_side: int, trigger: str) -> PhotoSize:
+    """
+    Выбирает наименьший PhotoSize, длинная сторона которого не меньше target_side
+    (если таких нет или target_side <= 0 — самый большой). Экономию относительно
+    самого большого размера пишет в метрику media_photo_bytes_saved{stage=select}.
+    """
+    by_area = sorted(photo_sizes, key=lambda p: p.width * p.height)
+    largest = by_area[-1]
+    chosen = largest
+    if target_side > 0:
+        chosen = next((p for p in by_area if max(p.width, p.height) >= target_side), largest)
+
+    metrics.inc("media_photo_selected", trigger=trigger, side=max(chosen.width, chosen.height))
+    if chosen is not largest and largest.file_size and chosen.file_size:
+        metrics.inc("media_photo_bytes_saved", largest.file_size - chosen.file_size, trigger=trigger, stage="select")
+    logger.debug(
+        "Photo size for trigger '%s': %dx%d (%s bytes) instead of %dx%d (%s bytes).",
+        trigger, chosen.width, chosen.height, chosen.file_size, largest.width, largest.height, largest.file_size,
+    )
+    return chosen
+
+
+def _reencode_jpeg(data: MediaData, max_bytes: int, max_side: int) -> Optional[bytes]:
+    """Уменьшает и пережимает JPEG, пока он не уложится в max_bytes. None — если не получилось."""
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+        if max_side > 0:
+            image.thumbnail((max_side, max_side))
+        for quality in _REENCODE_QUALITIES:
+            out = io.BytesIO()
+            image.save(out, format="JPEG", quality=quality, optimize=True)
+            if out.tell() <= max_bytes:
+                return out.getvalue()
+    return None
+
+
+async def fit_photo_to_budget(data: MediaData, max_bytes: int, max_side: int, trigger: str) -> MediaData:
+    """
+    Если фото больше max_bytes, перекодирует его локально (в отдельном потоке) с понижением
+    разрешения до max_side и качества JPEG. Без Pillow или при неудаче возвращает исходные данные.
+    """
+    if max_bytes <= 0 or len(data) <= max_bytes or Image is None:
+        return data
+    try:
+        reencoded = await asyncio.to_thread(_reencode_jpeg, data, max_bytes, max_side)
     except Exception as e:
-        logger.error("download_media error", exc_info=True)
-        raise MediaDownloadError(str(e))
+        logger.warning("Failed to re-encode photo (%d bytes): %s", len(data), e)
+        return data
+    if reencoded is None or len(reencoded) >= len(data):
+        return data
+    metrics.inc("media_photo_bytes_saved", len(data) - len(reencoded), trigger=trigger, stage="reencode")
+    logger.debug("Photo re-encoded for trigger '%s': %d -> %d bytes.", trigger, len(data), len(reencoded))
+    return reencoded
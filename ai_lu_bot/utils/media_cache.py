@@ -0,0 +1,210 @@
+# ai_lu_bot/utils/media_cache.py
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from ai_lu_bot.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Данные медиа: bytes из памяти или memoryview поверх отображённого в память файла на диске
+MediaData = Union[bytes, memoryview]
+
+
+def container_memory_limit() -> Optional[int]:
+    """Лимит памяти контейнера из cgroup (v2 или v1) в байтах, либо None, если лимита нет."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            raw = Path(path).read_text().strip()
+        except OSError:
+            continue
+        if raw.isdigit() and int(raw) < 1 << 60: # В cgroup v1 "без лимита" — огромное число
+            return int(raw)
+    return None
+
+
+class _SpilledEntry:
+    """Медиафайл, вытесненный из памяти в файл на диске и отображённый через mmap."""
+    __slots__ = ("path", "size", "mime_type", "mapping")
+
+    def __init__(self, path: Path, size: int, mime_type: str, mapping: mmap.mmap):
+        self.path = path
+        self.size = size
+        self.mime_type = mime_type
+        self.mapping = mapping
+
+    def release(self) -> None:
+        try:
+            self.mapping.close()
+        except BufferError:
+            # На mmap ещё ссылается memoryview, отданный вызывающему коду: закроется сборщиком мусора
+            pass
+        self.path.unlink(missing_ok=True)
+
+
+class MediaCache:
+    """
+    LRU-кэш медиафайлов Telegram по file_unique_id (одинаков для одного и того же файла во всех чатах).
+
+    - Свежие файлы держатся в памяти в пределах memory_budget байт.
+    - Вытесненные из памяти файлы сбрасываются на локальный диск (в пределах disk_budget)
+      и читаются оттуда через mmap, не занимая память процесса.
+    - Одновременные запросы одного файла объединяются в одно скачивание.
+    """
+    def __init__(
+        self,
+        memory_budget: int = 32 * 1024 * 1024,
+        disk_budget: int = 256 * 1024 * 1024,
+        spill_dir: Optional[str] = None,
+        memory_fraction_of_limit: float = 0.05,
+    ):
+        """
+        Args:
+            memory_budget: Максимальный объём медиа в памяти (байты).
+            disk_budget: Максимальный объём медиа на диске (байты, 0 — не использовать диск).
+            spill_dir: Каталог для файлов на диске (по умолчанию во временном каталоге системы).
+            memory_fraction_of_limit: Не больше этой доли лимита памяти контейнера, если он задан.
+        """
+        limit = container_memory_limit()
+        if limit:
+            memory_budget = min(memory_budget, int(limit * memory_fraction_of_limit))
+        self._memory_budget = memory_budget
+        self._disk_budget = disk_budget
+        self._memory: "OrderedDict[str, Tuple[MediaData, str]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: "OrderedDict[str, _SpilledEntry]" = OrderedDict()
+        self._disk_bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._spill_dir = Path(spill_dir or Path(tempfile.gettempdir()) / "ai_lu_bot_media")
+        if self._disk_budget > 0:
+            self._spill_dir.mkdir(parents=True, exist_ok=True)
+            # Файлы прошлого запуска бесполезны: индекс живёт только в памяти
+            for stale in self._spill_dir.glob("*.bin"):
+                stale.unlink(missing_ok=True)
+        logger.info(
+            "MediaCache initialized: memory_budget = %d bytes (container limit: %s), disk_budget = %d bytes, spill_dir = %s",
+            self._memory_budget, limit or "none", self._disk_budget, self._spill_dir,
+        )
+
+    async def get_or_load(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Tuple[MediaData, str]]],
+    ) -> Tuple[MediaData, str]:
+        """
+        Возвращает (данные, mime_type) из кэша или вызывает loader (одно скачивание на все одновременные запросы).
+        Ошибки loader пробрасываются всем ожидающим и не кэшируются.
+        """
+        while True:
+            cached = self._lookup(key)
+            if cached is not None:
+                metrics.inc("media_cache_requests", result="hit")
+                return cached
+
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            metrics.inc("media_cache_requests", result="coalesced")
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise # Отменили нас самих
+                # Отменили скачивание, к которому мы присоединились, — пробуем заново
+
+        metrics.inc("media_cache_requests", result="miss")
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            data, mime_type = await loader()
+            future.set_result((data, mime_type))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение отдаётся ожидающим; если их нет, помечаем его как полученное
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        await self._store(key, data, mime_type)
+        return data, mime_type
+
+    def _lookup(self, key: str) -> Optional[Tuple[MediaData, str]]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+            return entry
+        spilled = self._disk.get(key)
+        if spilled is not None:
+            self._disk.move_to_end(key)
+            return memoryview(spilled.mapping), spilled.mime_type
+        return None
+
+    async def _store(self, key: str, data: MediaData, mime_type: str) -> None:
+        size = len(data)
+        if key in self._memory:
+            return
+        if size > self._memory_budget:
+            # Слишком большой для памяти файл сразу уходит на диск
+            await self._spill(key, data, mime_type)
+            return
+        # Храним то, что вернул загрузчик (в т.ч. memoryview), без копирования
+        self._memory[key] = (data, mime_type)
+        self._memory_bytes += size
+        while self._memory_bytes > self._memory_budget and self._memory:
+            victim_key, (victim_data, victim_mime) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(victim_data)
+            await self._spill(victim_key, victim_data, victim_mime)
+
+    async def _spill(self, key: str, data: MediaData, mime_type: str) -> None:
+        """Сбрасывает файл на диск и отображает его в память (mmap). Без дискового бюджета файл просто забывается."""
+        size = len(data)
+        if self._disk_budget <= 0 or size == 0 or size > self._disk_budget:
+            return
+        if key in self._disk:
+            return
+        path = self._spill_dir / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}_{os.getpid()}.bin"
+        try:
+            mapping = await asyncio.to_thread(self._write_and_map, path, data)
+        except OSError as e:
+            logger.warning("MediaCache: failed to spill %s to disk: %s", key, e)
+            return
+        self._disk[key] = _SpilledEntry(path, size, mime_type, mapping)
+        self._disk_bytes += size
+        while self._disk_bytes > self._disk_budget and self._disk:
+            _victim_key, victim = self._disk.popitem(last=False)
+            self._disk_bytes -= victim.size
+            victim.release()
+
+    @staticmethod
+    def _write_and_map(path: Path, data: MediaData) -> mmap.mmap:
+        with open(path, "w+b") as f:
+            f.write(data)
+            f.flush()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def stats(self) -> Dict[str, int]:
+        """Заполненность кэша (для метрик)."""
+        return {
+            "memory_items": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_budget": self._memory_budget,
+            "disk_items": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "inflight": len(self._inflight),
+        }
+
+    def close(self) -> None:
+        """Удаляет файлы на диске."""
+        for entry in self._disk.values():
+            entry.release()
+        self._disk.clear()
+        self._disk_bytes = 0
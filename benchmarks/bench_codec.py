@@ -0,0 +1,79 @@
+# benchmarks/bench_codec.py
+"""
+Микро-бенчмарк кодеков записей контекста: JSON против компактного двоичного формата.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_codec
+    python -m benchmarks.bench_codec --redis redis://localhost:6379/15   # + замер памяти Redis (MEMORY USAGE)
+"""
+import argparse
+import random
+import timeit
+
+from ai_lu_bot.core.codec import ContextEntry, decode_entry, get_codec
+from ai_lu_bot.core.context import MAX_CONTEXT_MESSAGES
+
+_WORDS = "ну да конечно опять эти ваши алгоритмы смысл жизни вопрос сарказм философия кофе бытие".split()
+
+
+def _sample_entries(count: int) -> list:
+    rnd = random.Random(42)
+    entries = []
+    for i in range(count):
+        from_bot = i % 3 == 2
+        text = " ".join(rnd.choice(_WORDS) for _ in range(rnd.randint(3, 60)))
+        entries.append(ContextEntry(
+            user="Бот" if from_bot else rnd.choice(["Создатель", "vasya_pupkin", "Чат 'Лушок'"]),
+            text=text,
+            from_bot=from_bot,
+            message_id=100000 + i,
+        ))
+    return entries
+
+
+def _bench(codec_name: str, entries: list, rounds: int) -> dict:
+    codec = get_codec(codec_name)
+    encoded = [codec.encode(entry) for entry in entries]
+    encode_time = timeit.timeit(lambda: [codec.encode(entry) for entry in entries], number=rounds)
+    decode_time = timeit.timeit(lambda: [decode_entry(raw) for raw in encoded], number=rounds)
+    per_op = rounds * len(entries)
+    return {
+        "codec": codec_name,
+        "encode_us": encode_time / per_op * 1e6,
+        "decode_us": decode_time / per_op * 1e6,
+        "avg_bytes": sum(len(raw) for raw in encoded) / len(encoded),
+        "encoded": encoded,
+    }
+
+
+def _redis_memory(url: str, results: list) -> None:
+    import redis # Синхронный клиент достаточен для бенчмарка
+
+    client = redis.Redis.from_url(url)
+    for result in results:
+        key = f"bench:codec:{result['codec']}"
+        client.delete(key)
+        client.rpush(key, *result["encoded"])
+        result["redis_bytes"] = client.memory_usage(key, samples=0)
+        client.delete(key)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=MAX_CONTEXT_MESSAGES, help="Записей в окне (как в одном get)")
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--redis", help="URL Redis для замера MEMORY USAGE (используйте отдельную БД)")
+    args = parser.parse_args()
+
+    entries = _sample_entries(args.entries)
+    results = [_bench(name, entries, args.rounds) for name in ("json", "binary")]
+    if args.redis:
+        _redis_memory(args.redis, results)
+
+    print(f"{'codec':<8} {'encode, µs':>11} {'decode, µs':>11} {'bytes/entry':>12} {'redis bytes':>12}")
+    for r in results:
+        print(f"{r['codec']:<8} {r['encode_us']:>11.2f} {r['decode_us']:>11.2f} {r['avg_bytes']:>12.1f} {r.get('redis_bytes', '-'):>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# benchmarks/bench_key_pool.py
+"""
+Проверка маршрутизации запросов по пулу ключей Gemini без сети: GeminiService работает
+с заглушками (services/fake_backend.py), одна из которых отвечает ошибкой квоты.
+Печатает, сколько запросов принял каждый ключ, сколько ушло на повтор и состояние пула.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_key_pool
+"""
+import argparse
+import asyncio
+import time
+
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.services.fake_backend import FakeModelBackend
+from ai_lu_bot.services.gemini import GeminiService, ModelConfig
+from ai_lu_bot.services.key_pool import GeminiKeyPool
+
+
+async def _run(args: argparse.Namespace) -> None:
+    backends = [FakeModelBackend(name=f"fake{i}", latency=args.latency) for i in range(args.keys)]
+    # Первый ключ исчерпал квоту: пул должен вывести его из ротации и повторить запрос на другом
+    backends[0].failure = RuntimeError("429 Resource has been exhausted (e.g. check quota).")
+    backends[0].failure_rate = 1.0
+    pool = GeminiKeyPool(
+        backends,
+        labels=[backend.name for backend in backends],
+        requests_per_minute=args.key_rpm,
+        cooldown=args.cooldown,
+    )
+    service = GeminiService(model_config=ModelConfig(), key_pool=pool)
+
+    async def one_request(index: int) -> str:
+        await asyncio.sleep(index * args.spacing) # Запросы приходят потоком, а не все в один момент
+        key, response = await service._call_model(service.model_config, ["промпт " * 200], estimated_tokens=400)
+        pool.release(key, 400, response.usage_metadata.total_token_count)
+        return response.text
+
+    started = time.perf_counter()
+    replies = await asyncio.gather(*(one_request(i) for i in range(args.requests)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    failed = sum(1 for reply in replies if isinstance(reply, BaseException))
+    print(f"{args.requests} requests over {args.keys} keys in {elapsed:.2f}s, failed: {failed}")
+    for backend in backends:
+        print(f"  {backend.name:<8} calls {backend.calls:>5}  failures {backend.failures:>5}")
+    print("pool:", pool.stats())
+    print("metrics:", {k: v for k, v in metrics.snapshot()["counters"].items() if k.startswith("gemini_key")})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--spacing", type=float, default=0.002, help="interval between request arrivals, s")
+    parser.add_argument("--key-rpm", type=float, default=200)
+    parser.add_argument("--cooldown", type=float, default=60)
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# benchmarks/bench_memory_index.py
+"""
+Бенчмарк долгой памяти (BM25-индекс по истории чата): скорость индексации, размер индекса и время поиска.
+Корпус синтетический: слова с частотами по закону Ципфа и русскими окончаниями, как в живом чате.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_memory_index
+    python -m benchmarks.bench_memory_index --docs 200000 --queries 500
+    python -m benchmarks.bench_memory_index --redis redis://localhost:6379/15   # + индекс в Redis (используйте отдельную БД)
+"""
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+from urllib.parse import urlparse
+
+from ai_lu_bot.core.memory_index import InMemoryMemoryIndex, LongTermMemory, RedisMemoryIndex
+
+_SYLLABLES = "ка ли ро то ме на ви сло гра до пу зе ми ло ра ше ко бы ту фи".split()
+_ENDINGS = ["", "а", "ы", "ом", "ами", "ов", "ую", "ить", "ает", "ие"]
+_CHAT_ID = -100500
+
+
+def _vocabulary(size: int, rnd: random.Random) -> list:
+    return ["".join(rnd.choice(_SYLLABLES) for _ in range(rnd.randint(2, 4))) for _ in range(size)]
+
+
+def _corpus(docs: int, vocab_size: int, seed: int = 42) -> list:
+    rnd = random.Random(seed)
+    vocab = _vocabulary(vocab_size, rnd)
+    weights = [1 / rank for rank in range(1, vocab_size + 1)]
+    entries = []
+    for i in range(docs):
+        words = rnd.choices(vocab, weights, k=rnd.randint(3, 40))
+        entries.append({
+            "user": "Бот" if i % 3 == 2 else f"user_{rnd.randint(1, 30)}",
+            "text": " ".join(word + rnd.choice(_ENDINGS) for word in words),
+            "from_bot": i % 3 == 2,
+            "message_id": 1000 + i,
+        })
+    return entries
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def _fill(memory: LongTermMemory, entries: list, batch: int) -> float:
+    """Индексирует корпус порциями (как фоновый цикл LongTermMemory.run), возвращает мкс на сообщение."""
+    started = time.perf_counter()
+    for start in range(0, len(entries), batch):
+        for entry in entries[start:start + batch]:
+            memory.remember(_CHAT_ID, entry)
+        await memory.flush()
+    return (time.perf_counter() - started) / len(entries) * 1e6
+
+
+async def _query(memory: LongTermMemory, queries: list, k: int) -> dict:
+    latencies, found = [], 0
+    for query, source_id in queries:
+        started = time.perf_counter()
+        hits = await memory.recall(_CHAT_ID, query, k, timeout=5.0)
+        latencies.append(time.perf_counter() - started)
+        found += any(hit.message_id == source_id for hit in hits)
+    return {
+        "p50_ms": _percentile(latencies, 0.5) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "hit_rate": found / len(queries),
+    }
+
+
+async def _run(args) -> None:
+    entries = _corpus(args.docs, args.vocab)
+    # Запросы — начала сообщений корпуса старше окна контекста; качество поиска — доля запросов,
+    # для которых исходное сообщение попало в top-k
+    rnd = random.Random(7)
+    sources = [rnd.choice(entries[:-args.window]) for _ in range(args.queries)]
+    queries = [(" ".join(entry["text"].split()[:12]), entry["message_id"]) for entry in sources]
+    results = []
+
+    # Размер считается по tracemalloc при отдельном заполнении: с включённым трассированием замеры времени врут
+    # Тексты сообщений уже лежат в корпусе и в замер не попадают; оценка индекса, по которой работает лимит памяти, их учитывает
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    # Лимиты индекса сняты: архив не должен сокращаться во время замера
+    index = InMemoryMemoryIndex(max_docs_per_chat=args.docs + 1, max_bytes=2**40)
+    await _fill(LongTermMemory(index), entries, args.batch)
+    size = (tracemalloc.get_traced_memory()[0] - baseline) / 2**20
+    tracemalloc.stop()
+    estimated = index.stats()["bytes"] / 2**20
+    del index
+    memory = LongTermMemory(InMemoryMemoryIndex(max_docs_per_chat=args.docs + 1, max_bytes=2**40), window=args.window)
+    add_us = await _fill(memory, entries, args.batch)
+    results.append({"backend": "memory", "add_us": add_us, "size": f"{size:.1f} MiB", **await _query(memory, queries, args.k)})
+    print(f"in-memory index: {size:.1f} MiB allocated, {estimated:.1f} MiB estimated with message texts")
+
+    if args.redis:
+        import redis # Синхронный клиент достаточен для подготовки и замера памяти
+
+        url = urlparse(args.redis)
+        db = int(url.path.lstrip("/") or 0)
+        client = redis.Redis(host=url.hostname or "localhost", port=url.port or 6379, db=db)
+        client.flushdb()
+        memory = LongTermMemory(RedisMemoryIndex(host=url.hostname or "localhost", port=url.port or 6379, db=db), window=args.window)
+        add_us = await _fill(memory, entries, args.batch)
+        used = sum(client.memory_usage(key, samples=0) or 0 for key in client.scan_iter(f"memory:{_CHAT_ID}:*", count=1000))
+        results.append({"backend": "redis", "add_us": add_us, "size": f"{used / 2**20:.1f} MiB", **await _query(memory, queries, args.k)})
+        await memory.close()
+        client.flushdb()
+
+    print(f"docs={args.docs} vocab={args.vocab} queries={args.queries} k={args.k}")
+    print(f"{'backend':<8} {'add, µs/doc':>12} {'size':>10} {'p50, ms':>8} {'p95, ms':>8} {'p99, ms':>8} {'source@k':>9}")
+    for r in results:
+        print(
+            f"{r['backend']:<8} {r['add_us']:>12.1f} {r['size']:>10} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f}"
+            f" {r['p99_ms']:>8.2f} {r['hit_rate']:>9.0%}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=50000, help="Сообщений в архиве чата")
+    parser.add_argument("--vocab", type=int, default=20000, help="Размер словаря корпуса")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=3, help="Сколько давних сообщений возвращать")
+    parser.add_argument("--window", type=int, default=100, help="Размер окна контекста (его сообщения не ищутся)")
+    parser.add_argument("--batch", type=int, default=200, help="Сообщений за одну запись в индекс")
+    parser.add_argument("--redis", help="URL Redis для замера индекса в Redis (используйте отдельную БД)")
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
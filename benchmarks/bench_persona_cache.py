@@ -0,0 +1,98 @@
+# benchmarks/bench_persona_cache.py
+"""
+Проверка передачи персоны Лу модели (services/persona_cache.py) без сети, на заглушке модели
+(services/fake_backend.py), которая имитирует кэш контента API со сроком жизни:
+
+1. inline: персона в тексте каждого запроса (как было).
+2. system: персона отдельной system instruction — объём тот же, но промпт реплики отделён от неизменной части.
+3. cached: персона загружается в кэш один раз и продлевается до истечения (короткий TTL, чтобы продления были видны).
+4. cached, кэш истекает раньше срока: запрос, отвергнутый API, сразу повторяется с system instruction, кэш пересоздаётся.
+5. cached, API не поддерживает кэш: после одного отказа персона уходит system instruction.
+6. cached на модели по умолчанию (gemini-1.5-flash-latest): кэш этой модели заведомо не создаётся,
+   и вызовов создания нет вовсе. Выигрыш сценариев 3-4 есть только у моделей, которые кэшируют персону
+   такого размера (здесь — gemini-2.5-flash).
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_persona_cache
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.core.prompt_builder import PERSONA_INSTRUCTION
+from ai_lu_bot.services.fake_backend import FakeModelBackend
+from ai_lu_bot.services.gemini import GeminiService, ModelConfig, ModelRouter
+from ai_lu_bot.services.key_pool import GeminiKeyPool
+from ai_lu_bot.services.persona_cache import PersonaCache
+
+# Часть промпта, которая меняется от реплики к реплике (история и задание), — типичного размера
+_TURN = "6. БЛОК 6: КОНТЕКСТ ПЕРЕПИСКИ\n" + "[vasya_pupkin]: ну и что ты об этом думаешь?\n" * 40
+# Модель, кэш которой принимает персону (~2 тыс. токенов)
+_CACHING_MODEL = "gemini-2.5-flash"
+
+
+async def _scenario(
+    title: str, mode: str, backend: FakeModelBackend, args: argparse.Namespace, model_name: str = _CACHING_MODEL,
+) -> None:
+    config = ModelConfig(model_name=model_name)
+    persona_cache = None
+    if mode == "cached":
+        persona_cache = PersonaCache(PERSONA_INSTRUCTION, ttl=args.ttl, refresh_margin=args.ttl / 3, retry_after=3600)
+    service = GeminiService(
+        model_config=config,
+        key_pool=GeminiKeyPool([backend], labels=[backend.name]),
+        router=ModelRouter([], (config,)),
+        persona_mode=mode,
+        persona_cache=persona_cache,
+    )
+    service.warm_persona_cache()
+    # В режиме inline персона — часть текста запроса (build_prompt(include_persona=True))
+    content = [PERSONA_INSTRUCTION + _TURN if mode == "inline" else _TURN]
+    ok, errors = 0, 0
+    started = time.perf_counter()
+    for _ in range(args.requests):
+        await asyncio.sleep(args.spacing)
+        try:
+            key, response = await service._call_chain("dm", None, content, estimated_tokens=100, persona=True)
+        except Exception:
+            errors += 1
+            continue
+        service.key_pool.release(key, 100, response.usage_metadata.total_token_count)
+        ok += 1
+    elapsed = time.perf_counter() - started
+    print(
+        f"{title:<30} ok {ok:>4}/{args.requests}  sent {backend.sent_chars / max(backend.calls, 1) / 1000:>5.1f}k chars/req  "
+        f"via cache {backend.cached_calls:>4}  system {backend.system_calls:>4}  "
+        f"caches created {backend.caches_created:>2} extended {backend.caches_extended:>2}  errors {errors}  {elapsed:.1f}s"
+    )
+
+
+async def _run(args: argparse.Namespace) -> None:
+    def backend(**overrides) -> FakeModelBackend:
+        return FakeModelBackend(name="fake", latency=args.latency, **overrides)
+
+    await _scenario("inline", "inline", backend(), args)
+    await _scenario("system instruction", "system", backend(), args)
+    await _scenario("cached", "cached", backend(), args)
+    await _scenario("cached, expires early", "cached", backend(cache_ttl_cap=args.ttl / 2), args)
+    await _scenario("cached, unsupported", "cached", backend(cache_supported=False), args)
+    await _scenario("cached, gemini-1.5-latest", "cached", backend(), args, model_name=ModelConfig().model_name)
+
+    counters = metrics.snapshot()["counters"]
+    print("metrics:", {k: v for k, v in counters.items() if k.startswith(("persona_",))})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--spacing", type=float, default=0.01, help="interval between requests, s")
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--ttl", type=float, default=1.5, help="persona cache TTL, s")
+    logging.basicConfig(level=logging.ERROR) # Пересоздание кэша и отказы API пишут предупреждения
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# benchmarks/bench_prompt.py
+"""
+Бенчмарк сборки промпта: старая подстановка двумя str.replace по всему шаблону
+против предкомпилированных сегментов и кэша строк истории.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_prompt
+"""
+import argparse
+import timeit
+import tracemalloc
+from types import SimpleNamespace
+
+from ai_lu_bot.core.codec import ContextEntry
+from ai_lu_bot.core.context import MAX_CONTEXT_MESSAGES
+from ai_lu_bot.core.prompt_builder import _render_prompt, build_prompt
+from ai_lu_bot.prompt.base_prompt import BASE_PROMPT_TEMPLATE
+
+
+def _legacy_render(conversation_history_string: str, final_task_string: str) -> str:
+    """Прежняя реализация: два полных прохода str.replace по шаблону."""
+    return BASE_PROMPT_TEMPLATE.replace(
+        "{{CONVERSATION_HISTORY_PLACEHOLDER}}", conversation_history_string
+    ).replace(
+        "{{FINAL_TASK_PLACEHOLDER}}", final_task_string
+    )
+
+
+def _window(size: int) -> list:
+    return [
+        ContextEntry(user="vasya", text=f"сообщение номер {i} " * 8, from_bot=i % 2 == 1, message_id=1000 + i)
+        for i in range(size)
+    ]
+
+
+def _target_message(message_id: int) -> SimpleNamespace:
+    # Достаточно атрибутов, которые читает build_prompt
+    return SimpleNamespace(
+        message_id=message_id,
+        from_user=SimpleNamespace(username="vasya", first_name="Вася"),
+        forward_from_chat=None,
+        sender_chat=None,
+        text="а что ты думаешь о смысле жизни?",
+        caption=None,
+        photo=None,
+    )
+
+
+def _measure(label: str, func, rounds: int) -> None:
+    seconds = timeit.timeit(func, number=rounds)
+    tracemalloc.start()
+    func()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<34} {seconds / rounds * 1e6:>10.1f} µs/call {peak / 1024:>10.1f} KiB peak")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=5000)
+    args = parser.parse_args()
+
+    messages = _window(MAX_CONTEXT_MESSAGES)
+    target = _target_message(messages[-1].message_id)
+    history = "\n".join(f"[{m.user}]: {m.text}" for m in messages)
+    task = "ЗАДАНИЕ: Напиши ответ в стиле Лу на ПОСЛЕДНЕЕ сообщение в истории выше."
+
+    assert _legacy_render(history, task) == _render_prompt(history, task)
+
+    _measure("render: legacy str.replace x2", lambda: _legacy_render(history, task), args.rounds)
+    _measure("render: precompiled segments", lambda: _render_prompt(history, task), args.rounds)
+    _measure(
+        "build_prompt (warm history cache)",
+        lambda: build_prompt(chat_id=1, messages=messages, target_message=target, trigger="dm"),
+        args.rounds,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# benchmarks/bench_resilience.py
+"""
+Проверка слоя устойчивости вызова Gemini (services/resilience.py) без сети, на заглушках модели
+(services/fake_backend.py) с "хвостовыми" задержками и отказами:
+
+1. Хвост задержек: часть ответов медленные. Сравниваются p50/p95/p99 без хеджирования и с ним.
+2. Сбои 503: часть запросов падает. Видно, сколько спасли повторы.
+3. Авария: модель отвечает только 503. Автомат отключения открывается, и запросы отклоняются сразу.
+4. Отменённый пробный запрос: после аварии пробный запрос полуоткрытого автомата отменяют (как при вытеснении
+   новым сообщением); следующий запрос должен снова стать пробным и, когда модель ожила, закрыть автомат.
+5. Сбои 503 под лимитом RPM планировщика: каждый повтор списывается с лимита, поэтому вызовов модели
+   не больше, чем выданных планировщиком разрешений, а повторы без лимита не отправляются.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_resilience
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import time
+from typing import List, Optional
+
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.services.fake_backend import FakeModelBackend
+from ai_lu_bot.services.gemini import GeminiService, ModelConfig, ModelRouter
+from ai_lu_bot.services.key_pool import GeminiKeyPool
+from ai_lu_bot.services.resilience import ResilientCaller
+from ai_lu_bot.services.scheduler import GeminiScheduler
+
+SERVER_ERROR = RuntimeError("503 Service unavailable")
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def _scenario(
+    title: str,
+    backend: FakeModelBackend,
+    resilience: ResilientCaller,
+    args: argparse.Namespace,
+    scheduler: Optional[GeminiScheduler] = None,
+) -> None:
+    config = ModelConfig()
+    service = GeminiService(
+        model_config=config,
+        key_pool=GeminiKeyPool([backend], labels=[backend.name]),
+        scheduler=scheduler,
+        router=ModelRouter([], (config,)),
+        resilience=resilience,
+    )
+
+    async def one_request(index: int) -> float:
+        await asyncio.sleep(index * args.spacing)
+        started = time.perf_counter()
+        if scheduler is not None and await service._admit("dm", None, 100) is not None:
+            raise RuntimeError("rejected by scheduler")
+        key, response = await service._call_chain("dm", None, ["промпт " * 50], estimated_tokens=100)
+        service.key_pool.release(key, 100, response.usage_metadata.total_token_count)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one_request(i) for i in range(args.requests)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    latencies = [r for r in results if not isinstance(r, BaseException)]
+    errors: dict = {}
+    for r in results:
+        if isinstance(r, BaseException):
+            errors[type(r).__name__] = errors.get(type(r).__name__, 0) + 1
+    print(
+        f"{title:<28} ok {len(latencies):>4}/{args.requests}  calls {backend.calls:>4}  "
+        f"p50 {_percentile(latencies, 0.5) * 1000:>6.0f}ms  p95 {_percentile(latencies, 0.95) * 1000:>6.0f}ms  "
+        f"p99 {_percentile(latencies, 0.99) * 1000:>6.0f}ms  total {elapsed:.2f}s  errors {errors or '-'}"
+    )
+    if scheduler is not None:
+        counters = metrics.snapshot()["counters"]
+        granted = counters.get("gemini_scheduler_requests{priority=0,result=granted}", 0)
+        extra = counters.get("gemini_scheduler_extra_calls{priority=0,result=granted}", 0)
+        skipped = counters.get("gemini_scheduler_extra_calls{priority=0,result=skipped}", 0)
+        verdict = "ok" if backend.calls <= granted + extra else "FAIL"
+        print(f"{'':<28} scheduler: {granted} admitted + {extra} extra calls charged, {skipped} retries skipped  [{verdict}]")
+
+
+async def _cancelled_probe(args: argparse.Namespace) -> None:
+    config = ModelConfig()
+    backend = FakeModelBackend(name="recovering", latency=args.latency, failure=SERVER_ERROR, failure_rate=1.0)
+    resilience = ResilientCaller(max_attempts=1, attempt_timeout=2.0, breaker_threshold=1, breaker_reset=0.2)
+    service = GeminiService(
+        model_config=config,
+        key_pool=GeminiKeyPool([backend], labels=[backend.name]),
+        router=ModelRouter([], (config,)),
+        resilience=resilience,
+    )
+
+    async def request() -> str:
+        key, response = await service._call_chain("dm", None, ["промпт"], estimated_tokens=100)
+        service.key_pool.release(key, 100, response.usage_metadata.total_token_count)
+        return "ok"
+
+    with contextlib.suppress(Exception):
+        await request() # Сбой открывает автомат
+    await asyncio.sleep(0.25)
+    backend.failure_rate, backend.latency = 0.0, 1.0
+    probe = asyncio.create_task(request())
+    await asyncio.sleep(0.05)
+    probe.cancel() # Пробный запрос отменён на полпути
+    with contextlib.suppress(asyncio.CancelledError):
+        await probe
+    backend.latency = args.latency
+    try:
+        result = await request()
+    except Exception as e:
+        result = f"{type(e).__name__}: {e}"
+    state = resilience.breaker(config.model_name).state
+    verdict = "ok" if result == "ok" and state == "closed" else "FAIL"
+    print(f"{'cancelled half-open probe':<28} next request: {result}, circuit {state}  [{verdict}]")
+
+
+async def _run(args: argparse.Namespace) -> None:
+    def caller(**overrides) -> ResilientCaller:
+        options = dict(max_attempts=3, base_delay=0.05, max_delay=0.5, attempt_timeout=2.0, breaker_threshold=5, breaker_reset=30.0)
+        options.update(overrides)
+        return ResilientCaller(**options)
+
+    def tail_backend() -> FakeModelBackend:
+        return FakeModelBackend(name="tail", latency=args.latency, slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+
+    await _scenario("tail, no hedge", tail_backend(), caller(hedge=False), args)
+    await _scenario("tail, hedge after p95", tail_backend(), caller(hedge=True), args)
+
+    flaky = FakeModelBackend(name="flaky", latency=args.latency, failure=SERVER_ERROR, failure_rate=args.failure_rate)
+    await _scenario("503s, no retries", flaky, caller(max_attempts=1, breaker_threshold=10**6), args)
+    flaky = FakeModelBackend(name="flaky", latency=args.latency, failure=SERVER_ERROR, failure_rate=args.failure_rate)
+    await _scenario("503s, 3 attempts", flaky, caller(breaker_threshold=10**6), args)
+
+    down = FakeModelBackend(name="down", latency=args.latency, failure=SERVER_ERROR, failure_rate=1.0)
+    await _scenario("outage, circuit breaker", down, caller(), args)
+    await _cancelled_probe(args)
+
+    flaky = FakeModelBackend(name="flaky", latency=args.latency, failure=SERVER_ERROR, failure_rate=args.failure_rate)
+    # Корзина (четверть минутного лимита) плюс пополнение за время прогона — чуть больше числа запросов:
+    # места на все повторы в ней нет
+    rpm = args.requests * 1.02 / (0.25 + args.requests * args.spacing / 60)
+    await _scenario("503s, 3 attempts, rpm limit", flaky, caller(breaker_threshold=10**6), args, GeminiScheduler(requests_per_minute=rpm))
+
+    counters = metrics.snapshot()["counters"]
+    print("metrics:", {k: v for k, v in counters.items() if k.startswith(("gemini_retries", "gemini_hedge", "gemini_circuit"))})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--spacing", type=float, default=0.005, help="interval between request arrivals, s")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--slow-rate", type=float, default=0.03, help="share of requests with tail latency")
+    parser.add_argument("--slow-latency", type=float, default=0.5)
+    parser.add_argument("--failure-rate", type=float, default=0.1)
+    logging.basicConfig(level=logging.ERROR) # Скамейка ключей и повторы пишут предупреждения на каждый сбой
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
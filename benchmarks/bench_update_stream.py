@@ -0,0 +1,190 @@
+# benchmarks/bench_update_stream.py
+"""
+Сквозная проверка очереди обновлений в Redis Streams (services/update_stream.py) на локальном Redis:
+один процесс приёма (BOT_ROLE=ingest, webhook) и несколько обработчиков (BOT_ROLE=worker) без Telegram и Gemini.
+
+1. Поднимается заглушка Bot API (benchmarks/fake_bot_api.py), БД Redis очищается.
+2. Запускаются приём и --workers обработчиков (GEMINI_BACKEND=fake, контекст в Redis); ждём, пока приём
+   зарегистрирует webhook, а все потоки очереди разойдутся по обработчикам.
+3. Обновления отправляются POST на webhook приёма; для каждого ждётся ответ бота.
+   С --kill-one на середине один обработчик убивается (SIGKILL): его потоки вместе с неподтверждёнными
+   записями должны перейти к остальным после истечения аренды.
+
+Итог: сколько обновлений получило ответ, сколько потеряно, сколько обработано повторно (допустимо только
+после --kill-one), нарушен ли порядок сообщений в контексте чатов, задержки и распределение потоков по обработчикам.
+
+Запуск из корня проекта (используйте отдельную БД — она очищается):
+    python -m benchmarks.bench_update_stream --redis redis://localhost:6379/15
+    python -m benchmarks.bench_update_stream --redis redis://localhost:6379/15 --workers 4 --kill-one
+"""
+import argparse
+import asyncio
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+from collections import Counter
+from typing import Dict, List
+from urllib.parse import urlparse
+
+import httpx
+import redis # Синхронный клиент достаточен для подготовки и проверки состояния очереди
+
+from ai_lu_bot.core.context import RedisChatContextManager
+from ai_lu_bot.services.update_stream import lease_key, stream_key
+from benchmarks.bench_webhook import _free_port, _percentile
+from benchmarks.fake_bot_api import FakeBotApi, synthetic_updates, update_key
+
+
+def _base_env(api: FakeBotApi, args: argparse.Namespace) -> Dict[str, str]:
+    url = urlparse(args.redis)
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": "123456:FAKE-TOKEN",
+        "GEMINI_BACKEND": "fake",
+        "TELEGRAM_API_BASE_URL": api.base_url,
+        "REDIS_HOST": url.hostname or "localhost",
+        "REDIS_PORT": str(url.port or 6379),
+        "REDIS_DB": url.path.lstrip("/") or "0",
+        "UPDATE_STREAM_PARTITIONS": str(args.partitions),
+        "UPDATE_STREAM_LEASE_TTL": str(args.lease_ttl),
+        "UPDATE_STREAM_CLAIM_IDLE": str(args.claim_idle),
+        "METRICS_LOG_INTERVAL": "0",
+        "DM_DEBOUNCE_WINDOW": "0",
+    })
+    return env
+
+
+def _spawn(env: Dict[str, str], args: argparse.Namespace) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "ai_lu_bot.app"],
+        env=env,
+        stdout=subprocess.DEVNULL if not args.verbose else None,
+        stderr=subprocess.DEVNULL if not args.verbose else None,
+    )
+
+
+def _lease_owners(client: redis.Redis, partitions: int) -> List[str]:
+    return [owner.decode() if owner else "" for owner in client.mget([lease_key(p) for p in range(partitions)])]
+
+
+async def _wait_ready(api: FakeBotApi, client: redis.Redis, processes: List[subprocess.Popen], args: argparse.Namespace) -> float:
+    started = time.monotonic()
+    while api.webhook is None or not all(_lease_owners(client, args.partitions)):
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError(f"Bot process exited with code {process.returncode} during startup")
+        if time.monotonic() - started > args.startup_timeout:
+            raise RuntimeError("Ingest did not register the webhook or workers did not lease all partitions in time")
+        await asyncio.sleep(0.1)
+    return time.monotonic() - started
+
+
+async def _run(args: argparse.Namespace) -> None:
+    client = redis.Redis.from_url(args.redis)
+    client.flushdb()
+    api = FakeBotApi()
+    await api.start()
+    port = _free_port()
+    secret = secrets.token_urlsafe(16)
+    url = f"http://127.0.0.1:{port}/telegram"
+
+    ingest_env = _base_env(api, args)
+    ingest_env.update({
+        "BOT_ROLE": "ingest",
+        "UPDATE_MODE": "webhook",
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(port),
+        "WEBHOOK_URL": url,
+        "WEBHOOK_SECRET": secret,
+    })
+    processes = [_spawn(ingest_env, args)]
+    workers = []
+    for i in range(args.workers):
+        worker_env = _base_env(api, args)
+        worker_env.update({"BOT_ROLE": "worker", "UPDATE_WORKER_NAME": f"worker{i}", "CONTEXT_STORAGE_TYPE": "redis"})
+        workers.append(_spawn(worker_env, args))
+    processes.extend(workers)
+
+    try:
+        ready = await _wait_ready(api, client, processes, args)
+        print(f"ready in {ready:.1f}s: 1 ingest, {args.workers} workers, {args.partitions} partitions "
+              f"{dict(Counter(_lease_owners(client, args.partitions)))}")
+
+        updates = synthetic_updates(args.count, args.chats)
+        async with httpx.AsyncClient(timeout=10) as http:
+            async def deliver(index: int, update: dict):
+                await asyncio.sleep(index / args.rate)
+                sent = time.perf_counter()
+                response = await http.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+                replied = await api.wait_reply(update_key(update), args.reply_timeout) if response.status_code == 200 else None
+                return (replied - sent) if replied is not None else None
+
+            async def kill_one():
+                await asyncio.sleep(args.count / args.rate / 2)
+                workers[0].send_signal(signal.SIGKILL)
+                print(f"killed worker0 (pid {workers[0].pid}) after {args.count // 2} updates")
+
+            jobs = [deliver(i, update) for i, update in enumerate(updates)]
+            if args.kill_one and args.workers > 1:
+                jobs.append(kill_one())
+            results = await asyncio.gather(*jobs)
+        latencies = [r for r in results[:len(updates)] if r is not None]
+        owners = Counter(_lease_owners(client, args.partitions))
+        pending = sum(client.xpending(stream_key(p), "workers")["pending"] for p in range(args.partitions))
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=args.lease_ttl + 30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        await api.close()
+
+    keys = [update_key(update) for update in updates]
+    missing = sum(1 for key in keys if key not in api.replies)
+    duplicated = sum(1 for key in keys if api.reply_counts.get(key, 0) > 1)
+    # Сообщения чата должны лежать в его контексте в порядке поступления (ответы модели могут и обгонять друг друга)
+    redis_url = urlparse(args.redis)
+    context_manager = RedisChatContextManager(
+        host=redis_url.hostname or "localhost", port=redis_url.port or 6379, db=int(redis_url.path.lstrip("/") or 0),
+    )
+    chats = sorted({chat_id for chat_id, _ in keys})
+    out_of_order = 0
+    for chat_id in chats:
+        message_ids = [entry.message_id for entry in await context_manager.get(chat_id) if not entry.from_bot]
+        out_of_order += message_ids != sorted(message_ids)
+    await context_manager.close()
+    print(f"updates {len(keys)}  replied {len(keys) - missing}  missing {missing}  duplicated {duplicated}  "
+          f"chats out of order {out_of_order}/{len(chats)}  pending in streams {pending}")
+    print(
+        f"reply: p50 {_percentile(latencies, 0.5) * 1000:7.1f}ms  p95 {_percentile(latencies, 0.95) * 1000:7.1f}ms  "
+        f"p99 {_percentile(latencies, 0.99) * 1000:7.1f}ms  max {max(latencies, default=float('nan')) * 1000:7.1f}ms"
+    )
+    print("partitions per worker at the end:", dict(owners))
+    client.flushdb()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis", default="redis://localhost:6379/15", help="Redis URL (the database is flushed)")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--partitions", type=int, default=16)
+    parser.add_argument("--count", type=int, default=600, help="synthetic updates to send")
+    parser.add_argument("--chats", type=int, default=60, help="distinct chats for synthetic updates")
+    parser.add_argument("--rate", type=float, default=100.0, help="updates per second")
+    parser.add_argument("--kill-one", action="store_true", help="SIGKILL one worker halfway through")
+    parser.add_argument("--lease-ttl", type=float, default=3.0, help="UPDATE_STREAM_LEASE_TTL for the workers, s")
+    parser.add_argument("--claim-idle", type=float, default=10.0, help="UPDATE_STREAM_CLAIM_IDLE for the workers, s")
+    parser.add_argument("--reply-timeout", type=float, default=60.0)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--verbose", action="store_true", help="show bot output")
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# benchmarks/bench_webhook.py
+"""
+Замер режима webhook без обращения к Telegram и Gemini: задержка подтверждения (ответ 200 на POST обновления)
+и задержка "обновление пришло → бот отправил ответ".
+
+1. Поднимается заглушка Bot API (benchmarks/fake_bot_api.py).
+2. Бот запускается отдельным процессом (python -m ai_lu_bot.app) с UPDATE_MODE=webhook, GEMINI_BACKEND=fake
+   и TELEGRAM_API_BASE_URL на заглушку.
+3. Записанные обновления (JSON Lines, по одному Update на строку; по умолчанию — синтетические личные сообщения)
+   отправляются POST на webhook с заданной частотой, и для каждого ждётся sendMessage с ответом на него.
+Дополнительно проверяется, что POST с неверным секретом отклоняется (403).
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_webhook
+    python -m benchmarks.bench_webhook --updates recorded_updates.jsonl --rate 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import time
+from typing import List
+
+import httpx
+
+from benchmarks.fake_bot_api import FakeBotApi, synthetic_updates, update_key
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else float("nan")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _load_updates(args: argparse.Namespace) -> list:
+    if not args.updates:
+        return synthetic_updates(args.count, args.chats)
+    with open(args.updates, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _bot_env(api: FakeBotApi, port: int, secret: str, args: argparse.Namespace) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": "123456:FAKE-TOKEN",
+        "GEMINI_BACKEND": "fake",
+        "TELEGRAM_API_BASE_URL": api.base_url,
+        "UPDATE_MODE": "webhook",
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(port),
+        "WEBHOOK_URL": f"http://127.0.0.1:{port}/telegram",
+        "WEBHOOK_SECRET": secret,
+        "CONTEXT_STORAGE_TYPE": "memory",
+        "METRICS_LOG_INTERVAL": "0",
+        # Склейка серии сообщений в личке специально задерживает ответ — в замере она по умолчанию выключена
+        "DM_DEBOUNCE_WINDOW": str(args.debounce),
+    })
+    return env
+
+
+async def _run(args: argparse.Namespace) -> None:
+    api = FakeBotApi()
+    await api.start()
+    port = _free_port()
+    secret = secrets.token_urlsafe(16)
+    bot = subprocess.Popen(
+        [sys.executable, "-m", "ai_lu_bot.app"],
+        env=_bot_env(api, port, secret, args),
+        stdout=subprocess.DEVNULL if not args.verbose else None,
+        stderr=subprocess.DEVNULL if not args.verbose else None,
+    )
+    url = f"http://127.0.0.1:{port}/telegram"
+    try:
+        # Бот готов, когда зарегистрировал webhook у "Telegram"
+        started = time.monotonic()
+        while api.webhook is None:
+            if bot.poll() is not None:
+                raise RuntimeError(f"Bot exited with code {bot.returncode} before registering the webhook")
+            if time.monotonic() - started > args.startup_timeout:
+                raise RuntimeError("Bot did not register the webhook in time")
+            await asyncio.sleep(0.05)
+        print(f"bot ready in {time.monotonic() - started:.1f}s, webhook {api.webhook.get('url')}")
+
+        updates = _load_updates(args)
+        async with httpx.AsyncClient(timeout=10) as client:
+            forbidden = await client.post(url, json=updates[0], headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+            print(f"wrong secret -> HTTP {forbidden.status_code}")
+
+            async def deliver(index: int, update: dict):
+                await asyncio.sleep(index / args.rate)
+                sent = time.perf_counter()
+                response = await client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+                acked = time.perf_counter()
+                key = update_key(update)
+                replied = await api.wait_reply(key, args.reply_timeout) if key and response.status_code == 200 else None
+                return response.status_code, acked - sent, (replied - sent) if replied is not None else None
+
+            results = await asyncio.gather(*(deliver(i, update) for i, update in enumerate(updates)))
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        await api.close()
+
+    acks = [ack for status, ack, _ in results if status == 200]
+    replies = [reply for _, _, reply in results if reply is not None]
+    print(f"updates {len(results)}  acked {len(acks)}  replied {len(replies)}  rate {args.rate}/s")
+    print(
+        f"ack:   p50 {_percentile(acks, 0.5) * 1000:7.1f}ms  p95 {_percentile(acks, 0.95) * 1000:7.1f}ms  "
+        f"p99 {_percentile(acks, 0.99) * 1000:7.1f}ms"
+    )
+    print(
+        f"reply: p50 {_percentile(replies, 0.5) * 1000:7.1f}ms  p95 {_percentile(replies, 0.95) * 1000:7.1f}ms  "
+        f"p99 {_percentile(replies, 0.99) * 1000:7.1f}ms"
+    )
+    print("Bot API calls:", api.calls)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", help="JSON Lines file with recorded Telegram updates (default: synthetic DMs)")
+    parser.add_argument("--count", type=int, default=300, help="synthetic updates to send")
+    parser.add_argument("--chats", type=int, default=50, help="distinct chats for synthetic updates")
+    parser.add_argument("--rate", type=float, default=30.0, help="updates per second")
+    parser.add_argument("--debounce", type=float, default=0.0, help="DM_DEBOUNCE_WINDOW for the bot, s")
+    parser.add_argument("--reply-timeout", type=float, default=30.0)
+    parser.add_argument("--startup-timeout", type=float, default=30.0)
+    parser.add_argument("--verbose", action="store_true", help="show bot output")
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
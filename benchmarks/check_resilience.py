@@ -0,0 +1,181 @@
+# benchmarks/check_resilience.py
+"""
+Проверки слоя устойчивости вызова Gemini (services/resilience.py) на заглушках, без сети.
+Завершается с кодом 1, если хоть одна проверка не прошла.
+
+1. Автомат отключения: закрыт → открыт после серии сбоев → полуоткрыт с одним пробным запросом →
+   снова открыт при сбое пробы или закрыт при успехе.
+2. Пробный запрос, который отменили или который упал с ошибкой запроса (не 5xx), не оставляет автомат
+   полуоткрытым навсегда: следующий запрос снова становится пробным.
+3. Хеджирование: выигрывает первый успешный ответ, результат каждого другого успешного запроса
+   освобождается ровно один раз (в том числе когда обе попытки завершились одновременно);
+   через GeminiService с пулом ключей — после всех запросов ни один ключ не остаётся занятым.
+
+Запуск из корня проекта:
+    python -m benchmarks.check_resilience
+"""
+import asyncio
+import logging
+
+from ai_lu_bot.core.metrics import Histogram
+from ai_lu_bot.services.fake_backend import FakeModelBackend
+from ai_lu_bot.services.gemini import GeminiService, ModelConfig, ModelRouter
+from ai_lu_bot.services.key_pool import GeminiKeyPool
+from ai_lu_bot.services.resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
+from benchmarks.checks import Checks
+
+SERVER_ERROR = RuntimeError("503 Service unavailable")
+RESET = 0.1
+
+
+def _allowed(breaker: CircuitBreaker) -> bool:
+    try:
+        breaker.allow()
+    except CircuitOpenError:
+        return False
+    return True
+
+
+async def _fail() -> str:
+    raise SERVER_ERROR
+
+
+async def _ok() -> str:
+    return "ok"
+
+
+async def _breaker_states(checks: Checks) -> None:
+    breaker = CircuitBreaker("model", failure_threshold=2, reset_timeout=RESET)
+    breaker.record_failure()
+    checks.check("breaker stays closed below the threshold", breaker.state == "closed" and _allowed(breaker), breaker.state)
+    breaker.record_failure()
+    checks.check("breaker opens at the threshold and rejects calls", breaker.state == "open" and not _allowed(breaker), breaker.state)
+    await asyncio.sleep(RESET * 1.2)
+    checks.check("breaker turns half-open after the reset timeout", breaker.state == "half_open", breaker.state)
+    checks.check("half-open breaker lets exactly one probe through", _allowed(breaker) and not _allowed(breaker))
+    breaker.record_failure()
+    checks.check("failed probe opens the breaker again", breaker.state == "open", breaker.state)
+    await asyncio.sleep(RESET * 1.2)
+    _allowed(breaker)
+    breaker.record_success()
+    checks.check("successful probe closes the breaker", breaker.state == "closed" and _allowed(breaker), breaker.state)
+
+
+async def _probe_release(checks: Checks) -> None:
+    caller = ResilientCaller(max_attempts=1, attempt_timeout=2.0, breaker_threshold=1, breaker_reset=RESET)
+    loop = asyncio.get_running_loop()
+
+    async def call(factory) -> str:
+        return await caller.call("model", factory, loop.time() + 5)
+
+    try:
+        await call(_fail)
+    except RuntimeError:
+        pass
+    breaker = caller.breaker("model")
+    checks.check("one 5xx opens a breaker with threshold 1", breaker.state == "open", breaker.state)
+    await asyncio.sleep(RESET * 1.2)
+
+    probe = asyncio.create_task(call(lambda: asyncio.sleep(10, "late")))
+    await asyncio.sleep(0.02)
+    probe.cancel()
+    await asyncio.gather(probe, return_exceptions=True)
+    checks.check("cancelled probe releases the probe slot", breaker.state == "half_open" and _allowed(breaker), breaker.state)
+    breaker.record_neutral() # Слот, взятый проверкой выше, возвращается
+
+    async def bad_request() -> str:
+        raise ValueError("400 Request payload is invalid")
+
+    try:
+        await call(bad_request)
+    except ValueError:
+        pass
+    checks.check("probe failing with a non-5xx error releases the probe slot", _allowed(breaker), breaker.state)
+    breaker.record_neutral()
+
+    try:
+        result = await call(_ok)
+    except Exception as e:
+        result = repr(e)
+    checks.check("next request probes and closes the breaker", result == "ok" and breaker.state == "closed", f"{result}, {breaker.state}")
+
+
+async def _hedge_winner(checks: Checks) -> None:
+    caller = ResilientCaller(hedge=True)
+    discarded = []
+
+    # Первая попытка медленная, хеджированная быстрая: выигрывает вторая, первая отменяется и не освобождается дважды
+    attempts = iter([asyncio.sleep(1.0, "first"), asyncio.sleep(0.01, "second")])
+    result = await caller._hedged("model", lambda: next(attempts), 0.02, discarded.append)
+    checks.check("hedged request wins over a slow first attempt", result == "second", result)
+    checks.check("cancelled slow attempt is not discarded", discarded == [], discarded)
+
+    # Обе попытки завершаются в одной итерации цикла: одна возвращается, другая освобождается ровно один раз
+    release = asyncio.Event()
+    names = iter(["first", "second"])
+
+    async def together() -> str:
+        name = next(names)
+        await release.wait()
+        return name
+
+    discarded = []
+    hedged = asyncio.create_task(caller._hedged("model", together, 0.01, discarded.append))
+    await asyncio.sleep(0.05)
+    release.set()
+    result = await hedged
+    checks.check(
+        "simultaneous successes: one returned, the other discarded once",
+        sorted([result, *discarded]) == ["first", "second"], f"returned {result}, discarded {discarded}",
+    )
+
+    # Обе попытки упали: пробрасывается ошибка, освобождать нечего
+    discarded = []
+    try:
+        await caller._hedged("model", _fail, 0.0, discarded.append)
+        failed = False
+    except RuntimeError:
+        failed = True
+    checks.check("hedge with both attempts failing raises and discards nothing", failed and discarded == [], discarded)
+
+
+async def _hedge_keys(checks: Checks) -> None:
+    backends = [FakeModelBackend(name=f"fake{i}", latency=0.05) for i in range(2)]
+    pool = GeminiKeyPool(backends, labels=[backend.name for backend in backends])
+    config = ModelConfig()
+    resilience = ResilientCaller(hedge=True, attempt_timeout=2.0)
+    # Модель «обычно» отвечает за 5 мс: каждый запрос к заглушке (50 мс) получает хеджированного двойника
+    histogram = resilience._latencies.setdefault(config.model_name, Histogram())
+    for _ in range(50):
+        histogram.observe(0.001)
+    service = GeminiService(model_config=config, key_pool=pool, router=ModelRouter([], (config,)), resilience=resilience)
+
+    async def request() -> None:
+        key, response = await service._call_chain("dm", None, ["промпт"], estimated_tokens=100)
+        pool.release(key, 100, response.usage_metadata.total_token_count)
+
+    results = await asyncio.gather(*(request() for _ in range(20)), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    calls = sum(backend.calls for backend in backends)
+    in_flight = {label: stats["in_flight"] for label, stats in pool.stats().items()}
+    checks.check("hedged requests through the key pool all succeed", not errors, errors[:3])
+    checks.check("hedges were actually sent", calls > 20, f"{calls} calls for 20 requests")
+    checks.check("no key stays in flight after hedged requests", all(v == 0 for v in in_flight.values()), in_flight)
+
+
+async def _run() -> None:
+    checks = Checks()
+    await _breaker_states(checks)
+    await _probe_release(checks)
+    await _hedge_winner(checks)
+    await _hedge_keys(checks)
+    checks.exit()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.CRITICAL) # Повторы и автоматы пишут предупреждения на каждый сбой
+    asyncio.run(_run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# benchmarks/check_scheduler.py
+"""
+Проверки планировщика запросов к Gemini (services/scheduler.py) без сети.
+Завершается с кодом 1, если хоть одна проверка не прошла.
+
+1. Приоритеты: при исчерпанном лимите RPM ожидающие получают разрешение в порядке важности триггера,
+   а не в порядке прихода.
+2. Переполнение очереди: вытесняется самый неважный запрос, а новый неважный запрос при полной очереди
+   отвергается сразу.
+3. try_acquire: дополнительный вызов списывается с лимита, пока он есть, и не отправляется, если лимит исчерпан,
+   запросы приостановлены после ошибки квоты или в очереди кто-то ждёт; каждый исход попадает в метрики.
+4. Через GeminiService на заглушке со сбоями 503: вызовов модели не больше, чем выдано разрешений
+   (допусков плюс дополнительных вызовов).
+
+Запуск из корня проекта:
+    python -m benchmarks.check_scheduler
+"""
+import asyncio
+import logging
+from typing import Any, Dict
+
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.services.fake_backend import FakeModelBackend
+from ai_lu_bot.services.gemini import GeminiService, ModelConfig, ModelRouter
+from ai_lu_bot.services.key_pool import GeminiKeyPool
+from ai_lu_bot.services.resilience import ResilientCaller
+from ai_lu_bot.services.scheduler import GeminiScheduler, SchedulerRejected
+from benchmarks.checks import Checks
+
+SERVER_ERROR = RuntimeError("503 Service unavailable")
+RPM = 600 # Корзина на 150 запросов, пополняется на 10 в секунду
+
+
+def _counter(name: str, **labels: Any) -> float:
+    key = name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+    return metrics.snapshot()["counters"].get(key, 0)
+
+
+def _drain(scheduler: GeminiScheduler) -> None:
+    """Выбирает корзину RPM до дна, чтобы следующие запросы вставали в очередь."""
+    while scheduler.try_acquire("dm", 1):
+        pass
+
+
+async def _priority_order(checks: Checks) -> None:
+    scheduler = GeminiScheduler(requests_per_minute=RPM)
+    _drain(scheduler)
+    order = []
+
+    async def request(trigger: str) -> None:
+        await scheduler.acquire(trigger, 1)
+        order.append(trigger)
+
+    tasks = []
+    for trigger in ("random_group_message", "channel_post_forwarded_or_sent_as", "dm"):
+        tasks.append(asyncio.create_task(request(trigger)))
+        await asyncio.sleep(0.01) # Порядок прихода: фоновый, обычный, личка
+    queued = scheduler.stats()["queued"]
+    checks.check("requests queue up once the rpm bucket is empty", queued == {0: 1, 1: 1, 2: 1}, queued)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    checks.check("all queued requests are granted", not any(isinstance(r, BaseException) for r in results), results)
+    checks.check(
+        "queued requests are granted by priority, not arrival",
+        order == ["dm", "channel_post_forwarded_or_sent_as", "random_group_message"], order,
+    )
+
+
+async def _shedding(checks: Checks) -> None:
+    scheduler = GeminiScheduler(requests_per_minute=RPM, max_queue=2)
+    _drain(scheduler)
+    scheduler.backoff(5.0) # Очередь не разбирается, пока идёт проверка
+    background = [asyncio.create_task(scheduler.acquire("random_group_message", 1)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    interactive = asyncio.create_task(scheduler.acquire("dm", 1))
+    await asyncio.sleep(0.01)
+    shed = [task for task in background if task.done()]
+    checks.check(
+        "full queue sheds the newest background request for an interactive one",
+        len(shed) == 1 and shed[0] is background[1] and isinstance(shed[0].exception(), SchedulerRejected),
+        [task.done() for task in background],
+    )
+    try:
+        await scheduler.acquire("random_group_message", 1)
+        rejected = False
+    except SchedulerRejected:
+        rejected = True
+    checks.check("background request is rejected outright when the queue holds nothing less important", rejected)
+    for task in (background[0], interactive):
+        task.cancel()
+    await asyncio.gather(background[0], interactive, return_exceptions=True)
+
+
+async def _try_acquire(checks: Checks) -> None:
+    def extra(result: str) -> float:
+        return _counter("gemini_scheduler_extra_calls", priority=0, result=result)
+
+    scheduler = GeminiScheduler(requests_per_minute=RPM)
+    granted_before, skipped_before = extra("granted"), extra("skipped")
+    level = scheduler.stats()["rpm_bucket"]
+    allowed = scheduler.try_acquire("dm", 100)
+    checks.check(
+        "try_acquire with budget left grants and charges one request",
+        allowed and scheduler.stats()["rpm_bucket"] == level - 1, f"{allowed}, bucket {level} -> {scheduler.stats()['rpm_bucket']}",
+    )
+    granted = 1
+    while scheduler.try_acquire("dm", 100):
+        granted += 1
+    checks.check("try_acquire grants no more than the bucket holds", granted <= RPM / 4 + 1, granted)
+    checks.check(
+        "try_acquire outcomes are counted",
+        extra("granted") - granted_before == granted and extra("skipped") - skipped_before == 1,
+        f"granted +{extra('granted') - granted_before}, skipped +{extra('skipped') - skipped_before}",
+    )
+
+    scheduler = GeminiScheduler(requests_per_minute=RPM)
+    scheduler.backoff(5.0)
+    checks.check("try_acquire is refused during a quota backoff", not scheduler.try_acquire("dm", 100))
+
+    # Лимит токенов держит большой запрос в очереди, лимит запросов при этом не исчерпан
+    scheduler = GeminiScheduler(requests_per_minute=RPM, tokens_per_minute=4000)
+    await scheduler.acquire("dm", 900)
+    waiting = asyncio.create_task(scheduler.acquire("random_group_message", 900))
+    await asyncio.sleep(0.01)
+    checks.check("try_acquire does not overtake a queued request", not scheduler.try_acquire("dm", 1), scheduler.stats())
+    waiting.cancel()
+    await asyncio.gather(waiting, return_exceptions=True)
+
+
+async def _service_accounting(checks: Checks) -> None:
+    counters_before: Dict[str, float] = {
+        name: _counter(name, priority=0, result=result)
+        for name, result in (("gemini_scheduler_requests", "granted"), ("gemini_scheduler_extra_calls", "granted"))
+    }
+    backend = FakeModelBackend(name="flaky", latency=0.01, failure=SERVER_ERROR, failure_rate=0.5)
+    scheduler = GeminiScheduler(requests_per_minute=120, queue_timeouts=(3.0, 3.0, 3.0))
+    config = ModelConfig()
+    service = GeminiService(
+        model_config=config,
+        key_pool=GeminiKeyPool([backend], labels=[backend.name]),
+        scheduler=scheduler,
+        router=ModelRouter([], (config,)),
+        resilience=ResilientCaller(max_attempts=3, base_delay=0.01, breaker_threshold=10**6),
+    )
+
+    async def request() -> None:
+        if await service._admit("dm", None, 100) is not None:
+            raise RuntimeError("rejected by scheduler")
+        key, response = await service._call_chain("dm", None, ["промпт"], estimated_tokens=100)
+        service.key_pool.release(key, 100, response.usage_metadata.total_token_count)
+
+    await asyncio.gather(*(request() for _ in range(40)), return_exceptions=True)
+    admitted = _counter("gemini_scheduler_requests", priority=0, result="granted") - counters_before["gemini_scheduler_requests"]
+    extra = _counter("gemini_scheduler_extra_calls", priority=0, result="granted") - counters_before["gemini_scheduler_extra_calls"]
+    checks.check(
+        "model calls never exceed scheduler grants",
+        0 < backend.calls <= admitted + extra, f"{backend.calls} calls, {admitted} admitted + {extra} extra",
+    )
+
+
+async def _run() -> None:
+    checks = Checks()
+    await _priority_order(checks)
+    await _shedding(checks)
+    await _try_acquire(checks)
+    await _service_accounting(checks)
+    checks.exit()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.CRITICAL) # Отброшенные запросы и повторы пишут предупреждения
+    asyncio.run(_run())
+
+
+if __name__ == "__main__":
+    main()
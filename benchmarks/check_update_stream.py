@@ -0,0 +1,246 @@
+# benchmarks/check_update_stream.py
+"""
+Проверки очереди обновлений в Redis Streams (services/update_stream.py): передача потоков между обработчиками
+и подбор записей упавшего обработчика. Без Telegram и Gemini; Redis — заглушка fakeredis (pip install fakeredis)
+или настоящий с --redis. Завершается с кодом 1, если хоть одна проверка не прошла.
+
+1. Передача аренды: второй обработчик подключается, пока первый разбирает поток обновлений. Потоки делятся
+   поровну, ни одним потоком два обработчика не владеют одновременно, новый владелец не начинает запись потока,
+   пока прежний не закончил начатые, каждое обновление обработано ровно один раз и в порядке своего чата.
+2. Подбор: обработчик «упал», прочитав записи и не подтвердив их. Пока его аренда не истекла, поток никто не трогает;
+   затем поток забирает живой обработчик и первыми обрабатывает неподтверждённые записи, потом новые.
+
+Запуск из корня проекта:
+    python -m benchmarks.check_update_stream
+    python -m benchmarks.check_update_stream --redis redis://localhost:6379/15   # БД очищается
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import redis.asyncio as aioredis
+
+from ai_lu_bot.core.metrics import metrics
+from ai_lu_bot.services.update_stream import (
+    _GROUP, _RELEASE_SCRIPT, _RENEW_SCRIPT, UpdateStreamPublisher, UpdateStreamWorker, lease_key, stream_key,
+)
+from benchmarks.checks import Checks
+
+PARTITIONS = 4
+LEASE_TTL = 0.6 # Аренда продлевается и потоки перераспределяются каждые 0.2 с
+CHATS = 8
+ROUNDS = 60
+
+
+def _fake_client_factory() -> Callable[[], aioredis.Redis]:
+    import fakeredis
+
+    class _BlockingFakeRedis(fakeredis.FakeAsyncRedis):
+        """fakeredis не ждёт по BLOCK: без паузы пустое чтение превращается в холостой цикл."""
+        async def xreadgroup(self, *args, block: Optional[int] = None, **kwargs):
+            response = await super().xreadgroup(*args, block=block, **kwargs)
+            if not response and block:
+                await asyncio.sleep(block / 1000)
+            return response
+
+    server = fakeredis.FakeServer()
+    return lambda: _BlockingFakeRedis(server=server)
+
+
+def _use_client(component, client: aioredis.Redis) -> None:
+    """Подменяет клиент Redis публикатора или обработчика (для fakeredis)."""
+    component._client = client
+    if isinstance(component, UpdateStreamWorker):
+        component._renew_script = client.register_script(_RENEW_SCRIPT)
+        component._release_script = client.register_script(_RELEASE_SCRIPT)
+
+
+class _Setup:
+    """Создаёт публикатор, обработчики и служебный клиент на одном Redis (настоящем или fakeredis)."""
+    def __init__(self, url: Optional[str]):
+        self._url = urlparse(url) if url else None
+        self._fake = _fake_client_factory() if url is None else None
+
+    def _address(self) -> Dict[str, object]:
+        return {"host": self._url.hostname or "localhost", "port": self._url.port or 6379, "db": int(self._url.path.lstrip("/") or 0)}
+
+    def client(self) -> aioredis.Redis:
+        return self._fake() if self._fake else aioredis.Redis(**self._address())
+
+    def publisher(self) -> UpdateStreamPublisher:
+        if self._fake:
+            publisher = UpdateStreamPublisher(partitions=PARTITIONS)
+            _use_client(publisher, self._fake())
+            return publisher
+        return UpdateStreamPublisher(partitions=PARTITIONS, **self._address())
+
+    def worker(self, name: str, handler, concurrency: int = 8) -> UpdateStreamWorker:
+        options = dict(partitions=PARTITIONS, consumer=name, concurrency=concurrency, lease_ttl=LEASE_TTL, claim_idle=60.0, block=0.05)
+        if self._fake:
+            worker = UpdateStreamWorker(handler, **options)
+            _use_client(worker, self._fake())
+            return worker
+        return UpdateStreamWorker(handler, **options, **self._address())
+
+
+async def _wait_for(condition: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.02)
+    return True
+
+
+async def _stop(worker: UpdateStreamWorker, task: asyncio.Task) -> None:
+    worker.stop()
+    await task
+    await worker.close()
+
+
+async def _handover(checks: Checks, setup: _Setup) -> None:
+    admin = setup.client()
+    await admin.flushdb()
+    workers: Dict[str, UpdateStreamWorker] = {}
+    processed: List[Tuple[str, int, int]] = []
+    overlaps: List[Tuple[str, int, int]] = []
+
+    def handler_for(name: str):
+        async def handle(payload: str) -> None:
+            update = json.loads(payload)
+            partition = update["chat"] % PARTITIONS
+            # Начатые записи этого потока у другого обработчика означают, что он отдал поток, не дождавшись их
+            for other_name, other in workers.items():
+                if other_name != name and any(p == partition for p, _ in other._in_flight):
+                    overlaps.append((name, update["chat"], update["seq"]))
+            processed.append((name, update["chat"], update["seq"]))
+            await asyncio.sleep(0.01)
+        return handle
+
+    first = workers["worker-a"] = setup.worker("worker-a", handler_for("worker-a"))
+    first_task = asyncio.create_task(first.run())
+    took_all = await _wait_for(lambda: len(first._owned) == PARTITIONS, 3.0)
+    checks.check("single worker leases every partition", took_all, first.stats())
+
+    publisher = setup.publisher()
+
+    async def publish() -> None:
+        for seq in range(ROUNDS):
+            for chat in range(CHATS):
+                await publisher.publish(chat, json.dumps({"chat": chat, "seq": seq}))
+            await asyncio.sleep(0.02)
+
+    shared: List[Tuple[int, ...]] = [] # Потоки, которыми оба обработчика владели одновременно
+
+    async def watch() -> None:
+        while True:
+            both = set(first._owned) & set(workers["worker-b"]._owned) if "worker-b" in workers else set()
+            if both:
+                shared.append(tuple(sorted(both)))
+            await asyncio.sleep(0.01)
+
+    publishing = asyncio.create_task(publish())
+    watcher = asyncio.create_task(watch())
+    await asyncio.sleep(0.3)
+    second = workers["worker-b"] = setup.worker("worker-b", handler_for("worker-b"))
+    second_task = asyncio.create_task(second.run())
+    await publishing
+    total = ROUNDS * CHATS
+    await _wait_for(lambda: len(processed) >= total, 10.0)
+    balanced = await _wait_for(lambda: len(first._owned) == len(second._owned) == PARTITIONS // 2 and not first._draining, 3.0)
+    watcher.cancel()
+    await asyncio.gather(watcher, return_exceptions=True)
+
+    owners = [owner.decode() if owner else "" for owner in await admin.mget([lease_key(p) for p in range(PARTITIONS)])]
+    expected = ["worker-a" if p in first._owned else "worker-b" if p in second._owned else "" for p in range(PARTITIONS)]
+    checks.check("partitions are split evenly after a worker joins", balanced, f"a {sorted(first._owned)}, b {sorted(second._owned)}")
+    checks.check("lease keys name the worker that reads the partition", owners == expected, f"{owners} vs {expected}")
+    checks.check("no partition is owned by two workers at once", not shared, shared[:5])
+    checks.check("new owner starts a partition only after the old one finished its entries", not overlaps, overlaps[:5])
+    seen = [(chat, seq) for _, chat, seq in processed]
+    checks.check("every update is processed exactly once", sorted(seen) == sorted((c, s) for s in range(ROUNDS) for c in range(CHATS)),
+                 f"{len(seen)} processed, {len(set(seen))} distinct of {total}")
+    out_of_order = [chat for chat in range(CHATS) if [s for c, s in seen if c == chat] != sorted(s for c, s in seen if c == chat)]
+    checks.check("updates of each chat are processed in order across the handover", not out_of_order, out_of_order)
+    checks.check("both workers processed updates", {name for name, _, _ in processed} == {"worker-a", "worker-b"})
+
+    await _stop(second, second_task)
+    await _stop(first, first_task)
+    await publisher.close()
+    await admin.aclose()
+
+
+async def _reclaim(checks: Checks, setup: _Setup) -> None:
+    admin = setup.client()
+    await admin.flushdb()
+    publisher = setup.publisher()
+    chat = 1
+    stream = stream_key(chat % PARTITIONS)
+
+    # «Упавший» обработчик: взял аренду и прочитал первые записи, но не подтвердил их
+    dead_lease = LEASE_TTL * 2
+    for partition in range(PARTITIONS):
+        await admin.set(lease_key(partition), "crashed", px=int(dead_lease * 1000))
+        await admin.xgroup_create(stream_key(partition), _GROUP, id="0", mkstream=True)
+    for seq in range(3):
+        await publisher.publish(chat, json.dumps({"chat": chat, "seq": seq}))
+    read = await admin.xreadgroup(_GROUP, "crashed", {stream: ">"}, count=10)
+    for seq in range(3, 5):
+        await publisher.publish(chat, json.dumps({"chat": chat, "seq": seq}))
+    crashed_at = time.monotonic()
+
+    processed: List[int] = []
+
+    async def handle(payload: str) -> None:
+        processed.append(json.loads(payload)["seq"])
+
+    counters = metrics.snapshot()["counters"]
+    reclaimed_before = counters.get("updates_reclaimed", 0)
+    worker = setup.worker("worker-c", handle)
+    task = asyncio.create_task(worker.run())
+    await asyncio.sleep(dead_lease / 2)
+    checks.check("partition of a crashed worker is untouched while its lease lasts", not processed and not worker._owned, processed)
+    done = await _wait_for(lambda: len(processed) >= 5, dead_lease + 3.0)
+    reclaimed = metrics.snapshot()["counters"].get("updates_reclaimed", 0) - reclaimed_before
+    pending = await admin.xpending(stream, _GROUP)
+    checks.check("crashed worker had unacknowledged entries", sum(len(entries) for _, entries in read or ()) == 3, read)
+    checks.check("live worker takes the partition after the lease expires", done and time.monotonic() - crashed_at >= dead_lease * 0.9,
+                 f"processed {processed}")
+    checks.check("unacknowledged entries are reclaimed first, then new ones, in order", processed == [0, 1, 2, 3, 4], processed)
+    checks.check("exactly the unacknowledged entries count as reclaimed", reclaimed == 3, reclaimed)
+    checks.check("everything is acknowledged afterwards", pending["pending"] == 0, pending)
+    checks.check("lease of the partition now names the live worker", (await admin.get(lease_key(chat % PARTITIONS))) == b"worker-c")
+
+    await _stop(worker, task)
+    await publisher.close()
+    await admin.aclose()
+
+
+async def _run(args: argparse.Namespace) -> None:
+    setup = _Setup(args.redis)
+    checks = Checks()
+    await _handover(checks, setup)
+    await _reclaim(checks, setup)
+    checks.exit()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis", help="URL настоящего Redis (БД очищается); по умолчанию — fakeredis")
+    args = parser.parse_args()
+    if args.redis is None:
+        try:
+            import fakeredis # noqa: F401
+        except ImportError:
+            sys.exit("fakeredis is not installed: pip install fakeredis, or pass --redis redis://localhost:6379/15")
+    logging.basicConfig(level=logging.CRITICAL)
+    asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    main()
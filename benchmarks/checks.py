@@ -0,0 +1,26 @@
+# benchmarks/checks.py
+"""
+Общая часть проверочных скриптов benchmarks/check_*.py: в отличие от бенчмарков они не печатают цифры,
+а проверяют поведение на заглушках без сети и завершаются с ненулевым кодом, если хоть одна проверка не прошла.
+"""
+import sys
+
+
+class Checks:
+    """Набор проверок одного скрипта: каждая печатается как [ok] или [FAIL], итог — код выхода."""
+    def __init__(self):
+        self.passed = 0
+        self.failed = 0
+
+    def check(self, name: str, condition: bool, detail: object = "") -> bool:
+        if condition:
+            self.passed += 1
+            print(f"[ok]   {name}")
+        else:
+            self.failed += 1
+            print(f"[FAIL] {name}" + (f": {detail}" if detail != "" else ""))
+        return condition
+
+    def exit(self) -> None:
+        print(f"{self.passed} passed, {self.failed} failed")
+        sys.exit(1 if self.failed else 0)
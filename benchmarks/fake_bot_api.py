@@ -0,0 +1,173 @@
+# benchmarks/fake_bot_api.py
+"""
+Заглушка Telegram Bot API для локальных замеров: отвечает на вызовы бота (getMe, setWebhook, sendMessage, …)
+без обращения к Telegram и запоминает, когда пришёл каждый ответ бота. Бот направляется на неё
+через TELEGRAM_API_BASE_URL=http://127.0.0.1:<порт>.
+
+Также здесь — генерация обновлений Telegram (личные сообщения) для харнессов.
+"""
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+BOT_ID = 777000111
+BOT_USER = {
+    "id": BOT_ID,
+    "is_bot": True,
+    "first_name": "Лу",
+    "username": "AI_LU_Bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": True,
+    "supports_inline_queries": False,
+}
+
+
+def private_message_update(update_id: int, chat_id: int, message_id: int, text: str) -> Dict[str, Any]:
+    """Обновление с текстовым личным сообщением (в формате, который Telegram присылает боту)."""
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}", "username": f"user_{chat_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"], "username": user["username"]},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+def synthetic_updates(count: int, chats: int) -> List[Dict[str, Any]]:
+    """count личных сообщений, равномерно по chats чатам."""
+    return [
+        private_message_update(i + 1, 100000 + i % chats, 1 + i // chats, f"Лу, как думаешь, в чём смысл жизни? (вопрос №{i + 1})")
+        for i in range(count)
+    ]
+
+
+def update_key(update: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    """(chat_id, message_id) сообщения обновления — по нему ответ бота сопоставляется с обновлением."""
+    message = update.get("message") or update.get("edited_message") or update.get("channel_post")
+    if not message:
+        return None
+    return message["chat"]["id"], message["message_id"]
+
+
+class FakeBotApi:
+    """
+    Минимальный HTTP/1.1-сервер на asyncio с методами Bot API, которые вызывает бот.
+    replies: (chat_id, message_id, на который ответил бот) -> время получения первого sendMessage (time.perf_counter);
+    reply_counts — сколько раз бот ответил на сообщение (больше 1 — обновление обработано повторно).
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.replies: Dict[Tuple[int, int], float] = {}
+        self.reply_counts: Dict[Tuple[int, int], int] = {}
+        self.calls: Dict[str, int] = {}
+        self.webhook: Optional[Dict[str, Any]] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._next_message_id = 1_000_000
+        self._reply_waiters: Dict[Tuple[int, int], asyncio.Future] = {}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def wait_reply(self, key: Tuple[int, int], timeout: float) -> Optional[float]:
+        """Ждёт ответа бота на сообщение key; возвращает время его получения или None по таймауту."""
+        if key in self.replies:
+            return self.replies[key]
+        waiter = self._reply_waiters.setdefault(key, asyncio.get_running_loop().create_future())
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                _, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                result = self._call(path.rsplit("/", 1)[-1], self._params(headers.get("content-type", ""), body))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _params(content_type: str, body: bytes) -> Dict[str, Any]:
+        if not body:
+            return {}
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        # PTB шлёт параметры формой, значения — в JSON (строки, числа, вложенные объекты)
+        params = {}
+        for name, values in parse_qs(body.decode(), keep_blank_values=True).items():
+            try:
+                params[name] = json.loads(values[0])
+            except ValueError:
+                params[name] = values[0]
+        return params
+
+    def _message(self, params: Dict[str, Any], message_id: Optional[int] = None) -> Dict[str, Any]:
+        if message_id is None:
+            self._next_message_id += 1
+            message_id = self._next_message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "from": BOT_USER,
+            "text": str(params.get("text", "")),
+        }
+
+    def _call(self, method: str, params: Dict[str, Any]) -> Any:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self.webhook = params
+            return True
+        if method == "sendMessage":
+            reply_to = params.get("reply_to_message_id")
+            if reply_to is not None:
+                key = (int(params["chat_id"]), int(reply_to))
+                self.reply_counts[key] = self.reply_counts.get(key, 0) + 1
+                self.replies.setdefault(key, time.perf_counter())
+                waiter = self._reply_waiters.pop(key, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(self.replies[key])
+            return self._message(params)
+        if method == "editMessageText":
+            return self._message(params, int(params.get("message_id", 0)))
+        # deleteWebhook, sendChatAction и прочее
+        return True